@@ -0,0 +1,145 @@
+import atexit
+import threading
+from collections import deque
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from logger import get_logger
+
+from .rollups import apply_rollups
+
+logger = get_logger(__name__)
+
+
+class EventBuffer:
+    """
+    Collects rows in memory and writes them with `bulk_create` from a
+    background thread once `batch_size` rows are pending or `flush_interval`
+    seconds have passed, so request handlers never wait on an INSERT.
+
+    Memory is bounded by `max_events`. When the buffer is full, the
+    `drop_policy` decides whether the incoming row ('newest') or the oldest
+    pending row ('oldest') is discarded. Rows of a batch the database
+    rejected are lost too; `dropped` counts both.
+    """
+
+    def __init__(self, model_label, max_events=10000, batch_size=500,
+                 flush_interval=2.0, drop_policy='newest'):
+        if drop_policy not in ('newest', 'oldest'):
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+        self.model_label = model_label
+        self.max_events = max_events
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drop_policy = drop_policy
+        self.dropped = 0
+        self.written = 0
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def add(self, **fields):
+        """
+        Queues one row. Returns False if the row was dropped.
+        """
+        with self._condition:
+            if len(self._pending) >= self.max_events:
+                self.dropped += 1
+                if self.drop_policy == 'newest':
+                    return False
+                self._pending.popleft()
+            self._pending.append(fields)
+            if self._thread is None:
+                self._start()
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+        return True
+
+    def flush(self):
+        """
+        Writes every pending row. Returns the number of rows written.
+        """
+        with self._flush_lock:
+            with self._condition:
+                rows = list(self._pending)
+                self._pending.clear()
+            if not rows:
+                return 0
+            model = apps.get_model(self.model_label)
+            try:
+                objs = [model(**fields) for fields in rows]
+                model.objects.bulk_create(objs, batch_size=self.batch_size)
+            except Exception as e:
+                logger.error(f"Failed to write {len(rows)} {self.model_label} rows: {e}")
+                with self._condition:
+                    self.dropped += len(rows)
+                return 0
+            finally:
+                close_old_connections()
+            self.written += len(rows)
+            self.after_flush(objs)
+            return len(rows)
+
+    def after_flush(self, objs):
+        """Hook for subclasses that maintain derived data from written rows."""
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name=f"{self.model_label}-buffer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if len(self._pending) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+            self.flush()
+
+
+class AnalyticsEventBuffer(EventBuffer):
+    """Event buffer that also folds every flushed batch into the rollup tables."""
+
+    def after_flush(self, objs):
+        try:
+            apply_rollups(objs)
+        except Exception as e:
+            logger.error(f"Failed to update analytics rollups: {e}")
+        finally:
+            close_old_connections()
+
+
+def buffer_setting(name, default):
+    return getattr(settings, 'ANALYTICS_BUFFER', {}).get(name, default)
+
+
+analytics_buffer = AnalyticsEventBuffer(
+    'analytics_app.AnalyticsEvent',
+    max_events=buffer_setting('MAX_EVENTS', 10000),
+    batch_size=buffer_setting('BATCH_SIZE', 500),
+    flush_interval=buffer_setting('FLUSH_INTERVAL', 2.0),
+    drop_policy=buffer_setting('DROP_POLICY', 'newest'),
+)
+
+
+def record_event(event_type, event_data, user=None):
+    """
+    Buffers an AnalyticsEvent without touching the database on the caller's thread.
+
+    Args:
+        event_type (str): One of AnalyticsEvent.EVENT_TYPES.
+        event_data (dict): JSON-serializable event payload.
+        user (User, optional): The user the event belongs to.
+
+    Returns:
+        bool: False if the event was dropped because the buffer was full.
+    """
+    return analytics_buffer.add(
+        user_id=user.pk if user is not None and user.is_authenticated else None,
+        event_type=event_type,
+        event_data=event_data,
+        timestamp=timezone.now(),
+    )
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from analytics_app.rollups import bucket_start, prune_expired, rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Applies the analytics retention policy and optionally rebuilds recent rollups from raw events."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rebuild-hours', type=int, default=0,
+            help="Recompute rollups for the last N hours from raw events before pruning.",
+        )
+
+    def handle(self, *args, **options):
+        hours = options['rebuild_hours']
+        if hours:
+            end = bucket_start(timezone.now(), 'hour') + timedelta(hours=1)
+            rebuild_rollups(end - timedelta(hours=hours + 1), end)
+            self.stdout.write(f"Rebuilt rollups for the last {hours} hours.")
+        raw_deleted, minute_deleted = prune_expired()
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {raw_deleted} raw events and {minute_deleted} minute rollups."))
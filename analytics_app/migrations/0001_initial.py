@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:25
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('minute', 'Minute'), ('hour', 'Hour')], max_length=10)),
+                ('bucket_start', models.DateTimeField()),
+                ('event_type', models.CharField(choices=[('chat', 'Chat'), ('search', 'Search'), ('file_upload', 'File Upload'), ('model_inference', 'Model Inference')], max_length=20)),
+                ('model_name', models.CharField(blank=True, default='', max_length=255)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('latency_count', models.PositiveIntegerField(default=0)),
+                ('latency_sum_ms', models.FloatField(default=0.0)),
+                ('latency_histogram', models.JSONField(default=list)),
+            ],
+            options={
+                'ordering': ['bucket_start'],
+                'indexes': [models.Index(fields=['granularity', 'bucket_start'], name='analytics_a_granula_430b18_idx')],
+                'constraints': [models.UniqueConstraint(fields=('granularity', 'event_type', 'model_name', 'bucket_start'), name='unique_analytics_rollup_bucket')],
+            },
+        ),
+        migrations.CreateModel(
+            name='AnalyticsEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_type', models.CharField(choices=[('chat', 'Chat'), ('search', 'Search'), ('file_upload', 'File Upload'), ('model_inference', 'Model Inference')], max_length=20)),
+                ('event_data', models.JSONField()),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-timestamp'],
+                'indexes': [models.Index(fields=['event_type', 'timestamp'], name='analytics_a_event_t_9c9aa4_idx'), models.Index(fields=['timestamp'], name='analytics_a_timesta_475fe1_idx')],
+            },
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class AnalyticsEvent(models.Model):
     EVENT_TYPES = [
@@ -12,10 +13,50 @@ class AnalyticsEvent(models.Model):
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     event_type = models.CharField(max_length=20, choices=EVENT_TYPES)
     event_data = models.JSONField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set by the caller so buffered events keep the time they happened
+    timestamp = models.DateTimeField(default=timezone.now)
 
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['event_type', 'timestamp']),
+            models.Index(fields=['timestamp']),
+        ]
 
     def __str__(self):
         return f"{self.event_type} - {self.timestamp}"
+
+class AnalyticsRollup(models.Model):
+    """
+    Pre-aggregated event counts and latency histogram for one time bucket,
+    event type and model. Dashboards read these instead of raw events.
+    """
+    GRANULARITIES = [
+        ('minute', 'Minute'),
+        ('hour', 'Hour'),
+    ]
+
+    granularity = models.CharField(max_length=10, choices=GRANULARITIES)
+    bucket_start = models.DateTimeField()
+    event_type = models.CharField(max_length=20, choices=AnalyticsEvent.EVENT_TYPES)
+    model_name = models.CharField(max_length=255, blank=True, default='')
+    count = models.PositiveIntegerField(default=0)
+    latency_count = models.PositiveIntegerField(default=0)
+    latency_sum_ms = models.FloatField(default=0.0)
+    # Counts per bucket of analytics_app.rollups.LATENCY_BUCKETS_MS, plus overflow
+    latency_histogram = models.JSONField(default=list)
+
+    class Meta:
+        ordering = ['bucket_start']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['granularity', 'event_type', 'model_name', 'bucket_start'],
+                name='unique_analytics_rollup_bucket',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['granularity', 'bucket_start']),
+        ]
+
+    def __str__(self):
+        return f"{self.granularity} {self.event_type} {self.model_name} - {self.bucket_start}"
@@ -0,0 +1,211 @@
+import bisect
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from logger import get_logger
+
+from .models import AnalyticsEvent, AnalyticsRollup
+
+logger = get_logger(__name__)
+
+# Upper bounds (ms) of the latency histogram buckets; the last slot counts overflow
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                      10000, 25000, 60000, 120000, 300000)
+
+# Rounds of merging again after concurrent writers changed or created the same buckets
+MERGE_ATTEMPTS = 5
+
+GRANULARITY_DELTAS = {
+    'minute': timedelta(minutes=1),
+    'hour': timedelta(hours=1),
+}
+
+
+def bucket_start(timestamp, granularity):
+    if granularity == 'minute':
+        return timestamp.replace(second=0, microsecond=0)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def _empty_histogram():
+    return [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+
+def _aggregate(events):
+    """
+    Folds events into {(granularity, bucket_start, event_type, model): totals}.
+    """
+    totals = {}
+    for event in events:
+        data = event.event_data if isinstance(event.event_data, dict) else {}
+        model_name = str(data.get('model', ''))[:255]
+        latency = data.get('latency_ms')
+        for granularity in GRANULARITY_DELTAS:
+            key = (granularity, bucket_start(event.timestamp, granularity), event.event_type, model_name)
+            entry = totals.get(key)
+            if entry is None:
+                entry = totals[key] = {'count': 0, 'latency_count': 0, 'latency_sum_ms': 0.0,
+                                       'latency_histogram': _empty_histogram()}
+            entry['count'] += 1
+            if isinstance(latency, (int, float)):
+                entry['latency_count'] += 1
+                entry['latency_sum_ms'] += latency
+                entry['latency_histogram'][bisect.bisect_left(LATENCY_BUCKETS_MS, latency)] += 1
+    return totals
+
+
+def apply_rollups(events):
+    """
+    Adds a batch of newly written events to the rollup tables. Called by the
+    ingestion buffer after every flush, so rollups trail raw events by at
+    most one flush interval.
+    """
+    _merge(_aggregate(events))
+
+
+def _merge(totals):
+    for attempt in range(MERGE_ATTEMPTS):
+        if not totals:
+            return
+        try:
+            totals = _merge_totals(totals)
+        except IntegrityError:
+            # Another process created one of the buckets first; merge again
+            if attempt == MERGE_ATTEMPTS - 1:
+                raise
+    if totals:
+        raise RuntimeError(f"Gave up merging {len(totals)} rollup buckets that kept changing concurrently.")
+
+
+@transaction.atomic
+def _merge_totals(totals):
+    """
+    Adds totals to their rollup rows, creating missing ones. Counters are
+    incremented in the database. The histogram is a JSON list and cannot
+    be, so each row is only updated if its count is still the one read
+    here: a merge by another process in between (select_for_update does
+    not lock on SQLite) is never overwritten.
+
+    Returns:
+        dict: The totals whose rows another merge changed first, to merge again.
+    """
+    starts = {key[1] for key in totals}
+    existing = {
+        (row.granularity, row.bucket_start, row.event_type, row.model_name): row
+        for row in AnalyticsRollup.objects.select_for_update().filter(bucket_start__in=starts)
+    }
+    conflicts, to_create = {}, []
+    for key, entry in totals.items():
+        row = existing.get(key)
+        if row is None:
+            granularity, start, event_type, model_name = key
+            to_create.append(AnalyticsRollup(granularity=granularity, bucket_start=start,
+                                             event_type=event_type, model_name=model_name, **entry))
+            continue
+        histogram = row.latency_histogram or _empty_histogram()
+        # Every merge raises count, so an unchanged count means an unchanged row
+        updated = AnalyticsRollup.objects.filter(pk=row.pk, count=row.count).update(
+            count=F('count') + entry['count'],
+            latency_count=F('latency_count') + entry['latency_count'],
+            latency_sum_ms=F('latency_sum_ms') + entry['latency_sum_ms'],
+            latency_histogram=[a + b for a, b in zip(histogram, entry['latency_histogram'])],
+        )
+        if not updated:
+            conflicts[key] = entry
+    if to_create:
+        AnalyticsRollup.objects.bulk_create(to_create)
+    return conflicts
+
+
+def rebuild_rollups(start, end):
+    """
+    Recomputes rollups for [start, end) from raw events, e.g. after a crash
+    lost a flush. Both bounds should fall on hour boundaries.
+    """
+    with transaction.atomic():
+        AnalyticsRollup.objects.filter(bucket_start__gte=start, bucket_start__lt=end).delete()
+        events = AnalyticsEvent.objects.filter(timestamp__gte=start, timestamp__lt=end).only(
+            'event_type', 'event_data', 'timestamp').iterator(chunk_size=2000)
+        _merge(_aggregate(events))
+
+
+def percentile(histogram, q):
+    """
+    Estimates the q-th percentile (0-100) in ms from a latency histogram,
+    interpolating linearly inside the bucket that holds it.
+    """
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = total * q / 100.0
+    seen = 0
+    for i, count in enumerate(histogram):
+        if count and seen + count >= rank:
+            lower = LATENCY_BUCKETS_MS[i - 1] if i > 0 else 0
+            if i >= len(LATENCY_BUCKETS_MS):
+                return float(lower)
+            upper = LATENCY_BUCKETS_MS[i]
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return float(LATENCY_BUCKETS_MS[-1])
+
+
+def query_rollups(start, end, granularity='hour', event_type=None, model_name=None):
+    """
+    Returns one point per bucket in [start, end) with counts and latency
+    percentiles, merged across models unless `model_name` is given.
+    Only the rollup table is read.
+    """
+    rows = AnalyticsRollup.objects.filter(
+        granularity=granularity, bucket_start__gte=start, bucket_start__lt=end)
+    if event_type:
+        rows = rows.filter(event_type=event_type)
+    if model_name is not None:
+        rows = rows.filter(model_name=model_name)
+
+    series = {}
+    for row in rows.order_by('bucket_start'):
+        point = series.get(row.bucket_start)
+        if point is None:
+            point = series[row.bucket_start] = {'count': 0, 'latency_count': 0, 'latency_sum_ms': 0.0,
+                                                'latency_histogram': _empty_histogram()}
+        point['count'] += row.count
+        point['latency_count'] += row.latency_count
+        point['latency_sum_ms'] += row.latency_sum_ms
+        point['latency_histogram'] = [a + b for a, b in zip(point['latency_histogram'], row.latency_histogram)]
+
+    return [
+        {
+            'bucket_start': start_time.isoformat(),
+            'count': point['count'],
+            'latency_avg_ms': (point['latency_sum_ms'] / point['latency_count']) if point['latency_count'] else None,
+            'latency_p50_ms': percentile(point['latency_histogram'], 50),
+            'latency_p95_ms': percentile(point['latency_histogram'], 95),
+            'latency_p99_ms': percentile(point['latency_histogram'], 99),
+        }
+        for start_time, point in series.items()
+    ]
+
+
+def prune_expired(now=None):
+    """
+    Applies the retention policy: raw events older than
+    ANALYTICS_RETENTION['RAW_EVENT_DAYS'] and minute rollups older than
+    ANALYTICS_RETENTION['MINUTE_ROLLUP_DAYS'] are deleted. Hourly rollups are kept.
+
+    Returns:
+        tuple: (raw events deleted, minute rollups deleted)
+    """
+    now = now or timezone.now()
+    retention = getattr(settings, 'ANALYTICS_RETENTION', {})
+    raw_cutoff = now - timedelta(days=retention.get('RAW_EVENT_DAYS', 30))
+    minute_cutoff = now - timedelta(days=retention.get('MINUTE_ROLLUP_DAYS', 7))
+    raw_deleted, _ = AnalyticsEvent.objects.filter(timestamp__lt=raw_cutoff).delete()
+    minute_deleted, _ = AnalyticsRollup.objects.filter(
+        granularity='minute', bucket_start__lt=minute_cutoff).delete()
+    logger.info(f"Pruned {raw_deleted} raw analytics events and {minute_deleted} minute rollups.")
+    return raw_deleted, minute_deleted
@@ -1,3 +1,100 @@
-from django.test import TestCase
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+
+from .buffer import EventBuffer
+from .models import AnalyticsEvent, AnalyticsRollup
+from .rollups import LATENCY_BUCKETS_MS, apply_rollups, percentile, query_rollups, rebuild_rollups
+
+HOUR = datetime(2024, 1, 1, 10, tzinfo=timezone.utc)
+
+
+def histogram(counts):
+    """A latency histogram with the given {bucket index: count}."""
+    return [counts.get(i, 0) for i in range(len(LATENCY_BUCKETS_MS) + 1)]
+
+
+class PercentileTests(SimpleTestCase):
+    def test_interpolates_inside_the_bucket(self):
+        # Ten calls between 5 and 10 ms
+        self.assertEqual(percentile(histogram({1: 10}), 50), 7.5)
+        self.assertEqual(percentile(histogram({0: 5, 2: 5}), 50), 5.0)
+        self.assertEqual(percentile(histogram({0: 5, 2: 5}), 90), 22.0)
+
+    def test_overflow_reports_the_last_bound(self):
+        self.assertEqual(percentile(histogram({len(LATENCY_BUCKETS_MS): 3}), 99), float(LATENCY_BUCKETS_MS[-1]))
+
+    def test_empty_histogram_has_no_percentile(self):
+        self.assertIsNone(percentile(histogram({}), 50))
+
+
+class RollupTests(TestCase):
+    def record(self, minutes, latency_ms=None, model='qwen', event_type='model_inference'):
+        data = {'model': model}
+        if latency_ms is not None:
+            data['latency_ms'] = latency_ms
+        return AnalyticsEvent.objects.create(event_type=event_type, event_data=data,
+                                             timestamp=HOUR + timedelta(minutes=minutes))
+
+    def rollup(self, granularity, start=HOUR, model='qwen'):
+        return AnalyticsRollup.objects.get(granularity=granularity, bucket_start=start,
+                                           event_type='model_inference', model_name=model)
+
+    def test_events_are_counted_per_hour_and_minute(self):
+        apply_rollups([self.record(0, 8), self.record(0, 30), self.record(5)])
+        apply_rollups([self.record(5, 8), self.record(0, 40, model='gpt4')])
+
+        hour = self.rollup('hour')
+        self.assertEqual((hour.count, hour.latency_count, hour.latency_sum_ms), (4, 3, 46.0))
+        self.assertEqual(hour.latency_histogram, histogram({1: 2, 3: 1}))
+        self.assertEqual(self.rollup('minute').count, 2)
+        self.assertEqual(self.rollup('minute', HOUR + timedelta(minutes=5)).count, 2)
+        self.assertEqual(self.rollup('hour', model='gpt4').count, 1)
+
+        point, = query_rollups(HOUR, HOUR + timedelta(hours=1), event_type='model_inference')
+        self.assertEqual((point['count'], point['latency_avg_ms']), (5, 86.0 / 4))
+
+    def test_rebuild_recomputes_from_raw_events(self):
+        events = [self.record(1, 8), self.record(2, 8)]
+        apply_rollups(events)
+        apply_rollups(events[:1])  # A flush applied twice
+        self.record(3, 8)  # A flush that was lost
+
+        rebuild_rollups(HOUR, HOUR + timedelta(hours=1))
+        hour = self.rollup('hour')
+        self.assertEqual((hour.count, hour.latency_histogram), (3, histogram({1: 3})))
+        self.assertEqual(AnalyticsRollup.objects.filter(granularity='minute').count(), 3)
+
+        # Rebuilding again changes nothing
+        rebuild_rollups(HOUR, HOUR + timedelta(hours=1))
+        self.assertEqual(self.rollup('hour').count, 3)
+
+    def test_merge_does_not_overwrite_a_concurrent_merge(self):
+        apply_rollups([self.record(0, 8)])
+        # Rows as another process read them just before this process merged into them
+        stale = list(AnalyticsRollup.objects.all())
+        apply_rollups([self.record(1, 30)])
+
+        reads = iter([stale])
+        select = AnalyticsRollup.objects.select_for_update
+
+        def select_for_update():
+            queryset = select()
+            rows = next(reads, None)
+            return mock.Mock(filter=lambda **kwargs: rows) if rows is not None else queryset
+
+        with mock.patch.object(AnalyticsRollup.objects, 'select_for_update', side_effect=select_for_update):
+            apply_rollups([self.record(2, 8)])
+        hour = self.rollup('hour')
+        self.assertEqual((hour.count, hour.latency_sum_ms), (3, 46.0))
+        self.assertEqual(hour.latency_histogram, histogram({1: 2, 3: 1}))
+
+
+class EventBufferTests(TestCase):
+    def test_rejected_batch_counts_as_dropped(self):
+        buffer = EventBuffer('analytics_app.AnalyticsEvent')
+        buffer._pending.extend([{'event_type': 'chat', 'event_data': {}}, {'event_type': 'chat'}])
+        with mock.patch.object(AnalyticsEvent.objects, 'bulk_create', side_effect=ValueError('bad row')):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual((buffer.dropped, buffer.written), (2, 0))
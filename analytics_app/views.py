@@ -1,6 +1,44 @@
+from datetime import timedelta
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
+from .buffer import record_event
+from .models import AnalyticsEvent, AnalyticsRollup
+from .rollups import query_rollups
+
 class AnalyticsListView(APIView):
     def get(self, request):
-        return Response({"message": "Analytics API is working!"})
+        granularity = request.query_params.get('granularity', 'hour')
+        if granularity not in dict(AnalyticsRollup.GRANULARITIES):
+            return Response({"error": f"Unknown granularity: {granularity}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        end = parse_datetime(request.query_params.get('end', '')) or timezone.now()
+        start = parse_datetime(request.query_params.get('start', '')) or end - timedelta(days=1)
+        if timezone.is_naive(start):
+            start = timezone.make_aware(start)
+        if timezone.is_naive(end):
+            end = timezone.make_aware(end)
+
+        series = query_rollups(
+            start, end, granularity,
+            event_type=request.query_params.get('event_type'),
+            model_name=request.query_params.get('model'),
+        )
+        return Response({
+            "granularity": granularity,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "series": series,
+        })
+
+    def post(self, request):
+        event_type = request.data.get('event_type')
+        if event_type not in dict(AnalyticsEvent.EVENT_TYPES):
+            return Response({"error": f"Unknown event type: {event_type}"}, status=status.HTTP_400_BAD_REQUEST)
+        if not record_event(event_type, request.data.get('event_data', {}), user=request.user):
+            return Response({"error": "Analytics buffer is full."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({"queued": True}, status=status.HTTP_202_ACCEPTED)
@@ -2,19 +2,35 @@ import os
 import uuid
 import json
 import time  # Add this import at the top of the file
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response
 from markupsafe import Markup
-from models.indexer import index_documents
-from models.retriever import retrieve_documents
-from models.responder import generate_response
+from models.model_loader import start_model_watcher
+from models.pipeline import answer_query
+from models.page_store import release_session
+from models.answer_cache import answer_cache
+from models.admission import AdmissionRejected
+from models.library import libraries, attach_libraries, mismatched_libraries
+from models.page_metadata import normalize_filters
+from models.conversation import conversation_context
+from models.snapshots import index_fingerprint, index_model_name, load_index, log_load_report
 from werkzeug.utils import secure_filename
 from logger import get_logger
-from byaldi import RAGMultiModalModel
+from metrics import span, start_request_trace, finish_request_trace, current_request_timings, render_metrics
 import markdown
+import django
+from django.db import DatabaseError
 
 # Set the TOKENIZERS_PARALLELISM environment variable to suppress warnings
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# Configure Django so the chat flow can use the ORM-backed apps
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+from analytics_app.buffer import record_event
+from chat_app.services import record_query_events
+from models_app.models import UploadedFile
+from models_app.processing import save_upload, upload_processor, upload_status, UploadTooLarge
+
 # Initialize the Flask application
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'  # Replace with a secure secret key
@@ -26,6 +42,8 @@ app.config['UPLOAD_FOLDER'] = 'uploaded_documents'
 app.config['STATIC_FOLDER'] = 'static'
 app.config['SESSION_FOLDER'] = 'sessions'
 app.config['INDEX_FOLDER'] = os.path.join(os.getcwd(), '.byaldi')  # Set to .byaldi folder in current directory
+# Requests larger than this are refused before the body is read
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_REQUEST_BYTES', 1024 ** 3))
 
 # Create necessary directories if they don't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -33,9 +51,12 @@ os.makedirs(app.config['STATIC_FOLDER'], exist_ok=True)
 os.makedirs(app.config['SESSION_FOLDER'], exist_ok=True)
 
 # Initialize global variables
-RAG_models = {}  # Dictionary to store RAG models per session
+RAG_models = upload_processor.indexes  # RAG models per session, shared with the upload workers
+RAG_index_versions = {}  # Session ID -> version of the index currently loaded
 app.config['INITIALIZATION_DONE'] = False  # Flag to track initialization
 logger.info("Application started.")
+# Preload configured models and apply ModelConfig changes in the background
+start_model_watcher()
 
 def load_rag_model_for_session(session_id):
     """
@@ -45,8 +66,10 @@ def load_rag_model_for_session(session_id):
 
     if os.path.exists(index_path):
         try:
-            RAG = RAGMultiModalModel.from_index(index_path)
+            with span('index_load'):
+                RAG = load_index(index_path)
             RAG_models[session_id] = RAG
+            RAG_index_versions[session_id] = f"{session_id}:{index_fingerprint(index_path)}"
             logger.info(f"RAG model for session {session_id} loaded from index.")
         except Exception as e:
             logger.error(f"Error loading RAG model for session {session_id}: {e}")
@@ -65,6 +88,50 @@ def load_existing_indexes():
     else:
         logger.warning("No .byaldi folder found. No existing indexes to load.")
 
+def index_updated(session_id, RAG):
+    """
+    Called by the upload workers after a file is added to a session's index.
+    """
+    # Answers cached against the previous index no longer apply
+    answer_cache.invalidate_index(RAG_index_versions.get(session_id))
+    # Same version string as the API process computes, so both agree on cache and single-flight keys
+    index_path = os.path.join(app.config['INDEX_FOLDER'], session_id)
+    RAG_index_versions[session_id] = f"{session_id}:{index_fingerprint(index_path)}"
+
+upload_processor.listeners.append(index_updated)
+
+def upload_summary(upload):
+    results = upload.processing_results or {}
+    return {'id': upload.pk, 'name': upload.original_name, 'status': upload_status(upload), 'error': results.get('error')}
+
+def sync_indexed_files(session_id, session_data, session_file):
+    """
+    Adds the session's uploads that finished indexing since the last call to
+    session_data['indexed_files'], saving the session file if any did.
+
+    Returns:
+        list: The session's UploadedFile rows, oldest first.
+    """
+    try:
+        uploads = list(UploadedFile.objects.filter(session_id=session_id).order_by('uploaded_at'))
+    except DatabaseError as e:
+        logger.error(f"Could not read the uploads of session {session_id}: {e}")
+        return []
+    indexed_files = session_data.setdefault('indexed_files', [])
+    indexed = [u for u in uploads
+               if upload_status(u) == 'indexed' and os.path.basename(u.file.name) not in indexed_files]
+    if indexed:
+        indexed_files.extend(os.path.basename(u.file.name) for u in indexed)
+        with open(session_file, 'w') as f:
+            json.dump(session_data, f)
+        record_event('file_upload', {
+            'session_id': session_id,
+            'files': [os.path.basename(u.file.name) for u in indexed],
+            'pages': sum(u.processing_results.get('pages', 0) for u in indexed),
+            'indexer_model': indexed[0].processing_results.get('indexer_model'),
+        })
+    return uploads
+
 @app.before_request
 def initialize_app():
     """
@@ -73,8 +140,36 @@ def initialize_app():
     """
     if not app.config['INITIALIZATION_DONE']:
         load_existing_indexes()
+        try:
+            upload_processor.resume_pending()
+        except DatabaseError as e:
+            # The app still answers questions without the upload tables
+            logger.error(f"Could not resume pending uploads ({e}); run 'python manage.py migrate'.")
         app.config['INITIALIZATION_DONE'] = True
         logger.info("Application initialized and indexes loaded.")
+        # Models preloaded by the watcher thread are reported as they finish
+        log_load_report('Startup')
+
+@app.before_request
+def start_metrics_trace():
+    start_request_trace(request.endpoint or 'unknown')
+
+@app.teardown_request
+def finish_metrics_trace(exc):
+    endpoint = request.endpoint or 'unknown'
+    timings = finish_request_trace(endpoint)
+    if timings and request.method == 'POST' and 'send_query' in request.form:
+        logger.info("Request timings: " + json.dumps({
+            'endpoint': endpoint,
+            'stages': {stage: round(seconds, 4) for stage, seconds in timings.items()}
+        }))
+
+@app.after_request
+def cache_page_images(response):
+    # Page blobs are content-addressed, so their URLs never change meaning
+    if request.endpoint == 'static' and request.view_args.get('filename', '').startswith('pages/'):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 @app.before_request
 def make_session_permanent():
@@ -96,96 +191,118 @@ def chat():
     session_file = os.path.join(app.config['SESSION_FOLDER'], f"{session_id}.json")
 
     # Load session data from file
-    if os.path.exists(session_file):
-        with open(session_file, 'r') as f:
-            session_data = json.load(f)
-            chat_history = session_data.get('chat_history', [])
-            session_name = session_data.get('session_name', 'Untitled Session')
-            indexed_files = session_data.get('indexed_files', [])
-    else:
-        chat_history = []
-        session_name = 'Untitled Session'
-        indexed_files = []
+    with span('session_load'):
+        if os.path.exists(session_file):
+            with open(session_file, 'r') as f:
+                session_data = json.load(f)
+                chat_history = session_data.get('chat_history', [])
+                session_name = session_data.get('session_name', 'Untitled Session')
+                indexed_files = session_data.get('indexed_files', [])
+                attached_libraries = session_data.get('libraries', [])
+                history_summary = session_data.get('history_summary')
+        else:
+            chat_history = []
+            session_name = 'Untitled Session'
+            indexed_files = []
+            attached_libraries = []
+            history_summary = None
 
     if request.method == 'POST':
         if 'upload' in request.form:
-            # Handle file upload and indexing
+            # Stream uploads to disk and index them on the upload workers
             files = request.files.getlist('file')
-            session_folder = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
-            os.makedirs(session_folder, exist_ok=True)
-            uploaded_files = []
+            indexer_model = session.get('indexer_model', 'vidore/colpali')
+            queued = []
+            duplicates = []
+            rejected = []
             for file in files:
                 if file and file.filename:
                     filename = secure_filename(file.filename)
-                    file_path = os.path.join(session_folder, filename)
-                    file.save(file_path)
-                    uploaded_files.append(filename)
-                    logger.info(f"File saved: {file_path}")
+                    try:
+                        upload, created = save_upload(file.stream, filename, session_id, indexer_model)
+                    except UploadTooLarge as e:
+                        rejected.append(str(e))
+                        continue
+                    if created:
+                        upload_processor.submit(upload.pk)
+                        queued.append(upload)
+                    elif upload_status(upload) == 'indexed':
+                        duplicates.append(filename)
+                    else:
+                        # The same file from an earlier request has not been indexed yet; it is polled like a new one
+                        queued.append(upload)
             
-            if uploaded_files:
+            if queued or duplicates:
                 try:
-                    index_name = session_id
-                    index_path = os.path.join(app.config['INDEX_FOLDER'], index_name)
-                    indexer_model = session.get('indexer_model', 'vidore/colpali')
-                    RAG = index_documents(session_folder, index_name=index_name, index_path=index_path, indexer_model=indexer_model)
-                    if RAG is None:
-                        raise ValueError("Indexing failed: RAG model is None")
-                    RAG_models[session_id] = RAG
-                    session['index_name'] = index_name
-                    session['session_folder'] = session_folder
-                    indexed_files.extend(uploaded_files)
+                    session['index_name'] = session_id
+                    session['session_folder'] = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
                     session_data = {
                         'session_name': session_name,
                         'chat_history': chat_history,
-                        'indexed_files': indexed_files
+                        'indexed_files': indexed_files,
+                        'libraries': attached_libraries,
+                        'history_summary': history_summary
                     }
                     with open(session_file, 'w') as f:
                         json.dump(session_data, f)
-                    logger.info("Documents indexed successfully.")
+                    # Indexing runs on the upload workers; the page polls /upload_status for the outcome
+                    message = f"Queued {len(queued)} files for indexing." if queued else "No new files to index."
+                    if duplicates:
+                        message += f" Already indexed, skipped: {', '.join(duplicates)}."
+                    if rejected:
+                        message += ' ' + ' '.join(rejected)
+                    logger.info(f"Queued {len(queued)} uploads of session {session_id} for indexing.")
                     return jsonify({
                         "success": True, 
-                        "message": "Files indexed successfully.",
+                        "message": message,
+                        "uploads": [upload_summary(u) for u in queued],
                         "indexed_files": indexed_files
                     })
                 except Exception as e:
-                    logger.error(f"Error indexing documents: {str(e)}")
+                    logger.error(f"Error queueing documents: {str(e)}")
                     return jsonify({"success": False, "message": f"Error indexing files: {str(e)}"})
+            elif rejected:
+                return jsonify({"success": False, "message": ' '.join(rejected)})
             else:
                 return jsonify({"success": False, "message": "No files were uploaded."})
 
         elif 'send_query' in request.form:
             query = request.form['query']
+            query_started = time.perf_counter()
             
             try:
                 generation_model = session.get('generation_model', 'qwen')
                 resized_height = session.get('resized_height', 280)
                 resized_width = session.get('resized_width', 280)
+                try:
+                    # Optional restriction of the search to some files, pages or document types
+                    filters = normalize_filters({
+                        'file_names': request.form.getlist('filter_files'),
+                        'page_ranges': request.form.get('filter_pages', ''),
+                        'doc_types': request.form.getlist('filter_doc_types'),
+                    })
+                except ValueError as e:
+                    return jsonify({"success": False, "message": f"Invalid filter: {e}"})
                 
-                # Retrieve relevant documents
-                rag_model = RAG_models.get(session_id)
+                # Retrieve relevant documents from the session's index and its attached libraries
+                rag_model, index_version = attach_libraries(RAG_models.get(session_id),
+                                                            RAG_index_versions.get(session_id), attached_libraries)
                 if rag_model is None:
                     logger.error(f"RAG model not found for session {session_id}")
                     return jsonify({"success": False, "message": "RAG model not found for this session."})
                 
-                retrieved_images = retrieve_documents(rag_model, query, session_id)
-                logger.info(f"Retrieved images: {retrieved_images}")
+                # Earlier turns within a token budget; older ones only through the stored rolling summary
+                history, history_summary = conversation_context(chat_history, history_summary)
                 
-                # Generate response with full image paths
-                full_image_paths = [os.path.join(app.static_folder, img) for img in retrieved_images]
-                response_text, used_images = generate_response(
-                    full_image_paths, 
-                    query, 
-                    session_id, 
-                    resized_height, 
-                    resized_width, 
-                    generation_model
-                )
+                result = answer_query(rag_model, index_version, query, session_id,
+                                      generation_model, resized_height, resized_width, filters=filters,
+                                      history=history)
+                response_text = result['response_text']
+                relative_images = result['images']
                 
                 # Parse markdown in the response
-                parsed_response = Markup(markdown.markdown(response_text))
-
-                # Get relative paths for used images
-                relative_images = [os.path.relpath(img, app.static_folder) for img in used_images]
+                with span('markdown_render'):
+                    parsed_response = Markup(markdown.markdown(response_text))
 
                 # Update chat history
                 chat_history.append({"role": "user", "content": query})
@@ -202,11 +319,16 @@ def chat():
                 session_data = {
                     'session_name': session_name,
                     'chat_history': chat_history,
-                    'indexed_files': indexed_files
+                    'indexed_files': indexed_files,
+                    'libraries': attached_libraries,
+                    'history_summary': history_summary
                 }
-                with open(session_file, 'w') as f:
+                with span('session_write'), open(session_file, 'w') as f:
                     json.dump(session_data, f)
                 
+                record_query_events(result, query, session_id, generation_model,
+                                    current_request_timings(), time.perf_counter() - query_started)
+                
                 # Render the new messages
                 new_messages_html = render_template('chat_messages.html', messages=[
                     {"role": "user", "content": query},
@@ -217,6 +339,11 @@ def chat():
                     "success": True,
                     "html": new_messages_html
                 })
+            except AdmissionRejected as e:
+                response = jsonify({"success": False, "message": str(e)})
+                response.status_code = 429
+                response.headers['Retry-After'] = str(max(1, round(e.retry_after)))
+                return response
             except Exception as e:
                 logger.error(f"Error generating response: {e}", exc_info=True)
                 return jsonify({
@@ -283,12 +410,17 @@ def delete_session(session_id):
             import shutil
             shutil.rmtree(session_folder)
         
+        # Drop the session's page references; blobs no other session uses are deleted
+        release_session(session_id)
+
+        # Per-session image folders written before the shared page store
         session_images_folder = os.path.join('static', 'images', session_id)
         if os.path.exists(session_images_folder):
             import shutil
             shutil.rmtree(session_images_folder)
         
         RAG_models.pop(session_id, None)
+        answer_cache.invalidate_index(RAG_index_versions.pop(session_id, None))
         
         if session.get('session_id') == session_id:
             session['session_id'] = str(uuid.uuid4())
@@ -343,16 +475,74 @@ def new_session():
     flash("New chat session started.", "success")
     return redirect(url_for('chat'))
 
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/libraries')
+def list_libraries():
+    return jsonify({"success": True, "libraries": libraries.available()})
+
+@app.route('/session_libraries/<session_id>', methods=['GET', 'POST'])
+def session_libraries(session_id):
+    """
+    GET returns the shared libraries attached to a session. POST replaces
+    them with the `library` form values.
+    """
+    session_file = os.path.join(app.config['SESSION_FOLDER'], f"{session_id}.json")
+    if not os.path.exists(session_file):
+        return jsonify({"success": False, "message": "Session not found."})
+    with open(session_file, 'r') as f:
+        session_data = json.load(f)
+
+    if request.method == 'POST':
+        requested = request.form.getlist('library')
+        available = libraries.available()
+        unknown = [name for name in requested if name not in available]
+        if unknown:
+            return jsonify({"success": False, "message": f"Unknown libraries: {', '.join(unknown)}."})
+        # Every index is searched with one query encoding, so all must share the session's indexer model
+        model_name = (index_model_name(os.path.join(app.config['INDEX_FOLDER'], session_id))
+                      or session.get('indexer_model', 'vidore/colpali'))
+        mismatched = mismatched_libraries(requested, model_name)
+        if mismatched:
+            return jsonify({"success": False, "message": f"Libraries built with a different indexer model than "
+                                                         f"this session ({model_name}): {', '.join(mismatched)}."})
+        session_data['libraries'] = list(dict.fromkeys(requested))
+        with open(session_file, 'w') as f:
+            json.dump(session_data, f)
+        logger.info(f"Session {session_id} libraries set to {session_data['libraries']}")
+    return jsonify({"success": True, "libraries": session_data.get('libraries', [])})
+
 @app.route('/get_indexed_files/<session_id>')
 def get_indexed_files(session_id):
     session_file = os.path.join(app.config['SESSION_FOLDER'], f"{session_id}.json")
     if os.path.exists(session_file):
         with open(session_file, 'r') as f:
             session_data = json.load(f)
-            indexed_files = session_data.get('indexed_files', [])
-        return jsonify({"success": True, "indexed_files": indexed_files})
+        sync_indexed_files(session_id, session_data, session_file)
+        return jsonify({"success": True, "indexed_files": session_data['indexed_files']})
     else:
         return jsonify({"success": False, "message": "Session not found."})
 
+@app.route('/upload_status/<session_id>')
+def get_upload_status(session_id):
+    """
+    Processing state of the session's uploads, or of those whose IDs are
+    given as `id` query values. Uploads are 'queued' until a worker has
+    indexed them ('indexed') or given up ('failed', with an 'error').
+    """
+    session_file = os.path.join(app.config['SESSION_FOLDER'], f"{session_id}.json")
+    if not os.path.exists(session_file):
+        return jsonify({"success": False, "message": "Session not found."})
+    with open(session_file, 'r') as f:
+        session_data = json.load(f)
+    uploads = sync_indexed_files(session_id, session_data, session_file)
+    ids = request.args.getlist('id', type=int)
+    if ids:
+        uploads = [u for u in uploads if u.pk in ids]
+    return jsonify({"success": True, "uploads": [upload_summary(u) for u in uploads],
+                    "indexed_files": session_data['indexed_files']})
+
 if __name__ == '__main__':
     app.run(port=5050, debug=True)
\ No newline at end of file
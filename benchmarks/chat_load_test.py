@@ -0,0 +1,325 @@
+# benchmarks/chat_load_test.py
+
+"""
+Load tests the /chat send_query flow with concurrent browser-like sessions.
+
+Each virtual session starts a new chat, picks the stand-in indexer and the
+generation model in /settings, uploads a synthetic PDF corpus and then
+sends queries back to back, fetching the page images each answer links
+to. Concurrency is raised step by step. For every step the run reports:
+- throughput, latency percentiles and error rates;
+- queueing delay, both in the app's admission control (from /metrics) and
+  in the fake model server.
+
+    python -m benchmarks.chat_load_test run --concurrency 1 2 4 8 16 --duration 30 --output chat_load.json
+
+By default the fake LLM server and the app are started as subprocesses in a
+scratch directory; use --target to test an already running app instead.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, Request, build_opener, urlopen
+
+from benchmarks.common import REPO_ROOT, STUB_MODEL_NAME, compare_results, latency_summary, write_results
+from benchmarks.corpus import build_corpus, make_queries
+
+IMAGE_SRC = re.compile(r'<img src="([^"]+)"')
+STAGE_METRIC = re.compile(r'^localgpt_stage_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_until_ready(url, timeout, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Process serving {url} exited with code {process.returncode}.")
+        try:
+            with urlopen(url, timeout=2):
+                return
+        except (URLError, OSError):
+            time.sleep(0.5)
+    raise RuntimeError(f"{url} did not become ready within {timeout}s.")
+
+def encode_multipart(fields, files):
+    """Builds a multipart/form-data body from form fields and (name, path) files."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, path in files:
+        with open(path, 'rb') as f:
+            content = f.read()
+        header = (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                  f'filename="{os.path.basename(path)}"\r\nContent-Type: application/pdf\r\n\r\n')
+        parts.append(header.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def scrape_stage_metrics(base_url):
+    """Returns {stage: [sum, count]} from the app's /metrics endpoint."""
+    stages = {}
+    with urlopen(f"{base_url}/metrics", timeout=10) as response:
+        for line in response.read().decode().splitlines():
+            match = STAGE_METRIC.match(line)
+            if match:
+                kind, stage, value = match.groups()
+                stages.setdefault(stage, [0.0, 0.0])[0 if kind == 'sum' else 1] = float(value)
+    return stages
+
+def stage_means(before, after):
+    """Mean seconds per stage, in ms, over the samples recorded between two scrapes."""
+    means = {}
+    for stage, (total, count) in after.items():
+        old_total, old_count = before.get(stage, (0.0, 0.0))
+        if count > old_count:
+            means[stage] = {'mean_ms': round((total - old_total) / (count - old_count) * 1000, 3),
+                            'count': int(count - old_count)}
+    return means
+
+class VirtualSession:
+    """One browser-like chat session with its own cookie jar."""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+
+    def _request(self, path, data=None, content_type=None):
+        request = Request(f"{self.base_url}{path}", data=data)
+        if content_type:
+            request.add_header('Content-Type', content_type)
+        with self.opener.open(request, timeout=self.timeout) as response:
+            return response.status, response.read()
+
+    def setup(self, corpus_files, generation_model, resized_size):
+        self._request('/new_session')
+        self._request('/settings', urlencode({
+            'indexer_model': STUB_MODEL_NAME,
+            'generation_model': generation_model,
+            'resized_height': resized_size,
+            'resized_width': resized_size,
+        }).encode(), 'application/x-www-form-urlencoded')
+        body, content_type = encode_multipart({'upload': 'true'}, [('file', path) for path in corpus_files])
+        _, payload = self._request('/chat', body, content_type)
+        result = json.loads(payload)
+        if not result.get('success'):
+            raise RuntimeError(f"Upload failed: {result.get('message')}")
+
+    def query(self, text, fetch_images):
+        """
+        Sends one query.
+
+        Returns:
+            dict: 'outcome' ('ok', 'app_error', 'rejected', 'http_error' or
+            'connection_error'), 'seconds', 'images' and 'image_seconds'.
+        """
+        started = time.perf_counter()
+        try:
+            _, payload = self._request('/chat', urlencode({'send_query': 'true', 'query': text}).encode(),
+                                       'application/x-www-form-urlencoded')
+        except HTTPError as e:
+            e.read()
+            outcome = 'rejected' if e.code == 429 else 'http_error'
+            return {'outcome': outcome, 'seconds': time.perf_counter() - started}
+        except (URLError, OSError):
+            return {'outcome': 'connection_error', 'seconds': time.perf_counter() - started}
+        seconds = time.perf_counter() - started
+
+        result = json.loads(payload)
+        if not result.get('success'):
+            return {'outcome': 'app_error', 'seconds': seconds}
+        image_seconds = []
+        sources = IMAGE_SRC.findall(result.get('html', '')) if fetch_images else []
+        for source in sources:
+            image_started = time.perf_counter()
+            try:
+                self._request(source)
+                image_seconds.append(time.perf_counter() - image_started)
+            except (URLError, OSError):
+                pass
+        return {'outcome': 'ok', 'seconds': seconds, 'images': len(sources), 'image_seconds': image_seconds}
+
+def run_step(base_url, fake_url, concurrency, args, corpus_files):
+    sessions = [VirtualSession(base_url, args.timeout) for _ in range(concurrency)]
+    setup_threads = [threading.Thread(target=s.setup, args=(corpus_files, args.model, args.resized_size))
+                     for s in sessions]
+    for thread in setup_threads:
+        thread.start()
+    for thread in setup_threads:
+        thread.join()
+
+    if fake_url:
+        urlopen(f"{fake_url}/stats?reset=1", timeout=10).read()
+    metrics_before = scrape_stage_metrics(base_url)
+    samples = []
+    samples_lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def drive(session, seed):
+        rng = random.Random(seed)
+        queries = make_queries(200, seed=seed)
+        while time.monotonic() < deadline:
+            sample = session.query(rng.choice(queries), args.fetch_images)
+            with samples_lock:
+                samples.append(sample)
+            if args.think_time:
+                time.sleep(rng.uniform(0, 2 * args.think_time))
+
+    started = time.monotonic()
+    workers = [threading.Thread(target=drive, args=(s, i)) for i, s in enumerate(sessions)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+
+    ok = [s for s in samples if s['outcome'] == 'ok']
+    outcomes = {}
+    for sample in samples:
+        outcomes[sample['outcome']] = outcomes.get(sample['outcome'], 0) + 1
+    stages = stage_means(metrics_before, scrape_stage_metrics(base_url))
+    entry = {
+        'requests': len(samples),
+        'throughput_rps': round(len(ok) / elapsed, 3),
+        'error_rate': round(1 - len(ok) / len(samples), 4) if samples else None,
+        'outcomes': outcomes,
+        'latency': latency_summary([s['seconds'] for s in ok]),
+        'image_fetch': latency_summary([t for s in ok for t in s.get('image_seconds', [])]),
+        'queueing': {'admission_wait_ms': stages.get('admission_wait', {}).get('mean_ms')},
+        'stages': stages,
+    }
+    if fake_url:
+        with urlopen(f"{fake_url}/stats", timeout=10) as response:
+            backend = json.loads(response.read())
+        entry['backend'] = backend
+        entry['queueing']['backend_wait_ms'] = backend['queue_wait']['mean_ms']
+    return entry
+
+def start_servers(args, workdir):
+    fake_port, app_port = free_port(), free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    base_url = f"http://127.0.0.1:{app_port}"
+    log = open(os.path.join(workdir, 'servers.log'), 'ab')
+    fake = subprocess.Popen([
+        sys.executable, '-m', 'benchmarks.fake_llm_server', '--port', str(fake_port),
+        '--latency', str(args.backend_latency), '--tokens', str(args.backend_tokens),
+        '--token-rate', str(args.backend_token_rate), '--error-rate', str(args.backend_error_rate),
+        '--max-concurrency', str(args.backend_concurrency),
+    ], cwd=REPO_ROOT, stdout=log, stderr=log)
+
+    env = dict(os.environ,
+               OPENAI_BASE_URL=f"{fake_url}/v1",
+               OPENAI_API_KEY=os.environ.get('OPENAI_API_KEY', 'load-test'),
+               OLLAMA_HOST=fake_url)
+    for assignment in args.app_env:
+        key, _, value = assignment.partition('=')
+        env[key] = value
+    app = subprocess.Popen([
+        sys.executable, '-m', 'benchmarks.serve_app', '--workdir', os.path.join(workdir, 'app'),
+        '--port', str(app_port),
+    ], cwd=REPO_ROOT, env=env, stdout=log, stderr=log)
+
+    processes = [fake, app]
+    try:
+        wait_until_ready(f"{fake_url}/health", 30, fake)
+        wait_until_ready(f"{base_url}/metrics", args.startup_timeout, app)
+    except Exception:
+        stop_servers(processes)
+        raise
+    return base_url, fake_url, processes
+
+def stop_servers(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def run(args):
+    output = os.path.abspath(args.output)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='chat-load-test-'))
+    os.makedirs(workdir, exist_ok=True)
+    corpus_files = build_corpus(os.path.join(workdir, 'corpus'), args.pages, args.pages_per_document, 'pdf')
+
+    processes = []
+    if args.target:
+        base_url, fake_url = args.target.rstrip('/'), args.fake_target
+    else:
+        base_url, fake_url, processes = start_servers(args, workdir)
+    try:
+        results = {}
+        for concurrency in args.concurrency:
+            print(f"Running {concurrency} concurrent sessions for {args.duration}s...", flush=True)
+            entry = run_step(base_url, fake_url, concurrency, args, corpus_files)
+            results[f"concurrency={concurrency}"] = entry
+            latency = entry['latency']
+            print(f"  {entry['throughput_rps']} req/s, p50 {latency['p50_ms']} ms, p95 {latency['p95_ms']} ms, "
+                  f"p99 {latency['p99_ms']} ms, errors {entry['error_rate']}, "
+                  f"queueing {entry['queueing']}", flush=True)
+    finally:
+        stop_servers(processes)
+
+    write_results(output, 'chat_load', vars(args), results)
+    print(f"Results written to {output} (working directory {workdir})")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Run the load test.')
+    run_parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    run_parser.add_argument('--duration', type=float, default=30, help='Seconds per concurrency step.')
+    run_parser.add_argument('--think-time', type=float, default=0.0, help='Mean pause between a session\'s queries.')
+    run_parser.add_argument('--model', default='gpt4', choices=('gpt4', 'ollama-llama-vision'),
+                            help='Generation model; both are answered by the fake server.')
+    run_parser.add_argument('--pages', type=int, default=6, help='Pages uploaded per session.')
+    run_parser.add_argument('--pages-per-document', type=int, default=3)
+    run_parser.add_argument('--resized-size', type=int, default=280)
+    run_parser.add_argument('--no-fetch-images', dest='fetch_images', action='store_false')
+    run_parser.add_argument('--timeout', type=float, default=300, help='Per-request timeout in seconds.')
+    run_parser.add_argument('--backend-latency', type=float, default=0.3)
+    run_parser.add_argument('--backend-tokens', type=int, default=200)
+    run_parser.add_argument('--backend-token-rate', type=float, default=50.0)
+    run_parser.add_argument('--backend-error-rate', type=float, default=0.0)
+    run_parser.add_argument('--backend-concurrency', type=int, default=4,
+                            help='Generation slots of the fake server (0 means unlimited).')
+    run_parser.add_argument('--app-env', action='append', default=[], metavar='KEY=VALUE',
+                            help='Extra environment for the app, e.g. ADMISSION_MODEL_SLOTS=8.')
+    run_parser.add_argument('--startup-timeout', type=float, default=120)
+    run_parser.add_argument('--target', help='Base URL of a running app instead of starting one.')
+    run_parser.add_argument('--fake-target', help='Base URL of a running fake LLM server, for its stats.')
+    run_parser.add_argument('--workdir', help='Scratch directory (default: a temp dir).')
+    run_parser.add_argument('--output', default='chat_load_test.json')
+
+    compare_parser = commands.add_parser('compare', help='Compare two result files.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args)
+        return 0
+    return 1 if compare_results(args.baseline, args.candidate, args.threshold) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+# benchmarks/common.py
+
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Model name that benchmarks/stub_encoder.py serves in place of a ColPali checkpoint
+STUB_MODEL_NAME = 'stub/colpali-tiny'
+
+def percentile(samples, q):
+    """Returns the q-th percentile (0-100) of samples using linear interpolation."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * q / 100.0
+    lower = math.floor(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+def latency_summary(seconds):
+    """Summarizes latency samples given in seconds as milliseconds."""
+    ms = [s * 1000 for s in seconds]
+    return {
+        'count': len(ms),
+        'mean_ms': round(sum(ms) / len(ms), 3) if ms else None,
+        'p50_ms': round(percentile(ms, 50), 3) if ms else None,
+        'p95_ms': round(percentile(ms, 95), 3) if ms else None,
+        'p99_ms': round(percentile(ms, 99), 3) if ms else None,
+        'max_ms': round(max(ms), 3) if ms else None,
+    }
+
+def current_rss_mb():
+    """Resident set size of this process in MB (Linux), or None."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2, 1)
+    except (OSError, ValueError):
+        return None
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return round(peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024, 1)
+
+def folder_size_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return round(total / 1024 ** 2, 2)
+
+def environment_info():
+    """Describes the commit and machine a benchmark ran on."""
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=REPO_ROOT, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    info = {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+    try:
+        import torch
+        info['torch'] = torch.__version__
+        info['torch_threads'] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return info
+
+def write_results(path, name, args, results):
+    """Writes a benchmark run as JSON and returns the payload."""
+    payload = {
+        'benchmark': name,
+        'environment': environment_info(),
+        'args': args,
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(payload, f, indent=2)
+    return payload
+
+def flatten_metrics(results, prefix=''):
+    """Flattens nested result dicts into {'a/b/c': number}."""
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}/{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            flat.update(flatten_metrics(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+def higher_is_better(metric):
+    name = metric.rsplit('/', 1)[-1]
+    return name.endswith('_per_sec') or name in ('throughput_rps', 'requests', 'recall', 'speedup',
+                                                  'identical_outputs', 'prefix_match', 'success_rate')
+
+def compare_results(baseline_path, candidate_path, threshold=0.1, out=sys.stdout):
+    """
+    Prints every metric that changed by more than `threshold` (relative)
+    between two result files of the same benchmark.
+
+    Returns:
+        list: The metrics that got worse by more than the threshold.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+    if baseline.get('benchmark') != candidate.get('benchmark'):
+        raise ValueError("Result files come from different benchmarks.")
+
+    old = flatten_metrics(baseline['results'])
+    new = flatten_metrics(candidate['results'])
+    regressions = []
+    out.write(f"{'metric':<60} {'baseline':>12} {'candidate':>12} {'change':>8}\n")
+    for metric in sorted(old.keys() & new.keys()):
+        if metric.endswith('/count') or not old[metric]:
+            continue
+        change = (new[metric] - old[metric]) / abs(old[metric])
+        if abs(change) < threshold:
+            continue
+        worse = change < 0 if higher_is_better(metric) else change > 0
+        if worse:
+            regressions.append(metric)
+        flag = ' REGRESSION' if worse else ''
+        out.write(f"{metric:<60} {old[metric]:>12.3f} {new[metric]:>12.3f} {change:>+8.1%}{flag}\n")
+    out.write(f"{len(regressions)} regressions beyond {threshold:.0%}.\n")
+    return regressions
@@ -0,0 +1,69 @@
+# benchmarks/corpus.py
+
+import os
+import random
+from PIL import Image, ImageDraw
+
+# Letter-sized page at 100 dpi
+PAGE_SIZE = (850, 1100)
+VOCABULARY = (
+    "revenue margin forecast quarter invoice contract clause liability warranty "
+    "turbine pressure valve sensor calibration tolerance voltage circuit diagram "
+    "patient dosage trial protocol adverse endpoint cohort baseline placebo "
+    "shipment supplier inventory warehouse freight customs tariff pallet route "
+    "network latency throughput cache replica shard index query schema migration"
+).split()
+
+def render_page(rng, title, lines=40, words_per_line=10):
+    """Renders one synthetic text page with a heading and a small chart."""
+    page = Image.new('RGB', PAGE_SIZE, 'white')
+    draw = ImageDraw.Draw(page)
+    draw.text((60, 50), title, fill='black')
+    y = 100
+    for _ in range(lines):
+        draw.text((60, y), ' '.join(rng.choice(VOCABULARY) for _ in range(words_per_line)), fill='black')
+        y += 20
+    # Bars give the page non-text structure, like the charts in real reports
+    left = 60
+    for _ in range(8):
+        height = rng.randint(20, 150)
+        draw.rectangle([left, 1050 - height, left + 40, 1050], fill=(rng.randint(0, 200),) * 3)
+        left += 60
+    return page
+
+def build_corpus(folder, total_pages, pages_per_document=10, image_format='pdf', seed=0):
+    """
+    Writes a reproducible synthetic corpus of `total_pages` pages to `folder`.
+
+    Args:
+        image_format (str): 'pdf' writes multi-page PDFs (rendered by byaldi
+            through pdf2image); 'png' writes one image per page.
+
+    Returns:
+        list: The paths of the written files.
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    document = 0
+    remaining = total_pages
+    while remaining > 0:
+        count = min(pages_per_document, remaining)
+        pages = [render_page(rng, f"Document {document} - page {n + 1}") for n in range(count)]
+        if image_format == 'pdf':
+            path = os.path.join(folder, f"doc_{document:05d}.pdf")
+            pages[0].save(path, 'PDF', save_all=True, append_images=pages[1:], resolution=100)
+            paths.append(path)
+        else:
+            for n, page in enumerate(pages):
+                path = os.path.join(folder, f"doc_{document:05d}_{n + 1:03d}.png")
+                page.save(path)
+                paths.append(path)
+        remaining -= count
+        document += 1
+    return paths
+
+def make_queries(count, seed=1, words=6):
+    """Returns `count` reproducible queries drawn from the corpus vocabulary."""
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(VOCABULARY) for _ in range(words)) for _ in range(count)]
@@ -0,0 +1,163 @@
+# benchmarks/failover_benchmark.py
+
+"""
+Benchmarks generation against a flaky remote backend, with and without
+models.failover's hedging and fallback.
+
+Two fake LLM servers (benchmarks/fake_llm_server.py) are started in
+process. The primary plays the 'gpt4' API and has slow outliers. The
+fallback plays a local Ollama model ('ollama-llama-vision'). Each mode sends
+the same requests through three phases:
+- steady: the primary's slow outliers are what hedging should cut;
+- outage: every primary call fails, and its circuit should open;
+- recovery: the primary is healthy again, and the circuit should close
+  after its trial call.
+
+Modes:
+- direct: the primary alone. Its circuit still opens, so calls fail fast
+  during the outage;
+- failover: fallback on errors and open circuits;
+- hedged: failover, plus hedging after the primary's percentile latency.
+
+    python -m benchmarks.failover_benchmark run --output failover.json
+    python -m benchmarks.failover_benchmark compare baseline.json failover.json
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-request INFO logs would dominate the timings
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('LOG_FILE', os.path.join(tempfile.gettempdir(), 'failover_benchmark.log'))
+
+from benchmarks.common import compare_results, latency_summary, write_results
+from benchmarks.corpus import build_corpus
+from benchmarks.fake_llm_server import FakeLLMServer
+
+PRIMARY, FALLBACK = 'gpt4', 'ollama-llama-vision'
+PHASES = ('steady', 'outage', 'recovery')
+MODES = ('direct', 'failover', 'hedged')
+
+def start_server(**settings):
+    server = FakeLLMServer(('127.0.0.1', 0), **settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_phase(failover, images, args, fallback):
+    """Sends args.requests requests; returns (latencies, answers by backend or 'failed')."""
+    def one(n):
+        started = time.perf_counter()
+        _, used, backend = failover.generate([images[n % len(images)]], f"Question {n}", 'failover-benchmark',
+                                             model_choice=PRIMARY, max_tokens=args.tokens, fallback=fallback,
+                                             user_key=f"user-{n % args.concurrency}")
+        seconds = time.perf_counter() - started
+        # Clients pause between questions; without it calls rejected by an open circuit
+        # would use up the phase before the circuit's trial call returns
+        time.sleep(args.think_time)
+        return seconds, backend if used else None
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        outcomes = list(pool.map(one, range(args.requests)))
+    answered = {}
+    for _, backend in outcomes:
+        answered[backend or 'failed'] = answered.get(backend or 'failed', 0) + 1
+    return [seconds for seconds, _ in outcomes], answered
+
+def run_mode(mode, primary, images, args):
+    from models.admission import AdmissionController
+    from models.failover import Failover, HEDGED
+
+    # Fallback calls queue for the fallback model's slots like any other generation
+    failover = Failover(hedge_enabled=mode == 'hedged', hedge_percentile=args.hedge_percentile,
+                        hedge_min_samples=args.hedge_min_samples, failure_threshold=args.failure_threshold,
+                        reset_seconds=args.reset_seconds,
+                        admission_controller=AdmissionController(model_slots=args.fallback_slots))
+    fallback = None if mode == 'direct' else FALLBACK
+    results = {}
+    for phase in PHASES:
+        primary.configure(error_rate=1.0 if phase == 'outage' else args.error_rate)
+        if phase == 'recovery':
+            # Long enough for an open circuit to let its trial call through
+            time.sleep(args.reset_seconds)
+        hedged_before = sum(HEDGED.value(model=PRIMARY, winner=w) for w in ('primary', 'fallback'))
+        seconds, answered = run_phase(failover, images, args, fallback)
+        hedged = sum(HEDGED.value(model=PRIMARY, winner=w) for w in ('primary', 'fallback')) - hedged_before
+        results[phase] = {
+            'latency': latency_summary(seconds),
+            'success_rate': round(1 - answered.get('failed', 0) / len(seconds), 4),
+            'fallback_share': round(answered.get(FALLBACK, 0) / len(seconds), 4),
+            'hedged_share': round(hedged / len(seconds), 4),
+            'circuit': failover.health(PRIMARY).state,
+        }
+        print(f"  {mode}/{phase}: p50 {results[phase]['latency']['p50_ms']:.0f} ms, "
+              f"p99 {results[phase]['latency']['p99_ms']:.0f} ms, "
+              f"success {results[phase]['success_rate']:.0%}, fallback {results[phase]['fallback_share']:.0%}, "
+              f"circuit {results[phase]['circuit']}", flush=True)
+    return results
+
+def run(args):
+    output = os.path.abspath(args.output)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='failover-benchmark-'))
+    os.makedirs(workdir, exist_ok=True)
+
+    primary = start_server(latency=args.latency, tokens=args.tokens, token_rate=0, jitter=0.2,
+                           error_rate=args.error_rate, slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    fallback = start_server(latency=args.fallback_latency, tokens=args.tokens, token_rate=0, jitter=0.2)
+    # The OpenAI and Ollama clients read these when they are created or imported
+    os.environ['OPENAI_BASE_URL'] = f"http://127.0.0.1:{primary.server_port}/v1"
+    os.environ.setdefault('OPENAI_API_KEY', 'fake')
+    os.environ['OLLAMA_HOST'] = f"http://127.0.0.1:{fallback.server_port}"
+
+    images = build_corpus(os.path.join(workdir, 'pages'), 8, pages_per_document=1, image_format='png')
+    results = {}
+    for mode in args.modes:
+        print(f"Mode {mode}:", flush=True)
+        results[mode] = run_mode(mode, primary, images, args)
+    primary.shutdown()
+    fallback.shutdown()
+
+    write_results(output, 'failover', vars(args), results)
+    print(f"Results written to {output} (working directory {workdir})")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Run the benchmark.')
+    run_parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    run_parser.add_argument('--requests', type=int, default=200, help='Requests per phase.')
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--think-time', type=float, default=0.05, help='Seconds each client waits between requests.')
+    run_parser.add_argument('--tokens', type=int, default=50)
+    run_parser.add_argument('--latency', type=float, default=0.2, help="Primary's usual seconds per answer.")
+    run_parser.add_argument('--slow-rate', type=float, default=0.02, help='Share of slow primary answers.')
+    run_parser.add_argument('--slow-latency', type=float, default=2.0, help='Extra seconds of a slow answer.')
+    run_parser.add_argument('--error-rate', type=float, default=0.01, help="Primary's error rate outside the outage.")
+    run_parser.add_argument('--fallback-latency', type=float, default=0.4)
+    run_parser.add_argument('--fallback-slots', type=int, default=4, help='Fallback generations at once.')
+    run_parser.add_argument('--hedge-percentile', type=float, default=95)
+    run_parser.add_argument('--hedge-min-samples', type=int, default=20)
+    run_parser.add_argument('--failure-threshold', type=int, default=5)
+    run_parser.add_argument('--reset-seconds', type=float, default=2.0)
+    run_parser.add_argument('--workdir', help='Where the page images are written (default: a temp dir).')
+    run_parser.add_argument('--output', default='failover_benchmark.json')
+
+    compare_parser = commands.add_parser('compare', help='Compare two result files.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Relative change to report.')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args)
+        return 0
+    # A non-zero exit lets CI fail on regressions
+    return 1 if compare_results(args.baseline, args.candidate, args.threshold) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+# benchmarks/fake_llm_server.py
+
+"""
+A local stand-in for the OpenAI and Ollama chat APIs that answers after a
+configurable delay, so the chat flow can be load tested without real models.
+
+    python -m benchmarks.fake_llm_server --port 11500 --latency 0.3 --tokens 200 --token-rate 50
+
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:11500/v1 (the
+'gpt4' model) or OLLAMA_HOST=http://127.0.0.1:11500 ('ollama-llama-vision').
+GET /stats returns queueing and latency statistics; /stats?reset=1 also
+clears them.
+
+Slow outliers (--slow-rate, --slow-latency) and failures (--error-rate)
+can be injected. POST /control with a JSON object such as
+{"error_rate": 1.0} changes these settings on a running server, e.g. to
+simulate an outage and its recovery.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.common import latency_summary
+
+class FakeLLMStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.errors = 0
+            self.images = 0
+            self.queue_wait = []
+            self.service_time = []
+
+    def record(self, queue_wait, service_time, images, error):
+        with self._lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.images += images
+            self.queue_wait.append(queue_wait)
+            self.service_time.append(service_time)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'images': self.images,
+                'queue_wait': latency_summary(self.queue_wait),
+                'service_time': latency_summary(self.service_time),
+            }
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Settings that POST /control may change
+    CONTROLS = ('latency', 'tokens', 'token_rate', 'jitter', 'error_rate', 'slow_rate', 'slow_latency')
+
+    def __init__(self, address, latency=0.3, tokens=200, token_rate=50.0, jitter=0.1,
+                 error_rate=0.0, max_concurrency=0, seed=0, slow_rate=0.0, slow_latency=5.0):
+        super().__init__(address, FakeLLMHandler)
+        self.latency = latency
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        # Simulates a backend with a fixed number of generation slots
+        self.slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.stats = FakeLLMStats()
+
+    def generation_plan(self, max_tokens):
+        """Returns (tokens to emit, seconds to take, whether to fail)."""
+        tokens = min(self.tokens, max_tokens) if max_tokens else self.tokens
+        with self.random_lock:
+            factor = 1 + self.random.uniform(-self.jitter, self.jitter)
+            fail = self.random.random() < self.error_rate
+            slow = self.random.random() < self.slow_rate
+        seconds = (self.latency + (tokens / self.token_rate if self.token_rate > 0 else 0)) * factor
+        if slow:
+            seconds += self.slow_latency
+        return tokens, max(0.0, seconds), fail
+
+    def configure(self, **settings):
+        """Changes injected latency or errors; returns the current settings."""
+        with self.random_lock:
+            for name, value in settings.items():
+                if name not in self.CONTROLS:
+                    raise ValueError(f"Unknown setting '{name}'.")
+                setattr(self, name, int(value) if name == 'tokens' else float(value))
+            return {name: getattr(self, name) for name in self.CONTROLS}
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            snapshot = self.server.stats.snapshot()
+            if parse_qs(url.query).get('reset'):
+                self.server.stats.reset()
+            self._send_json(200, snapshot)
+        elif url.path in ('/', '/health', '/api/version'):
+            self._send_json(200, {'status': 'ok', 'version': 'fake'})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        path = urlparse(self.path).path
+        if path == '/control':
+            try:
+                self._send_json(200, self.server.configure(**request))
+            except (TypeError, ValueError) as e:
+                self._send_json(400, {'error': str(e)})
+            return
+        if path.endswith('/chat/completions'):
+            max_tokens = request.get('max_tokens')
+            images = sum(1 for message in request.get('messages', []) if isinstance(message.get('content'), list)
+                         for part in message['content'] if part.get('type') == 'image_url')
+        elif path == '/api/chat':
+            max_tokens = (request.get('options') or {}).get('num_predict')
+            images = sum(len(message.get('images') or []) for message in request.get('messages', []))
+        else:
+            self._send_json(404, {'error': 'not found'})
+            return
+
+        tokens, seconds, fail = self.server.generation_plan(max_tokens)
+        queued = time.perf_counter()
+        if self.server.slots:
+            self.server.slots.acquire()
+        started = time.perf_counter()
+        try:
+            time.sleep(seconds)
+        finally:
+            if self.server.slots:
+                self.server.slots.release()
+        self.server.stats.record(started - queued, time.perf_counter() - started, images, fail)
+
+        if fail:
+            self._send_json(500, {'error': {'message': 'Injected failure', 'type': 'server_error'}})
+            return
+        text = ' '.join(f"token{i}" for i in range(tokens))
+        model = request.get('model', 'fake')
+        if path == '/api/chat':
+            self._send_json(200, {
+                'model': model,
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'message': {'role': 'assistant', 'content': text},
+                'done': True,
+                'done_reason': 'stop',
+                'total_duration': int(seconds * 1e9),
+                'eval_count': tokens,
+                'eval_duration': int(seconds * 1e9),
+            })
+        else:
+            self._send_json(200, {
+                'id': f"chatcmpl-fake-{time.time_ns()}",
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': tokens, 'total_tokens': tokens},
+            })
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11500)
+    parser.add_argument('--latency', type=float, default=0.3, help='Seconds before the first token.')
+    parser.add_argument('--tokens', type=int, default=200, help='Tokens per answer (capped by max_tokens).')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='Tokens generated per second.')
+    parser.add_argument('--jitter', type=float, default=0.1, help='Relative random variation of the delay.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 500.')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='Fraction of requests that are slow outliers.')
+    parser.add_argument('--slow-latency', type=float, default=5.0, help='Extra seconds taken by a slow outlier.')
+    parser.add_argument('--max-concurrency', type=int, default=0, help='Generation slots (0 means unlimited).')
+    args = parser.parse_args(argv)
+
+    server = FakeLLMServer((args.host, args.port), args.latency, args.tokens, args.token_rate,
+                           args.jitter, args.error_rate, args.max_concurrency,
+                           slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    print(f"Fake LLM server listening on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
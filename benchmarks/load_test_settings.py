@@ -0,0 +1,17 @@
+# benchmarks/load_test_settings.py
+
+# Django settings for load tests: everything the app writes goes to the
+# load test's working directory instead of the repository.
+import os
+
+from config.settings import *  # noqa: F401,F403
+
+LOAD_TEST_WORKDIR = os.environ.get('LOAD_TEST_WORKDIR', os.getcwd())
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(LOAD_TEST_WORKDIR, 'db.sqlite3'),
+    }
+}
+UPLOAD_ROOT = os.path.join(LOAD_TEST_WORKDIR, 'uploaded_documents')
@@ -0,0 +1,143 @@
+# benchmarks/retrieval_benchmark.py
+
+"""
+Benchmarks the retrieval path (index_documents + retrieve_documents) on a
+synthetic corpus and writes the results as JSON.
+
+    python -m benchmarks.retrieval_benchmark run --sizes 50 200 1000 --output retrieval.json
+    python -m benchmarks.retrieval_benchmark compare baseline.json retrieval.json
+
+By default the tiny stand-in encoder from benchmarks/stub_encoder.py is
+used, so the run needs no GPU and no network. Pass --model vidore/colpali to
+measure the real model.
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+
+# Per-query INFO logs would dominate the timings
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('LOG_FILE', os.path.join(tempfile.gettempdir(), 'retrieval_benchmark.log'))
+
+from benchmarks import stub_encoder
+from benchmarks.common import (
+    compare_results, current_rss_mb, folder_size_mb, latency_summary, peak_rss_mb, write_results,
+)
+from benchmarks.corpus import build_corpus, make_queries
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def benchmark_corpus(size, args, queries, workdir):
+    from byaldi import RAGMultiModalModel
+    from models.indexer import index_documents
+    from models.retriever import retrieve_documents
+
+    corpus_folder = os.path.join(workdir, 'corpus', str(size))
+    build_corpus(corpus_folder, size, args.pages_per_document, args.format)
+    index_name = f"bench_{size}"
+    index_path = os.path.join('.byaldi', index_name)
+
+    rss_before = current_rss_mb()
+    RAG, index_seconds = timed(index_documents, corpus_folder, index_name=index_name,
+                               index_path=index_path, indexer_model=args.model)
+    pages = len(RAG.model.indexed_embeddings)
+    entry = {'index': {
+        'pages': pages,
+        'seconds': round(index_seconds, 3),
+        'pages_per_sec': round(pages / index_seconds, 2),
+        'rss_delta_mb': round((current_rss_mb() or 0) - (rss_before or 0), 1),
+        'index_size_mb': folder_size_mb(index_path),
+    }}
+    del RAG
+    gc.collect()
+
+    load_times = []
+    for _ in range(args.load_repeats):
+        RAG = None
+        gc.collect()
+        RAG, seconds = timed(RAGMultiModalModel.from_index, index_path)
+        load_times.append(seconds)
+    entry['load'] = {
+        'seconds_min': round(min(load_times), 3),
+        'seconds_median': round(sorted(load_times)[len(load_times) // 2], 3),
+        'rss_mb': current_rss_mb(),
+    }
+
+    # The first search pays one-off costs (lazy init, allocator growth)
+    RAG.search(queries[0], k=1)
+    entry['search'] = {}
+    entry['retrieve'] = {}
+    for k in args.ks:
+        entry['search'][f"k={k}"] = latency_summary([timed(RAG.search, q, k=k)[1] for q in queries])
+        # retrieve_documents adds base64 decoding and writing pages to the page store
+        entry['retrieve'][f"k={k}"] = latency_summary([
+            timed(retrieve_documents, RAG, q, index_name, k=k, score_gap=0)[1] for q in queries
+        ])
+    entry['memory'] = {'peak_rss_mb': peak_rss_mb()}
+    return entry
+
+def run(args):
+    output = os.path.abspath(args.output)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='retrieval-benchmark-'))
+    os.makedirs(workdir, exist_ok=True)
+    # Indexes, page blobs and session files are all written relative to the working directory
+    os.chdir(workdir)
+    if args.model == stub_encoder.STUB_MODEL_NAME:
+        stub_encoder.install()
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+
+    queries = make_queries(args.queries)
+    results = {}
+    for size in args.sizes:
+        print(f"Benchmarking {size} pages...", flush=True)
+        entry = benchmark_corpus(size, args, queries, workdir)
+        results[f"pages={size}"] = entry
+        index = entry['index']
+        print(f"  indexed {index['pages']} pages at {index['pages_per_sec']} pages/s, "
+              f"load {entry['load']['seconds_median']}s", flush=True)
+        for k, summary in entry['search'].items():
+            print(f"  search {k}: p50 {summary['p50_ms']} ms, p95 {summary['p95_ms']} ms, "
+                  f"p99 {summary['p99_ms']} ms", flush=True)
+
+    write_results(output, 'retrieval', vars(args), results)
+    print(f"Results written to {output} (working directory {workdir})")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Run the benchmark.')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 1000], help='Corpus sizes in pages.')
+    run_parser.add_argument('--ks', type=int, nargs='+', default=[1, 3, 5, 10], help='Values of k to search with.')
+    run_parser.add_argument('--queries', type=int, default=50, help='Queries per (size, k).')
+    run_parser.add_argument('--pages-per-document', type=int, default=10)
+    run_parser.add_argument('--format', choices=('pdf', 'png'), default='pdf')
+    run_parser.add_argument('--model', default=stub_encoder.STUB_MODEL_NAME, help='Indexer model.')
+    run_parser.add_argument('--load-repeats', type=int, default=3)
+    run_parser.add_argument('--threads', type=int, default=0, help='Torch CPU threads (0 keeps the default).')
+    run_parser.add_argument('--workdir', help='Where the corpus and indexes are written (default: a temp dir).')
+    run_parser.add_argument('--output', default='retrieval_benchmark.json')
+
+    compare_parser = commands.add_parser('compare', help='Compare two result files.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Relative change to report.')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args)
+        return 0
+    # A non-zero exit lets CI fail on regressions
+    return 1 if compare_results(args.baseline, args.candidate, args.threshold) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
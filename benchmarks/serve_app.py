@@ -0,0 +1,45 @@
+# benchmarks/serve_app.py
+
+"""
+Runs app.py for load tests: from a scratch working directory, with its own
+SQLite database, and with the stand-in encoder available for indexing.
+
+    python -m benchmarks.serve_app --workdir /tmp/chat-load --port 5051
+"""
+
+import argparse
+import os
+import sys
+
+from benchmarks.common import REPO_ROOT
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workdir', required=True)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5051)
+    args = parser.parse_args(argv)
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    # app.py creates its folders relative to the working directory at import time
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    os.environ['LOAD_TEST_WORKDIR'] = workdir
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'benchmarks.load_test_settings'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('LOG_FILE', os.path.join(workdir, 'app.log'))
+
+    from benchmarks import stub_encoder
+    stub_encoder.install()
+
+    from app import app
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+    # Page blobs are written to the working directory, so serve static files from there
+    app.static_folder = os.path.join(workdir, 'static')
+    app.run(host=args.host, port=args.port, threaded=True, debug=False, use_reloader=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# benchmarks/speculative_benchmark.py
+
+"""
+Benchmarks assisted (speculative) decoding for the local Qwen2-VL backend
+against the plain model.generate path, for tokens/sec and output parity.
+
+The prompts are built by models.responder.qwen_inputs from pages of the
+synthetic corpus. Each prompt is generated twice on the same loaded model:
+once plainly, once with the draft model as assistant_model. The two outputs
+are then compared token by token. With greedy decoding, assisted decoding
+should reproduce the plain output. Differences come only from half-precision
+numerics.
+
+    python -m benchmarks.speculative_benchmark run --assistant-model Qwen/Qwen2-VL-2B-Instruct --output speculative.json
+    python -m benchmarks.speculative_benchmark compare baseline.json speculative.json
+
+This needs the real checkpoints, and in practice a GPU.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Per-query INFO logs would dominate the timings
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('LOG_FILE', os.path.join(tempfile.gettempdir(), 'speculative_benchmark.log'))
+
+from benchmarks.common import compare_results, latency_summary, peak_rss_mb, write_results
+from benchmarks.corpus import build_corpus
+
+QUESTIONS = (
+    "What is the title of this page?",
+    "Summarize the text on this page in two sentences.",
+    "Which words appear most often on this page?",
+    "Describe the chart at the bottom of the page.",
+)
+
+def load_models(args):
+    from transformers import AutoProcessor, Qwen2VLForConditionalGeneration
+    from models.model_config import DEFAULT_MODEL_CONFIGS, merge_config
+    from models.model_loader import load_assistant_model, pretrained_kwargs, resolve_device
+
+    config = merge_config(DEFAULT_MODEL_CONFIGS['qwen'], {
+        'model_id': args.model,
+        'assistant_model_id': args.assistant_model,
+        'dtype': args.dtype,
+        'quantization': args.quantization,
+    })
+    device = resolve_device(config)
+    model = Qwen2VLForConditionalGeneration.from_pretrained(config['model_id'], **pretrained_kwargs(config, device))
+    if not config.get('quantization'):
+        model.to(device)
+    assistant = load_assistant_model(Qwen2VLForConditionalGeneration, config, device)
+    if assistant is None:
+        raise RuntimeError(f"Assistant model '{args.assistant_model}' could not be loaded.")
+    processor = AutoProcessor.from_pretrained(config['model_id'])
+    return model, assistant, processor, device
+
+def make_prompts(args, workdir):
+    paths = build_corpus(os.path.join(workdir, 'pages'), args.prompts * args.pages_per_prompt,
+                         pages_per_document=1, image_format='png')
+    return [(paths[i * args.pages_per_prompt:(i + 1) * args.pages_per_prompt], QUESTIONS[i % len(QUESTIONS)])
+            for i in range(args.prompts)]
+
+def timed_generate(model, inputs, params, device):
+    import torch
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.inference_mode():
+        output = model.generate(**inputs, **params)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    new_tokens = output[0][inputs['input_ids'].shape[1]:].tolist()
+    return new_tokens, time.perf_counter() - start
+
+def matching_prefix(a, b):
+    count = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        count += 1
+    return count
+
+def mode_summary(seconds, tokens):
+    return {
+        'latency': latency_summary(seconds),
+        'tokens': sum(tokens),
+        'tokens_per_sec': round(sum(tokens) / sum(seconds), 2) if sum(seconds) else None,
+    }
+
+def run(args):
+    from models.responder import qwen_inputs
+
+    output = os.path.abspath(args.output)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='speculative-benchmark-'))
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    print(f"Loading {args.model} with assistant {args.assistant_model}...", flush=True)
+    model, assistant, processor, device = load_models(args)
+    prompts = make_prompts(args, workdir)
+    # Greedy decoding, so the assisted output should match the plain one
+    plain = {'max_new_tokens': args.max_new_tokens, 'do_sample': False}
+    assisted = dict(plain, assistant_model=assistant)
+    if args.num_assistant_tokens:
+        assisted['num_assistant_tokens'] = args.num_assistant_tokens
+
+    # The first generation pays one-off costs (kernel selection, allocator growth)
+    warmup, _ = qwen_inputs(processor, *prompts[0], args.resized_height, args.resized_width)
+    for params in (plain, assisted):
+        timed_generate(model, warmup.to(device), params, device)
+
+    samples = {'baseline': ([], []), 'assisted': ([], [])}
+    identical = 0
+    prefix_tokens = total_tokens = 0
+    for n, (images, question) in enumerate(prompts, start=1):
+        inputs, _, _ = qwen_inputs(processor, images, question, args.resized_height, args.resized_width)
+        inputs = inputs.to(device)
+        outputs = {}
+        for mode, params in (('baseline', plain), ('assisted', assisted)):
+            outputs[mode], seconds = timed_generate(model, inputs, params, device)
+            samples[mode][0].append(seconds)
+            samples[mode][1].append(len(outputs[mode]))
+        identical += outputs['baseline'] == outputs['assisted']
+        prefix_tokens += matching_prefix(outputs['baseline'], outputs['assisted'])
+        total_tokens += len(outputs['baseline'])
+        print(f"  prompt {n}/{len(prompts)}: {samples['baseline'][0][-1]:.2f}s plain, "
+              f"{samples['assisted'][0][-1]:.2f}s assisted", flush=True)
+
+    results = {mode: mode_summary(*samples[mode]) for mode in samples}
+    results['speedup'] = round(results['assisted']['tokens_per_sec'] / results['baseline']['tokens_per_sec'], 3)
+    results['parity'] = {
+        'identical_outputs': round(identical / len(prompts), 4),
+        # Share of the plain output's tokens reproduced before the first difference
+        'prefix_match': round(prefix_tokens / total_tokens, 4) if total_tokens else None,
+    }
+    results['memory'] = {'peak_rss_mb': peak_rss_mb()}
+    if device == 'cuda':
+        import torch
+        results['memory']['peak_cuda_mb'] = round(torch.cuda.max_memory_allocated() / 1024 ** 2, 1)
+
+    write_results(output, 'speculative', vars(args), results)
+    print(f"{results['baseline']['tokens_per_sec']} tokens/s plain, {results['assisted']['tokens_per_sec']} "
+          f"tokens/s assisted ({results['speedup']}x); identical outputs "
+          f"{results['parity']['identical_outputs']:.0%}")
+    print(f"Results written to {output} (working directory {workdir})")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Run the benchmark.')
+    run_parser.add_argument('--model', default='Qwen/Qwen2-VL-7B-Instruct')
+    run_parser.add_argument('--assistant-model', default='Qwen/Qwen2-VL-2B-Instruct', help='Draft model.')
+    run_parser.add_argument('--num-assistant-tokens', type=int, default=0,
+                            help='Draft tokens per step (0 keeps the transformers default).')
+    run_parser.add_argument('--dtype', default='float16')
+    run_parser.add_argument('--quantization', choices=('4bit', '8bit'), help='Quantize the main model.')
+    run_parser.add_argument('--prompts', type=int, default=20)
+    run_parser.add_argument('--pages-per-prompt', type=int, default=1)
+    run_parser.add_argument('--max-new-tokens', type=int, default=128)
+    run_parser.add_argument('--resized-height', type=int, default=280)
+    run_parser.add_argument('--resized-width', type=int, default=280)
+    run_parser.add_argument('--workdir', help='Where the page images are written (default: a temp dir).')
+    run_parser.add_argument('--output', default='speculative_benchmark.json')
+
+    compare_parser = commands.add_parser('compare', help='Compare two result files.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Relative change to report.')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args)
+        return 0
+    # A non-zero exit lets CI fail on regressions
+    return 1 if compare_results(args.baseline, args.candidate, args.threshold) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
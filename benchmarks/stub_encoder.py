@@ -0,0 +1,103 @@
+# benchmarks/stub_encoder.py
+
+"""
+A tiny stand-in for the ColPali checkpoint, so retrieval benchmarks run on a
+CPU without downloading weights. It keeps ColPali's shape of work: one
+vector per image patch, one vector per query token, and late-interaction
+(MaxSim) scoring. The vectors are seeded random projections, though, so
+results are only good for measuring speed, not retrieval quality.
+"""
+
+import hashlib
+import numpy as np
+import torch
+from transformers import BatchFeature
+from benchmarks.common import STUB_MODEL_NAME
+
+EMBEDDING_DIM = 128
+PATCH_SIZE = 8
+# 16 x 16 patches per page, a scaled-down version of ColPali's 32 x 32 grid
+PATCH_GRID = 16
+VOCAB_SIZE = 4096
+MAX_QUERY_TOKENS = 32
+
+class StubColPali(torch.nn.Module):
+    """Projects patches and hashed query tokens into a shared embedding space."""
+
+    def __init__(self):
+        super().__init__()
+        generator = torch.Generator().manual_seed(0)
+        self.patch_projection = torch.nn.Parameter(
+            torch.randn(PATCH_SIZE * PATCH_SIZE, EMBEDDING_DIM, generator=generator), requires_grad=False)
+        self.token_embeddings = torch.nn.Parameter(
+            torch.randn(VOCAB_SIZE, EMBEDDING_DIM, generator=generator), requires_grad=False)
+
+    @classmethod
+    def from_pretrained(cls, *args, **kwargs):
+        return cls()
+
+    @property
+    def dtype(self):
+        return torch.float32
+
+    @property
+    def device(self):
+        return self.patch_projection.device
+
+    def forward(self, pixel_values=None, input_ids=None, attention_mask=None, **kwargs):
+        if pixel_values is not None:
+            embeddings = pixel_values @ self.patch_projection
+        else:
+            embeddings = self.token_embeddings[input_ids]
+        embeddings = torch.nn.functional.normalize(embeddings, dim=-1)
+        if attention_mask is not None:
+            embeddings = embeddings * attention_mask.unsqueeze(-1)
+        return embeddings
+
+class StubColPaliProcessor:
+    """Turns pages into patch grids and queries into hashed token IDs."""
+
+    @classmethod
+    def from_pretrained(cls, *args, **kwargs):
+        return cls()
+
+    def process_images(self, images):
+        side = PATCH_GRID * PATCH_SIZE
+        pixels = torch.stack([
+            torch.from_numpy(np.asarray(image.convert('L').resize((side, side)), dtype=np.float32) / 255.0)
+            for image in images
+        ])
+        patches = pixels.unfold(1, PATCH_SIZE, PATCH_SIZE).unfold(2, PATCH_SIZE, PATCH_SIZE)
+        return BatchFeature({'pixel_values': patches.reshape(len(images), -1, PATCH_SIZE * PATCH_SIZE)})
+
+    def process_queries(self, queries, **kwargs):
+        tokenized = [
+            [int(hashlib.md5(word.encode()).hexdigest(), 16) % VOCAB_SIZE for word in query.lower().split()][:MAX_QUERY_TOKENS] or [0]
+            for query in queries
+        ]
+        length = max(len(tokens) for tokens in tokenized)
+        input_ids = torch.zeros(len(queries), length, dtype=torch.long)
+        attention_mask = torch.zeros(len(queries), length, dtype=torch.long)
+        for i, tokens in enumerate(tokenized):
+            input_ids[i, :len(tokens)] = torch.tensor(tokens)
+            attention_mask[i, :len(tokens)] = 1
+        return BatchFeature({'input_ids': input_ids, 'attention_mask': attention_mask})
+
+    def score(self, qs, ps, batch_size=128, **kwargs):
+        """MaxSim scores of every query against every page, as in colpali_engine."""
+        queries = torch.nn.utils.rnn.pad_sequence(qs, batch_first=True)
+        scores = []
+        for start in range(0, len(ps), batch_size):
+            pages = torch.nn.utils.rnn.pad_sequence(ps[start:start + batch_size], batch_first=True)
+            similarities = torch.einsum('qnd,psd->qpns', queries, pages)
+            scores.append(similarities.max(dim=3).values.sum(dim=2))
+        return torch.cat(scores, dim=1)
+
+def install():
+    """
+    Makes byaldi load the stand-in classes for ColPali checkpoints in this
+    process. Indexes built with STUB_MODEL_NAME load back the same way.
+    """
+    import byaldi.colpali as colpali
+    colpali.ColPali = StubColPali
+    colpali.ColPaliProcessor = StubColPaliProcessor
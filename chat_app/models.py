@@ -9,6 +9,10 @@ class ChatSession(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
+    # Names of the shared library indexes searched along with the session's own uploads
+    libraries = models.JSONField(default=list, blank=True)
+    # Rolling summary of older turns, see models/conversation.py
+    history_summary = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return f"{self.title} - {self.user.username}"
@@ -23,10 +27,15 @@ class Message(models.Model):
     session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='messages')
     role = models.CharField(max_length=10, choices=ROLE_CHOICES)
     content = models.TextField()
+    # Page images the answer was based on, relative to the static folder
+    images = models.JSONField(default=list, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['session', 'timestamp']),
+        ]
 
     def __str__(self):
         return f"{self.role}: {self.content[:50]}..."
\ No newline at end of file
@@ -0,0 +1,76 @@
+import os
+
+import markdown
+from rest_framework import serializers
+
+from models.library import libraries, mismatched_libraries
+from models.snapshots import index_model_name
+from models.page_metadata import normalize_filters
+
+from .models import ChatSession, Message
+from .services import INDEX_FOLDER
+
+
+class MessageSerializer(serializers.ModelSerializer):
+    """
+    Serializes a message; the rendered HTML is omitted when the serializer
+    context has compact=True.
+    """
+    html = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Message
+        fields = ['id', 'role', 'content', 'html', 'images', 'timestamp']
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if self.context.get('compact'):
+            fields.pop('html')
+        return fields
+
+    def get_html(self, obj):
+        return markdown.markdown(obj.content) if obj.role == 'assistant' else None
+
+
+class ChatSessionSerializer(serializers.ModelSerializer):
+    message_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = ChatSession
+        fields = ['id', 'title', 'created_at', 'updated_at', 'is_active', 'libraries', 'message_count']
+
+    def validate_libraries(self, value):
+        if not isinstance(value, list) or not all(isinstance(name, str) for name in value):
+            raise serializers.ValidationError("Expected a list of library names.")
+        unknown = sorted(set(value) - set(libraries.available()))
+        if unknown:
+            raise serializers.ValidationError(f"Unknown libraries: {', '.join(unknown)}.")
+        # Every index is searched with one query encoding, so all must share the session's indexer model
+        model_name = index_model_name(os.path.join(INDEX_FOLDER, str(self.instance.pk))) if self.instance else None
+        mismatched = mismatched_libraries(value, model_name)
+        if mismatched:
+            raise serializers.ValidationError(
+                f"Libraries built with a different indexer model than this session: {', '.join(mismatched)}.")
+        return list(dict.fromkeys(value))
+
+
+class ChatSessionDetailSerializer(ChatSessionSerializer):
+    messages = MessageSerializer(many=True, read_only=True)
+
+    class Meta(ChatSessionSerializer.Meta):
+        fields = ChatSessionSerializer.Meta.fields + ['messages']
+
+
+class QuerySerializer(serializers.Serializer):
+    query = serializers.CharField()
+    model = serializers.CharField(required=False, default='qwen')
+    resized_height = serializers.IntegerField(required=False, default=280, min_value=28)
+    resized_width = serializers.IntegerField(required=False, default=280, min_value=28)
+    # file_names, page_ranges, doc_types, uploaded_after, uploaded_before
+    filters = serializers.DictField(required=False, default=dict)
+
+    def validate_filters(self, value):
+        try:
+            return normalize_filters(value)
+        except (TypeError, ValueError) as e:
+            raise serializers.ValidationError(str(e))
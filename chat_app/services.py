@@ -0,0 +1,70 @@
+import os
+import threading
+
+from analytics_app.buffer import record_event
+from logger import get_logger
+from metrics import span
+from models.page_store import page_id_from_path
+from models.snapshots import index_fingerprint, load_index
+from search_app.history import record_search
+
+logger = get_logger(__name__)
+
+INDEX_FOLDER = os.path.join(os.getcwd(), '.byaldi')
+
+_rag_models = {}  # session_id -> (RAG model, index version)
+_rag_lock = threading.Lock()
+
+
+def get_rag_model(session_id):
+    """
+    Returns (RAG model, index version) for a session's byaldi index, loading
+    it on first use. Returns (None, None) if the session has no index.
+    """
+    index_path = os.path.join(INDEX_FOLDER, session_id)
+    if not os.path.isdir(index_path):
+        return None, None
+    # byaldi rewrites files inside the folder, which often leaves the folder's own mtime unchanged
+    version = f"{session_id}:{index_fingerprint(index_path)}"
+    with _rag_lock:
+        cached = _rag_models.get(session_id)
+        if cached is not None and cached[1] == version:
+            return cached
+        with span('index_load'):
+            rag_model = load_index(index_path)
+        _rag_models[session_id] = (rag_model, version)
+        logger.info(f"RAG model for session {session_id} loaded from index.")
+        return rag_model, version
+
+
+def record_query_events(result, query, session_id, generation_model, timings, total_seconds, user=None):
+    """
+    Buffers the SearchQuery row and analytics events for one answered query.
+
+    Args:
+        result (dict): The result of models.pipeline.answer_query.
+        timings (dict): Stage timings of the request, from metrics.current_request_timings.
+        total_seconds (float): End-to-end latency of the query.
+    """
+    retrieved_images = result['retrieved_images']
+    record_search(query, [page_id_from_path(img) for img in retrieved_images], user=user, session_id=session_id)
+    record_event('search', {
+        'session_id': session_id,
+        'num_results': len(retrieved_images),
+        'cache_hit': result['cache_hit'],
+        'latency_ms': round(timings.get('rag_search', 0.0) * 1000, 2),
+    }, user=user)
+    if not result['cache_hit']:
+        record_event('model_inference', {
+            'session_id': session_id,
+            # The fallback backend if it answered instead
+            'model': result['model'],
+            'num_images': len(result['images']),
+            'latency_ms': round(timings.get('generation', 0.0) * 1000, 2),
+        }, user=user)
+    record_event('chat', {
+        'session_id': session_id,
+        'model': generation_model,
+        'cache_hit': result['cache_hit'],
+        'latency_ms': round(total_seconds * 1000, 2),
+    }, user=user)
@@ -1,3 +1,51 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import srsly
+from django.contrib.auth.models import User
 from django.test import TestCase
 
-# Create your tests here.
+from models.library import libraries
+
+from .models import ChatSession
+from .serializers import ChatSessionSerializer
+
+
+def write_index(folder, model_name):
+    os.makedirs(folder, exist_ok=True)
+    srsly.write_gzip_json(os.path.join(folder, 'index_config.json.gz'), {'model_name': model_name})
+
+
+class LibraryValidationTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.library_root = os.path.join(root, 'library')
+        self.index_folder = os.path.join(root, 'indexes')
+        for patcher in (mock.patch.object(libraries, 'root', self.library_root),
+                        mock.patch('chat_app.serializers.INDEX_FOLDER', self.index_folder)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        write_index(os.path.join(self.library_root, 'manuals'), 'vidore/colpali')
+        write_index(os.path.join(self.library_root, 'contracts'), 'vidore/colqwen2-v0.1')
+        self.chat = ChatSession.objects.create(user=User.objects.create_user('owner'), title='Docs')
+
+    def validate(self, names, instance=None):
+        serializer = ChatSessionSerializer(instance, data={'libraries': names}, partial=True)
+        return serializer.is_valid(), serializer.errors
+
+    def test_libraries_matching_the_session_index_are_accepted(self):
+        write_index(os.path.join(self.index_folder, str(self.chat.pk)), 'vidore/colpali')
+        self.assertEqual(self.validate(['manuals'], self.chat), (True, {}))
+
+    def test_library_with_another_model_is_rejected(self):
+        write_index(os.path.join(self.index_folder, str(self.chat.pk)), 'vidore/colpali')
+        valid, errors = self.validate(['contracts'], self.chat)
+        self.assertFalse(valid)
+        self.assertIn('contracts', str(errors['libraries']))
+
+    def test_libraries_without_session_index_must_agree(self):
+        self.assertTrue(self.validate(['contracts'], self.chat)[0])
+        self.assertFalse(self.validate(['manuals', 'contracts'])[0])
@@ -6,4 +6,6 @@ app_name = 'chat'
 urlpatterns = [
     path('', views.ChatListView.as_view(), name='chat-list'),
     path('<uuid:chat_id>/', views.ChatDetailView.as_view(), name='chat-detail'),
-]
\ No newline at end of file
+    path('<uuid:chat_id>/messages/', views.MessageListView.as_view(), name='chat-messages'),
+    path('<uuid:chat_id>/query/', views.ChatQueryView.as_view(), name='chat-query'),
+]
@@ -1,11 +1,146 @@
-from rest_framework import generics
+import time
+
+from django.db.models import Count, Prefetch
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from rest_framework import generics, status
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-class ChatListView(APIView):
-    def get(self, request):
-        return Response({"message": "Chat API is working!"})
+from metrics import current_request_timings, finish_request_trace, start_request_trace
+from models.admission import AdmissionRejected
+from models.conversation import conversation_context
+from models.library import attach_libraries
+from models.pipeline import answer_query
+from users_app.profiles import get_user_limits
+
+from .models import ChatSession, Message
+from .serializers import (
+    ChatSessionDetailSerializer, ChatSessionSerializer, MessageSerializer, QuerySerializer,
+)
+from .services import get_rag_model, record_query_events
+
+
+def is_compact(request):
+    """Compact responses leave out rendered HTML."""
+    return request.query_params.get('compact', '').lower() in ('1', 'true', 'yes')
+
+
+class SessionCursorPagination(CursorPagination):
+    # Cursor positions need a field that never changes; updated_at moves with every query
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class MessageCursorPagination(CursorPagination):
+    ordering = ('timestamp', 'id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+class ChatListView(generics.ListAPIView):
+    """
+    Lists the user's chat sessions. With ?include_messages=1 every session's
+    messages are fetched in one extra query rather than one per session.
+    """
+    pagination_class = SessionCursorPagination
+
+    def include_messages(self):
+        return self.request.query_params.get('include_messages', '').lower() in ('1', 'true', 'yes')
+
+    def get_queryset(self):
+        sessions = ChatSession.objects.filter(user=self.request.user).annotate(message_count=Count('messages'))
+        if self.include_messages():
+            sessions = sessions.prefetch_related(Prefetch('messages', queryset=Message.objects.order_by('timestamp')))
+        return sessions
+
+    def get_serializer_class(self):
+        return ChatSessionDetailSerializer if self.include_messages() else ChatSessionSerializer
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'compact': is_compact(self.request)}
+
+
+class ChatDetailView(generics.RetrieveUpdateAPIView):
+    """
+    Returns a session with its messages. PATCH updates the title or the
+    shared libraries attached to the session.
+    """
+    serializer_class = ChatSessionDetailSerializer
+    lookup_url_kwarg = 'chat_id'
+
+    def get_queryset(self):
+        return (ChatSession.objects.filter(user=self.request.user)
+                .annotate(message_count=Count('messages'))
+                .prefetch_related('messages'))
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'compact': is_compact(self.request)}
+
+
+class MessageListView(generics.ListAPIView):
+    serializer_class = MessageSerializer
+    pagination_class = MessageCursorPagination
+
+    def get_queryset(self):
+        return Message.objects.filter(session_id=self.kwargs['chat_id'], session__user=self.request.user)
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'compact': is_compact(self.request)}
+
+
+class ChatQueryView(APIView):
+    """
+    Runs retrieval and generation against the session's index and stores the
+    question and answer as messages.
+    """
+
+    def post(self, request, chat_id):
+        chat_session = get_object_or_404(ChatSession, pk=chat_id, user=request.user)
+        serializer = QuerySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+
+        session_id = str(chat_session.pk)
+        rag_model, index_version = attach_libraries(*get_rag_model(session_id), chat_session.libraries)
+        if rag_model is None:
+            return Response({"error": "No index found for this session."}, status=status.HTTP_404_NOT_FOUND)
+
+        # Only messages not yet folded into the stored summary are loaded
+        summary = chat_session.history_summary or None
+        folded = (summary or {}).get('turns', 0)
+        recent_messages = list(chat_session.messages.order_by('timestamp', 'id').values('role', 'content')[folded:])
+        history, summary = conversation_context(recent_messages, summary, offset=folded)
+
+        started = time.perf_counter()
+        start_request_trace('api_chat_query')
+        try:
+            result = answer_query(rag_model, index_version, params['query'], session_id,
+                                  params['model'], params['resized_height'], params['resized_width'],
+                                  user_key=request.user.pk, limits=get_user_limits(request.user),
+                                  filters=params['filters'], history=history)
+            timings = current_request_timings()
+        except AdmissionRejected as e:
+            return Response({"error": str(e), "reason": e.reason}, status=status.HTTP_429_TOO_MANY_REQUESTS,
+                            headers={'Retry-After': str(max(1, round(e.retry_after)))})
+        finally:
+            finish_request_trace('api_chat_query')
+
+        messages = Message.objects.bulk_create([
+            Message(session=chat_session, role='user', content=params['query']),
+            Message(session=chat_session, role='assistant', content=result['response_text'], images=result['images']),
+        ])
+        ChatSession.objects.filter(pk=chat_session.pk).update(updated_at=timezone.now(), history_summary=summary)
+        record_query_events(result, params['query'], session_id, params['model'],
+                            timings, time.perf_counter() - started, user=request.user)
 
-class ChatDetailView(APIView):
-    def get(self, request, chat_id):
-        return Response({"chat_id": str(chat_id)})
+        context = {'request': request, 'compact': is_compact(request)}
+        return Response({
+            "cache_hit": result['cache_hit'],
+            "model": result['model'],
+            "messages": MessageSerializer(messages, many=True, context=context).data,
+        }, status=status.HTTP_201_CREATED)
@@ -94,5 +94,30 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Buffered analytics ingestion (analytics_app.buffer)
+ANALYTICS_BUFFER = {
+    'MAX_EVENTS': 10000,     # pending events held in memory
+    'BATCH_SIZE': 500,       # flush as soon as this many are pending
+    'FLUSH_INTERVAL': 2.0,   # seconds between time-based flushes
+    'DROP_POLICY': 'newest', # 'newest' or 'oldest' event is dropped when full
+}
+
+# Retention for raw analytics events and minute rollups (manage.py prune_analytics)
+ANALYTICS_RETENTION = {
+    'RAW_EVENT_DAYS': 30,
+    'MINUTE_ROLLUP_DAYS': 7,
+}
+
+# Upload processing (models_app.processing)
+UPLOAD_ROOT = BASE_DIR / 'uploaded_documents'
+UPLOAD_PROCESSING = {
+    'WORKERS': 2,                      # files processed concurrently
+    'MAX_FILE_BYTES': 200 * 1024 ** 2, # larger uploads are rejected while streaming
+    'CHUNK_BYTES': 1024 ** 2,          # bytes read and hashed per chunk
+}
+
+# Seconds a user's admission limits (users_app.profiles) are cached in memory
+USER_PROFILE_CACHE_TTL = 300
+
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True  # Only for development
\ No newline at end of file
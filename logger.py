@@ -1,27 +1,98 @@
 # logger.py
 
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import threading
 
-def get_logger(name):
+LOG_FILE = os.getenv('LOG_FILE', 'app.log')
+# Default level for every module, overridden per module by LOG_LEVELS,
+# e.g. LOG_LEVELS="models.retriever=INFO,models.responder=WARNING"
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG')
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Keep 1 in N DEBUG records from each call site; 1 keeps everything
+LOG_DEBUG_SAMPLE_RATE = max(1, int(os.getenv('LOG_DEBUG_SAMPLE_RATE', 1)))
+
+_queue_handler = None
+_listener = None
+_setup_lock = threading.Lock()
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that never blocks the caller: records are dropped and
+    counted when the queue is full instead of waiting for the writer thread.
     """
-    Creates a logger with the specified name.
 
-    Args:
-        name (str): The name of the logger.
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
 
-    Returns:
-        Logger: Configured logger instance.
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class DebugSampler(logging.Filter):
+    """
+    Lets through one in every `rate` DEBUG records per call site so that
+    per-image and per-page debug lines cannot flood the queue.
     """
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
 
-    if not logger.handlers:
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self._counts = {}
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG or self.rate == 1:
+            return True
+        key = (record.pathname, record.lineno)
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        return count % self.rate == 0
+
+def _parse_levels(spec):
+    levels = {}
+    for item in spec.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+_module_levels = _parse_levels(LOG_LEVELS)
+
+def _level_for(name):
+    """Returns the configured level for `name`, matching the longest dotted prefix."""
+    parts = name.split('.')
+    for i in range(len(parts), 0, -1):
+        level = _module_levels.get('.'.join(parts[:i]))
+        if level:
+            return level
+    return LOG_LEVEL.upper()
+
+def _setup_queue_handler():
+    """
+    Starts the single background writer thread shared by all loggers.
+    """
+    global _queue_handler, _listener
+
+    with _setup_lock:
+        if _queue_handler is not None:
+            return _queue_handler
+
         # Console handler
         c_handler = logging.StreamHandler()
         c_handler.setLevel(logging.INFO)
 
-        # File handler
-        f_handler = logging.FileHandler('app.log')
+        # File handler with size-based rotation
+        f_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
         f_handler.setLevel(logging.DEBUG)
 
         # Create formatters and add them to handlers
@@ -30,8 +101,33 @@ def get_logger(name):
         c_handler.setFormatter(c_format)
         f_handler.setFormatter(f_format)
 
-        # Add handlers to the logger
-        logger.addHandler(c_handler)
-        logger.addHandler(f_handler)
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _queue_handler = DroppingQueueHandler(log_queue)
+        _queue_handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE_RATE))
+
+        _listener = logging.handlers.QueueListener(
+            log_queue, c_handler, f_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+        return _queue_handler
+
+def get_logger(name):
+    """
+    Creates a logger with the specified name.
+
+    Records are handed to a queue and written to the console and the rotating
+    log file by one background thread, so logging never waits on disk I/O.
+
+    Args:
+        name (str): The name of the logger.
+
+    Returns:
+        Logger: Configured logger instance.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(_level_for(name))
+
+    if not logger.handlers:
+        logger.addHandler(_setup_queue_handler())
 
     return logger
@@ -0,0 +1,173 @@
+# metrics.py
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond cache hits to multi-minute model loads
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+_trace = threading.local()
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in items]
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket (non-cumulative) counts, plus +Inf, then sum
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+STAGE_SECONDS = Histogram('localgpt_stage_seconds', 'Time spent in each request stage.', labels=('stage',))
+CACHE_LOOKUPS = Counter('localgpt_cache_lookups_total', 'Cache lookups by cache and result.', labels=('cache', 'result'))
+REQUEST_SECONDS = Histogram('localgpt_request_seconds', 'End-to-end request latency by endpoint.', labels=('endpoint',))
+IN_FLIGHT = Gauge('localgpt_in_flight_requests', 'Requests currently being processed.', labels=('endpoint',))
+
+@contextmanager
+def span(stage):
+    """
+    Times a request stage and records it in the stage histogram. If a request
+    trace is active on this thread the duration is also added to it.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = getattr(_trace, 'timings', None)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+def start_request_trace(endpoint):
+    """
+    Marks a request as in flight and starts collecting its stage timings
+    on the current thread.
+    """
+    _trace.timings = {}
+    _trace.start = time.perf_counter()
+    IN_FLIGHT.inc(endpoint=endpoint)
+
+def finish_request_trace(endpoint):
+    """
+    Ends the request trace started on this thread.
+
+    Returns:
+        dict: Stage name -> seconds for the request, including a 'total' entry,
+        or None if no trace was active.
+    """
+    timings = getattr(_trace, 'timings', None)
+    if timings is None:
+        return None
+    IN_FLIGHT.dec(endpoint=endpoint)
+    timings['total'] = time.perf_counter() - _trace.start
+    REQUEST_SECONDS.observe(timings['total'], endpoint=endpoint)
+    _trace.timings = None
+    return timings
+
+def current_request_timings():
+    """Returns the stage timings collected so far for this thread's request."""
+    return dict(getattr(_trace, 'timings', None) or {})
+
+def record_cache_lookup(cache, hit):
+    """Counts a hit or miss for the named cache."""
+    CACHE_LOOKUPS.inc(cache=cache, result='hit' if hit else 'miss')
+
+def render_metrics():
+    """
+    Renders every registered metric in the Prometheus text exposition format.
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
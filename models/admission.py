@@ -0,0 +1,253 @@
+# models/admission.py
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from metrics import Counter, Gauge, span
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Generations that may run at once on one model, across all users
+ADMISSION_MODEL_SLOTS = int(os.getenv('ADMISSION_MODEL_SLOTS', 2))
+# Defaults for users without a profile (e.g. Flask sessions)
+ADMISSION_USER_SLOTS = int(os.getenv('ADMISSION_USER_SLOTS', 1))
+ADMISSION_MAX_TOKENS = int(os.getenv('ADMISSION_MAX_TOKENS', 2000))
+ADMISSION_TOKENS_PER_MINUTE = int(os.getenv('ADMISSION_TOKENS_PER_MINUTE', 20000))
+# Requests a single user may have waiting for a slot before new ones are rejected
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', 4))
+# Seconds a queued request waits for a slot before it is rejected
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 60))
+# Seconds between sweeps that forget idle users whose budget has fully refilled
+ADMISSION_EVICT_INTERVAL = float(os.getenv('ADMISSION_EVICT_INTERVAL', 60))
+
+QUEUE_DEPTH = Gauge('localgpt_admission_queue_depth', 'Generation requests waiting for a slot.', labels=('model',))
+ACTIVE_GENERATIONS = Gauge('localgpt_admission_active', 'Generation requests holding a slot.', labels=('model',))
+REJECTIONS = Counter('localgpt_admission_rejections_total', 'Generation requests rejected by admission control.', labels=('reason',))
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a generation request is refused. `retry_after` is a hint in
+    seconds for when the same request could succeed.
+    """
+
+    def __init__(self, reason, message, retry_after=1.0):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+def estimate_tokens(text):
+    """Rough output-token count for charging a generation (~4 characters per token)."""
+    return math.ceil(len(text or '') / 4)
+
+class TokenBucket:
+    """
+    Refills `rate` tokens per second up to `capacity`. A rate of 0 disables
+    the limit.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, amount):
+        """
+        Takes `amount` tokens if available.
+
+        Returns:
+            float: 0 on success, otherwise the seconds until enough tokens accrue.
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._refill(time.monotonic())
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def refund(self, amount):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def is_full(self, now):
+        """Whether the bucket has refilled to capacity, i.e. a fresh bucket would behave the same."""
+        return self.rate <= 0 or self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class _UserState:
+    def __init__(self):
+        self.active = 0
+        self.slots = ADMISSION_USER_SLOTS
+        self.waiting = {}  # model -> deque of tickets
+        self.bucket = None
+
+    def idle(self, now):
+        return not self.active and not any(self.waiting.values()) and (self.bucket is None or self.bucket.is_full(now))
+
+class Ticket:
+    """An admitted (or waiting) generation request."""
+
+    def __init__(self, user_key, model_choice, max_tokens, charged):
+        self.user_key = user_key
+        self.model_choice = model_choice
+        self.max_tokens = max_tokens
+        self.charged = charged
+        self.granted = False
+
+class AdmissionController:
+    """
+    Gates generation per model. Each model has a fixed number of slots; each
+    user may hold at most `user_slots` of them and keep `queue_size` requests
+    waiting. Freed slots go to waiting users in round-robin order, so one
+    user's backlog cannot starve the others. Requests are also charged
+    against a per-user token bucket sized by the user's tokens-per-minute
+    budget, and rejected immediately when the bucket or queue is exhausted.
+    Users with nothing running or queued and a full bucket are forgotten
+    when their last request finishes, or by a sweep every `evict_interval`
+    seconds.
+    """
+
+    def __init__(self, model_slots=ADMISSION_MODEL_SLOTS, queue_size=ADMISSION_QUEUE_SIZE,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT, evict_interval=ADMISSION_EVICT_INTERVAL):
+        self.model_slots = model_slots
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.evict_interval = evict_interval
+        self._users = {}  # user key -> _UserState
+        self._last_eviction = time.monotonic()
+        self._active = {}  # model -> slots in use
+        self._turns = {}  # model -> OrderedDict of user keys with waiting tickets, next turn first
+        self._condition = threading.Condition()
+
+    def _user(self, user_key, tokens_per_minute):
+        state = self._users.get(user_key)
+        if state is None:
+            state = self._users[user_key] = _UserState()
+        if state.bucket is None or state.bucket.capacity != tokens_per_minute:
+            state.bucket = TokenBucket(tokens_per_minute / 60.0, tokens_per_minute)
+        return state
+
+    def _evict_idle(self, user_key=None):
+        """
+        Forgets `user_key` if it is idle, and every idle user once per
+        evict_interval. Caller holds the lock.
+        """
+        now = time.monotonic()
+        if user_key is not None and user_key in self._users and self._users[user_key].idle(now):
+            del self._users[user_key]
+        if now - self._last_eviction < self.evict_interval:
+            return
+        self._last_eviction = now
+        idle = [key for key, state in self._users.items() if state.idle(now)]
+        for key in idle:
+            del self._users[key]
+        for model_choice in [model for model, turns in self._turns.items() if not turns]:
+            del self._turns[model_choice]
+        if idle:
+            logger.debug(f"Evicted {len(idle)} idle admission states.")
+
+    def _reject(self, reason, message, retry_after=1.0):
+        REJECTIONS.inc(reason=reason)
+        logger.warning(f"Admission rejected ({reason}): {message}")
+        raise AdmissionRejected(reason, message, retry_after)
+
+    def _dispatch(self):
+        """Hands free slots to waiting tickets, one user at a time. Caller holds the lock."""
+        for model_choice, turns in self._turns.items():
+            self._dispatch_model(model_choice, turns)
+        self._condition.notify_all()
+
+    def _dispatch_model(self, model_choice, turns):
+        while turns and self._active.get(model_choice, 0) < self.model_slots:
+            for user_key in turns:
+                state = self._users[user_key]
+                if state.active < state.slots:
+                    break
+            else:
+                return
+            ticket = state.waiting[model_choice].popleft()
+            turns.pop(user_key)
+            if state.waiting[model_choice]:
+                # Back of the line for this user's next request
+                turns[user_key] = None
+            state.active += 1
+            self._active[model_choice] = self._active.get(model_choice, 0) + 1
+            ticket.granted = True
+            QUEUE_DEPTH.dec(model=model_choice)
+            ACTIVE_GENERATIONS.inc(model=model_choice)
+
+    @contextmanager
+    def admit(self, user_key, model_choice, max_tokens=ADMISSION_MAX_TOKENS,
+              user_slots=ADMISSION_USER_SLOTS, tokens_per_minute=ADMISSION_TOKENS_PER_MINUTE):
+        """
+        Waits for a generation slot and yields the Ticket holding it.
+
+        Args:
+            user_key: Identifies the user (user ID, or session ID when anonymous).
+            model_choice (str): The generation model; slots are per model.
+            max_tokens (int): Output-token cap for the request, charged up front.
+            user_slots (int): Concurrent generations allowed for this user.
+            tokens_per_minute (int): The user's token budget; 0 disables it.
+
+        Raises:
+            AdmissionRejected: The budget is spent, the queue is full, or no
+            slot freed up within the queue timeout.
+        """
+        with self._condition:
+            self._evict_idle()
+            state = self._user(user_key, tokens_per_minute)
+            state.slots = user_slots
+            charge = min(max_tokens, tokens_per_minute) if tokens_per_minute > 0 else max_tokens
+            wait = state.bucket.try_consume(charge)
+            if wait > 0:
+                self._reject('rate_limited', f"Token budget exhausted for {user_key}", retry_after=wait)
+            if sum(len(queue) for queue in state.waiting.values()) >= self.queue_size:
+                state.bucket.refund(charge)
+                self._reject('queue_full', f"Too many queued requests for {user_key}")
+
+            ticket = Ticket(user_key, model_choice, max_tokens, charge)
+            state.waiting.setdefault(model_choice, deque()).append(ticket)
+            self._turns.setdefault(model_choice, OrderedDict()).setdefault(user_key, None)
+            QUEUE_DEPTH.inc(model=model_choice)
+            self._dispatch()
+
+            with span('admission_wait'):
+                deadline = time.monotonic() + self.queue_timeout
+                while not ticket.granted:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        state.waiting[model_choice].remove(ticket)
+                        if not state.waiting[model_choice]:
+                            self._turns[model_choice].pop(user_key, None)
+                        QUEUE_DEPTH.dec(model=model_choice)
+                        state.bucket.refund(charge)
+                        self._reject('timeout', f"No {model_choice} slot became free for {user_key}")
+                    self._condition.wait(remaining)
+
+        try:
+            yield ticket
+        finally:
+            with self._condition:
+                state.active -= 1
+                self._active[model_choice] -= 1
+                ACTIVE_GENERATIONS.dec(model=model_choice)
+                self._dispatch()
+                self._evict_idle(user_key)
+
+    def settle(self, ticket, used_tokens):
+        """Returns the unused part of a ticket's up-front charge to the user's bucket."""
+        with self._condition:
+            state = self._users.get(ticket.user_key)
+            if state is not None and used_tokens < ticket.charged:
+                state.bucket.refund(ticket.charged - used_tokens)
+            self._evict_idle(ticket.user_key)
+
+admission = AdmissionController()
@@ -0,0 +1,212 @@
+# models/answer_cache.py
+
+import functools
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+import torch
+from models.page_store import page_id_from_path, reference_page
+from metrics import record_cache_lookup
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Minimum cosine similarity between pooled query embeddings for a cached answer to be reused
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', 0.95))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', 3600))
+# 'session' keeps answers private to a session; 'index' shares them across
+# every session querying the same index version
+ANSWER_CACHE_SCOPE = os.getenv('ANSWER_CACHE_SCOPE', 'session')
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', 256))
+
+_WORD_RE = re.compile(r'\w+')
+_CODE_RE = re.compile(r'\w*\d(?:[\w./-]*\w)?')
+# Filler that does not change what is asked. Auxiliaries ("was", "does"), negations,
+# prepositions and question words other than "what" are kept: they do.
+_FILLER_WORDS = frozenset({'a', 'an', 'the', 'please', 'what', 'whats', 'you', 'me', 'tell', 'show', 'give'})
+# Words that flip the answer while barely moving the query embedding
+_NEGATIONS = frozenset({'not', 'no', 'without', 'never', 'except', 'excluding', 'nor'})
+_PAST = frozenset({'was', 'were', 'did', 'had'})
+_FUTURE = frozenset({'will', 'shall'})
+
+def normalize_query(query):
+    """
+    Reduces a query to the words that decide its answer: case, Unicode
+    width forms, punctuation and filler words are dropped; word order and every
+    number and keyword are kept. "What is the total of invoice 1042?" and
+    "What is total of invoice 1042" share a key; "... invoice 1043" and
+    "What was the total ..." do not.
+    """
+    words = _WORD_RE.findall(unicodedata.normalize('NFKC', query).casefold())
+    return ' '.join(word for word in words if word not in _FILLER_WORDS) or ' '.join(words)
+
+def literal_terms(query):
+    """
+    The parts of a query that similar queries must share exactly: numbers and
+    codes, negations and past or future tense. "total of invoice 1042" and
+    "... 1043", or "what was the revenue" and "what is the revenue", embed
+    almost identically but ask different things.
+    """
+    text = unicodedata.normalize('NFKC', query).casefold()
+    words = set(_WORD_RE.findall(text))
+    terms = set(_CODE_RE.findall(text)) | (words & _NEGATIONS)
+    if words & _PAST:
+        terms.add('<past>')
+    if words & _FUTURE:
+        terms.add('<future>')
+    return frozenset(terms)
+
+@functools.lru_cache(maxsize=8)
+def _template_ids(processor):
+    """Token IDs the processor wraps around every query (the prompt prefix, padding and augmentation tokens)."""
+    return processor.process_queries([''])['input_ids'][0].tolist()
+
+def query_token_span(processor, query):
+    """
+    Returns (start, end) of the query's own tokens in its processed input,
+    found by stripping the prefix and suffix it shares with an empty query.
+    """
+    ids = processor.process_queries([query])['input_ids'][0].tolist()
+    template = _template_ids(processor)
+    start = 0
+    while start < min(len(ids), len(template)) and ids[start] == template[start]:
+        start += 1
+    suffix = 0
+    while suffix < min(len(ids), len(template)) - start and ids[-1 - suffix] == template[-1 - suffix]:
+        suffix += 1
+    return start, len(ids) - suffix
+
+def query_vector(RAG, query_embedding):
+    """
+    Mean-pools the query's own token embeddings into one unit-length vector.
+    The prompt prefix and padding/augmentation tokens are the same for every
+    query and are left out, or they would dominate the average.
+
+    Args:
+        RAG (RAGMultiModalModel): The index whose query encoder is used.
+        query_embedding (models.page_metadata.QueryEmbedding): The encoded
+            query, shared with retrieval.
+
+    Returns:
+        torch.Tensor: A 1-D float32 tensor on the CPU.
+    """
+    model = RAG.model
+    embedding = query_embedding.get(model)
+    start, end = query_token_span(model.processor, query_embedding.query)
+    if end <= start or end > len(embedding):
+        # Unknown input layout; pool every token
+        start, end = 0, len(embedding)
+    with torch.no_grad():
+        return torch.nn.functional.normalize(embedding[start:end].float().mean(dim=0), dim=0)
+
+class AnswerCache:
+    """
+    Stores generated answers per scope (index version, optional session,
+    generation model and image size) and returns the one given for the same
+    normalized query text or, failing that, for the most similar earlier
+    query: the cosine similarity of their pooled query embeddings must reach
+    `threshold` and both must share their literal terms (see literal_terms).
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, scope=ANSWER_CACHE_SCOPE,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.scope = scope
+        self.max_entries = max_entries
+        self._entries = {}  # scope key -> OrderedDict of normalized query -> entry dict, oldest first
+        self._lock = threading.Lock()
+
+    def scope_key(self, index_version, session_id, model_choice, resized_height, resized_width, filters=None):
+        owner = session_id if self.scope == 'session' else None
+        # Answers to filtered queries only apply to the same filters
+        filter_key = tuple(sorted(filters.items())) if filters else None
+        return (index_version, owner, model_choice, int(resized_height), int(resized_width), filter_key)
+
+    def lookup(self, key, query, session_id, embed=None):
+        """
+        Returns the live entry for the query as a dict with 'query', 'answer'
+        and 'images' (plus 'similarity' for a near-duplicate), or None. Pages
+        of a hit are re-referenced for `session_id` so the page store keeps
+        them alive.
+
+        Args:
+            embed (callable, optional): Returns the query's vector (see
+                query_vector). Only called when no entry has the same
+                normalized text; without it only those match.
+        """
+        normalized = normalize_query(query)
+        hit = self._find(key, normalized)
+        if hit is None and embed is not None:
+            hit = self._find_similar(key, embed(), literal_terms(query))
+
+        if hit is not None:
+            page_ids = [page_id_from_path(img) for img in hit['images']]
+            if not all(page_id and reference_page(page_id, session_id) for page_id in page_ids):
+                # A page was garbage collected; the entry can no longer be served
+                self.invalidate(key, hit['query'])
+                hit = None
+        record_cache_lookup('answer', hit=hit is not None)
+        return hit
+
+    def _live(self, key, now):
+        """The scope's entries, without expired ones. Caller holds the lock."""
+        entries = self._entries.get(key)
+        if not entries:
+            return {}
+        for normalized in [n for n, entry in entries.items() if now - entry['created_at'] >= self.ttl]:
+            del entries[normalized]
+        return entries
+
+    def _find(self, key, normalized):
+        with self._lock:
+            entry = self._live(key, time.time()).get(normalized)
+            return dict(entry) if entry is not None else None
+
+    def _find_similar(self, key, vector, terms):
+        with self._lock:
+            candidates = [entry for entry in self._live(key, time.time()).values()
+                          if entry['vector'] is not None and entry['terms'] == terms]
+            if not candidates:
+                return None
+            similarities = torch.stack([entry['vector'] for entry in candidates]) @ vector
+            best = int(similarities.argmax())
+            if float(similarities[best]) < self.threshold:
+                return None
+            return dict(candidates[best], similarity=float(similarities[best]))
+
+    def store(self, key, query, answer, images, vector=None):
+        """Stores an answer. Without the query's `vector` it is only found by its normalized text."""
+        with self._lock:
+            entries = self._entries.setdefault(key, OrderedDict())
+            normalized = normalize_query(query)
+            entries.pop(normalized, None)
+            entries[normalized] = {'query': query, 'answer': answer, 'images': list(images), 'vector': vector,
+                                   'terms': literal_terms(query), 'created_at': time.time()}
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def invalidate(self, key, query=None):
+        with self._lock:
+            if query is None:
+                self._entries.pop(key, None)
+            elif key in self._entries:
+                self._entries[key].pop(normalize_query(query), None)
+
+    def invalidate_index(self, index_version):
+        """
+        Drops every entry computed against the given index version, including
+        federated entries whose version tuple contains it.
+        """
+        def uses(version):
+            return version == index_version or (isinstance(version, tuple) and index_version in version)
+
+        with self._lock:
+            for key in [k for k in self._entries if uses(k[0])]:
+                del self._entries[key]
+
+answer_cache = AnswerCache()
@@ -0,0 +1,133 @@
+# models/conversation.py
+
+import html
+import os
+import re
+from models.admission import estimate_tokens
+from metrics import Histogram
+
+# Tokens of earlier conversation sent with each question (0 disables history)
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', 1000))
+# Share of the budget kept for the rolling summary of older turns
+HISTORY_SUMMARY_TOKENS = int(os.getenv('HISTORY_SUMMARY_TOKENS', 300))
+# Most recent messages quoted verbatim, budget permitting
+HISTORY_RECENT_MESSAGES = int(os.getenv('HISTORY_RECENT_MESSAGES', 4))
+
+HISTORY_CONTEXT_TOKENS = Histogram('localgpt_history_context_tokens',
+                                   'Estimated tokens of conversation history sent with a question.',
+                                   buckets=(0, 50, 100, 250, 500, 1000, 2000, 4000))
+
+_TAG_RE = re.compile(r'<[^>]+>')
+_SENTENCE_RE = re.compile(r'(?<=[.!?])\s')
+_SPACE_BEFORE_PUNCTUATION_RE = re.compile(r'\s+([.,;:!?])')
+_WORD_RE = re.compile(r"\w+")
+# Words that point back at earlier turns ("what does it cost", "and the one before that")
+_REFERENCE_WORDS = frozenset({
+    'it', 'its', 'this', 'that', 'these', 'those', 'they', 'them', 'their', 'he', 'him', 'his', 'she', 'her',
+    'above', 'previous', 'earlier', 'before', 'last', 'same', 'former', 'latter', 'again', 'also', 'else',
+    'instead', 'another', 'other', 'more', 'further', 'next', 'one', 'ones',
+})
+_CONTINUATIONS = ('and', 'but', 'so', 'or', 'then', 'what about', 'how about')
+
+def plain_text(content):
+    """Turns a stored message (assistant answers are rendered HTML in session files) into plain text."""
+    text = ' '.join(html.unescape(_TAG_RE.sub(' ', str(content or ''))).split())
+    # Closing inline tags leave a space before punctuation
+    return _SPACE_BEFORE_PUNCTUATION_RE.sub(r'\1', text)
+
+def truncate_tokens(text, tokens):
+    """Cuts text to roughly `tokens` tokens on a word boundary."""
+    limit = tokens * 4
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(' ', 1)[0] + ' ...'
+
+def summary_line(message):
+    """One line of the rolling summary: the question, or the first sentence of the answer."""
+    text = plain_text(message['content'])
+    if message['role'] == 'user':
+        return f"User asked: {truncate_tokens(text, 40)}"
+    return f"Assistant answered: {truncate_tokens(_SENTENCE_RE.split(text, 1)[0], 50)}"
+
+def fold_into_summary(summary_text, messages, max_tokens=HISTORY_SUMMARY_TOKENS):
+    """
+    Adds messages that fell out of the recent window to the rolling summary,
+    dropping its oldest lines once it exceeds `max_tokens`. Only the new
+    messages are read, so the work per turn does not grow with the chat.
+    """
+    lines = [line for line in (summary_text or '').split('\n') if line]
+    lines.extend(summary_line(message) for message in messages)
+    while len(lines) > 1 and estimate_tokens('\n'.join(lines)) > max_tokens:
+        lines.pop(0)
+    return '\n'.join(lines)
+
+def conversation_context(messages, summary=None, offset=0, budget=HISTORY_TOKEN_BUDGET):
+    """
+    Builds the conversation context for the next question: a rolling summary
+    of older turns plus the most recent messages verbatim, within `budget`
+    tokens.
+
+    Args:
+        messages (list): Dicts with 'role' and 'content'; messages[i] is
+            message number offset + i of the chat. Messages before
+            summary['turns'] may be left out.
+        summary (dict, optional): The stored summary state, {'text', 'turns'},
+            where 'turns' is the number of leading messages already folded in.
+        offset (int): Number of the first message in `messages`.
+        budget (int): Token budget for the whole context.
+
+    Returns:
+        tuple: (context text, or '' without history; updated summary state
+        to store with the session).
+    """
+    summary = dict(summary or {'text': '', 'turns': 0})
+    if budget <= 0:
+        return '', summary
+    pending = messages[max(0, summary['turns'] - offset):]
+
+    recent_budget = budget - min(HISTORY_SUMMARY_TOKENS, budget // 2)
+    recent = []
+    used = 0
+    for message in reversed(pending):
+        if len(recent) >= HISTORY_RECENT_MESSAGES:
+            break
+        text = truncate_tokens(plain_text(message['content']), recent_budget // 2)
+        tokens = estimate_tokens(text)
+        if recent and used + tokens > recent_budget:
+            break
+        recent.insert(0, (message['role'], text))
+        used += tokens
+
+    aged = pending[:len(pending) - len(recent)]
+    if aged:
+        summary['text'] = fold_into_summary(summary['text'], aged, min(HISTORY_SUMMARY_TOKENS, budget // 2))
+        summary['turns'] += len(aged)
+
+    parts = []
+    if summary['text']:
+        parts.append(f"Summary of the earlier conversation:\n{summary['text']}")
+    if recent:
+        parts.append("Recent conversation:\n" + '\n'.join(
+            f"{'User' if role == 'user' else 'Assistant'}: {text}" for role, text in recent))
+    context = '\n\n'.join(parts)
+    HISTORY_CONTEXT_TOKENS.observe(estimate_tokens(context))
+    return context, summary
+
+def depends_on_history(query):
+    """
+    Whether a question only makes sense with the conversation before it: it
+    refers back ("what does it cost?"), continues the last one ("and in
+    2023?") or is too short to stand alone. Other questions get the same
+    answer in any conversation.
+    """
+    words = _WORD_RE.findall(query.casefold())
+    if len(words) < 3 or not _REFERENCE_WORDS.isdisjoint(words):
+        return True
+    text = ' '.join(words)
+    return any(text == start or text.startswith(start + ' ') for start in _CONTINUATIONS)
+
+def prompt_with_context(context, query):
+    """Prefixes the question with the conversation context, if there is any."""
+    if not context:
+        return query
+    return f"{context}\n\nAnswer the current question using the pages provided.\nCurrent question: {query}"
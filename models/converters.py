@@ -22,4 +22,21 @@ def convert_docs_to_pdfs(folder_path):
                 logger.info(f"Converted '{filename}' to PDF.")
     except Exception as e:
         logger.error(f"Error converting documents to PDFs: {e}")
-        raise
\ No newline at end of file
+        raise
+
+def convert_to_pdf(file_path):
+    """
+    Converts a .doc or .docx file to a PDF next to it.
+
+    Args:
+        file_path (str): The path to the document.
+
+    Returns:
+        str: The path to index: the PDF for Word documents, otherwise `file_path` unchanged.
+    """
+    if not file_path.lower().endswith(('.doc', '.docx')):
+        return file_path
+    pdf_path = os.path.splitext(file_path)[0] + '.pdf'
+    convert(file_path, pdf_path)
+    logger.info(f"Converted '{os.path.basename(file_path)}' to PDF.")
+    return pdf_path
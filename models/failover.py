@@ -0,0 +1,264 @@
+# models/failover.py
+
+import math
+import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from models.admission import admission, ADMISSION_MAX_TOKENS
+from models.model_config import model_configs
+from models.responder import generate_response, GenerationCancelled
+from logger import get_logger
+from metrics import Counter, Gauge, Histogram
+
+logger = get_logger(__name__)
+
+# Send the request to the fallback backend too when the primary is slower than usual
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Percentile of the primary's recent latencies after which the request is hedged
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 95))
+# Successful calls needed before the percentile is trusted (no hedging before that)
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 20))
+# Recent latencies kept per backend
+LATENCY_WINDOW = int(os.getenv('LATENCY_WINDOW', 200))
+# Consecutive failures that open a backend's circuit
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+# Seconds an open circuit waits before letting one trial request through
+CIRCUIT_RESET_SECONDS = float(os.getenv('CIRCUIT_RESET_SECONDS', 30))
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BACKEND_SECONDS = Histogram('localgpt_backend_seconds', 'Generation latency per backend and outcome.',
+                            labels=('model', 'outcome'))
+CIRCUIT_STATE = Gauge('localgpt_circuit_state', "Backend circuit state: 0 closed, 1 half-open, 2 open.",
+                      labels=('model',))
+HEDGED = Counter('localgpt_hedged_requests_total', 'Requests also sent to the fallback backend, by winner.',
+                 labels=('model', 'winner'))
+FALLBACKS = Counter('localgpt_generation_fallbacks_total', 'Requests answered by the fallback backend.',
+                    labels=('model', 'reason'))
+
+class BackendUnavailable(Exception):
+    """Raised when a backend's circuit is open."""
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty sequence."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def error_text(error):
+    """The message shown in place of an answer when generation failed."""
+    if isinstance(error, BackendUnavailable):
+        return f"{error} Please try again shortly."
+    return f"An error occurred while generating the response: {str(error)}"
+
+class BackendHealth:
+    """
+    Recent latencies and a circuit breaker for one backend. The circuit
+    opens after `failure_threshold` consecutive failures, rejects calls for
+    `reset_seconds`, then lets a single trial call through (half-open) whose
+    outcome closes or re-opens it.
+    """
+
+    def __init__(self, model_choice, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds=CIRCUIT_RESET_SECONDS, window=LATENCY_WINDOW):
+        self.model_choice = model_choice
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.latencies = deque(maxlen=window)
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.info(f"Circuit of backend '{self.model_choice}' is now {state.replace('_', '-')}.")
+        self.state = state
+        CIRCUIT_STATE.set(_STATE_VALUES[state], model=self.model_choice)
+
+    def allow(self):
+        """Whether a call may be sent now. In the half-open state only one call is let through."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self._set_state(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.failures = 0
+            self._trial_running = False
+            self._set_state(CLOSED)
+        BACKEND_SECONDS.observe(seconds, model=self.model_choice, outcome='ok')
+
+    def record_failure(self, seconds):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+        BACKEND_SECONDS.observe(seconds, model=self.model_choice, outcome='error')
+
+    def record_cancelled(self):
+        """A call stopped because another backend answered first says nothing about this one."""
+        with self._lock:
+            self._trial_running = False
+
+    def hedge_delay(self, p=HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES):
+        """Seconds after which a call counts as slow, or None until enough calls were timed."""
+        with self._lock:
+            if len(self.latencies) < max(1, min_samples):
+                return None
+            return percentile(self.latencies, p)
+
+class Failover:
+    """
+    Sends generation requests to the chosen backend, tracking its latency
+    and health, and degrades to the backend named by 'fallback_model' in its
+    configuration:
+    - immediately while the primary's circuit is open;
+    - when the primary fails;
+    - with hedging, also when the primary is slower than its usual
+      HEDGE_PERCENTILE latency. The fallback is then started alongside and
+      the first answer wins.
+    The caller holds the primary's admission slot; a fallback waits for a
+    slot of its own model from `admission_controller`. Once one backend has
+    answered, a local generation still running on the other is stopped.
+    """
+
+    def __init__(self, hedge_enabled=HEDGE_ENABLED, hedge_percentile=HEDGE_PERCENTILE,
+                 hedge_min_samples=HEDGE_MIN_SAMPLES, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds=CIRCUIT_RESET_SECONDS, admission_controller=admission):
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.admission = admission_controller
+        self._backends = {}  # model_choice -> BackendHealth
+        self._lock = threading.Lock()
+
+    def health(self, model_choice):
+        with self._lock:
+            if model_choice not in self._backends:
+                self._backends[model_choice] = BackendHealth(model_choice, self.failure_threshold,
+                                                             self.reset_seconds)
+            return self._backends[model_choice]
+
+    def _call(self, model_choice, args, page_handles, max_tokens, stop_event=None):
+        """Runs one backend, recording the outcome. Raises BackendUnavailable or the backend's error."""
+        health = self.health(model_choice)
+        if not health.allow():
+            raise BackendUnavailable(f"Backend '{model_choice}' is unavailable after repeated failures.")
+        started = time.perf_counter()
+        try:
+            result = generate_response(*args, model_choice, page_handles=page_handles, max_tokens=max_tokens,
+                                       raise_errors=True, stop_event=stop_event)
+        except GenerationCancelled:
+            health.record_cancelled()
+            raise
+        except BaseException:
+            health.record_failure(time.perf_counter() - started)
+            raise
+        health.record_success(time.perf_counter() - started)
+        return result
+
+    def _start(self, model_choice, args, max_tokens, results, stop_event, admit_as=None):
+        def run():
+            # The fallback runs outside the caller's admission slot, so it queues for one of its own model.
+            # Its budget was already charged for the primary.
+            slot = nullcontext() if admit_as is None else self.admission.admit(
+                admit_as, model_choice, max_tokens=max_tokens or ADMISSION_MAX_TOKENS, tokens_per_minute=0)
+            try:
+                with slot:
+                    if stop_event.is_set():
+                        raise GenerationCancelled(f"'{model_choice}' is no longer needed.")
+                    result = self._call(model_choice, args, None, max_tokens, stop_event)
+                results.put((model_choice, result, None))
+            except BaseException as e:
+                results.put((model_choice, None, e))
+        threading.Thread(target=run, name=f'generate-{model_choice}', daemon=True).start()
+
+    def generate(self, images, query, session_id, resized_height=280, resized_width=280, model_choice='qwen',
+                 page_handles=None, max_tokens=None, fallback=None, user_key=None):
+        """
+        Generates a response like models.responder.generate_response, falling
+        back to another backend when the chosen one is down or slow.
+
+        Args:
+            fallback (str, optional): Backend to degrade to; defaults to the
+                chosen backend's 'fallback_model' setting.
+            user_key (optional): The admission user of the request (see
+                models.admission); the fallback is admitted on its behalf.
+
+        Returns:
+            tuple: (response_text, used_images, backend that answered).
+        """
+        args = (images, query, session_id, resized_height, resized_width)
+        fallback = fallback or (model_configs.get(model_choice) or {}).get('fallback_model')
+        if fallback == model_choice:
+            fallback = None
+        if not fallback:
+            try:
+                return (*self._call(model_choice, args, page_handles, max_tokens), model_choice)
+            except Exception as e:
+                return error_text(e), [], model_choice
+
+        # Either call may be abandoned while still running, so neither reads the
+        # shared page buffers the caller releases on return; pages come from disk
+        timeout = None
+        if self.hedge_enabled:
+            timeout = self.health(model_choice).hedge_delay(self.hedge_percentile, self.hedge_min_samples)
+        results = queue.Queue()
+        running = set()
+        reason = None  # Why the fallback was started
+        stop_event = threading.Event()
+
+        def start(backend):
+            # Separate from the user's own key, whose slot the primary call already holds
+            admit_as = f"{user_key or session_id}:fallback" if backend == fallback else None
+            self._start(backend, args, max_tokens, results, stop_event, admit_as)
+            running.add(backend)
+
+        start(model_choice)
+        while True:
+            try:
+                backend, result, error = results.get(timeout=timeout)
+            except queue.Empty:
+                logger.info(f"Backend '{model_choice}' slower than {timeout:.2f}s; hedging with '{fallback}'.")
+                reason, timeout = 'hedge', None
+                start(fallback)
+                continue
+            running.discard(backend)
+            if error is None or not running and reason is not None:
+                break
+            if reason is None:
+                reason = 'circuit_open' if isinstance(error, BackendUnavailable) else 'error'
+                if reason == 'error':
+                    logger.warning(f"Backend '{model_choice}' failed ({error}); falling back to '{fallback}'.")
+                start(fallback)
+            # Otherwise wait for the other call
+            timeout = None
+
+        # A local generation still running is stopped at its next token; a remote one runs on
+        # and its outcome still updates the backend's health
+        stop_event.set()
+        if reason == 'hedge':
+            HEDGED.inc(model=model_choice, winner='fallback' if backend == fallback else 'primary')
+        if error is not None:
+            return error_text(error), [], model_choice
+        if backend == fallback:
+            FALLBACKS.inc(model=model_choice, reason=reason)
+        return (*result, backend)
+
+failover = Failover()
@@ -1,13 +1,22 @@
 # models/indexer.py
 
 import os
-from byaldi import RAGMultiModalModel
 from models.converters import convert_docs_to_pdfs
+from models.lexical import save_page_texts
+from models.snapshots import detach_snapshot, empty_index, load_index
 from logger import get_logger
 
 logger = get_logger(__name__)
 
-def index_documents(folder_path, index_name='document_index', index_path=None, indexer_model='vidore/colpali'):
+def store_page_texts(RAG):
+    """Extracts the text of newly indexed pages for lexical search; failures only cost recall."""
+    try:
+        save_page_texts(RAG)
+    except Exception as e:
+        logger.warning(f"Could not store page text: {e}")
+
+def index_documents(folder_path, index_name='document_index', index_path=None, indexer_model='vidore/colpali',
+                    index_root='.byaldi'):
     """
     Indexes documents in the specified folder using Byaldi.
 
@@ -16,6 +25,7 @@ def index_documents(folder_path, index_name='document_index', index_path=None, i
         index_name (str): The name of the index to create or update.
         index_path (str): The path where the index should be saved.
         indexer_model (str): The name of the indexer model to use.
+        index_root (str): The folder byaldi writes the index into.
 
     Returns:
         RAGMultiModalModel: The RAG model with the indexed documents.
@@ -26,10 +36,8 @@ def index_documents(folder_path, index_name='document_index', index_path=None, i
         convert_docs_to_pdfs(folder_path)
         logger.info("Conversion of non-PDF documents to PDFs completed.")
 
-        # Initialize RAG model
-        RAG = RAGMultiModalModel.from_pretrained(indexer_model)
-        if RAG is None:
-            raise ValueError(f"Failed to initialize RAGMultiModalModel with model {indexer_model}")
+        # Initialize RAG model, sharing the indexer weights already loaded in this process
+        RAG = empty_index(indexer_model, index_root=index_root)
         logger.info(f"RAG model initialized with {indexer_model}.")
 
         # Index the documents in the folder
@@ -41,8 +49,49 @@ def index_documents(folder_path, index_name='document_index', index_path=None, i
         )
 
         logger.info(f"Indexing completed. Index saved at '{index_path}'.")
+        store_page_texts(RAG)
 
         return RAG
     except Exception as e:
         logger.error(f"Error during indexing: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+def index_file(file_path, index_name, RAG=None, index_path=None, indexer_model='vidore/colpali', metadata=None):
+    """
+    Adds one document to a byaldi index, creating the index if needed.
+
+    Args:
+        file_path (str): The PDF or image to index.
+        index_name (str): The name of the index.
+        RAG (RAGMultiModalModel, optional): The index's loaded model, if any.
+        index_path (str, optional): Where the index is stored; it is loaded from
+            here when RAG is not given.
+        indexer_model (str): The indexer model used for a new index.
+        metadata (dict, optional): Stored with the document's pages (see
+            models.page_metadata.upload_metadata).
+
+    Returns:
+        tuple: (RAGMultiModalModel, number of pages added)
+    """
+    if RAG is None and index_path and os.path.isdir(index_path):
+        RAG = load_index(index_path)
+
+    if RAG is None:
+        RAG = empty_index(indexer_model)
+        RAG.index(
+            input_path=file_path,
+            index_name=index_name,
+            store_collection_with_index=True,
+            overwrite=True,
+            metadata=[metadata] if metadata else None
+        )
+        pages_before = 0
+    else:
+        pages_before = len(RAG.model.indexed_embeddings)
+        detach_snapshot(RAG)
+        RAG.add_to_index(file_path, store_collection_with_index=True, metadata=metadata)
+
+    pages = len(RAG.model.indexed_embeddings) - pages_before
+    store_page_texts(RAG)
+    logger.info(f"Indexed '{os.path.basename(file_path)}' into '{index_name}' ({pages} pages).")
+    return RAG, pages
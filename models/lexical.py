@@ -0,0 +1,305 @@
+# models/lexical.py
+
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import threading
+import weakref
+import numpy as np
+from models.page_metadata import (RETRIEVAL_SCORE_GAP, QueryEmbedding, cut_on_score_gap, page_metadata, page_result,
+                                  visual_search)
+from logger import get_logger
+from metrics import Counter, span
+
+logger = get_logger(__name__)
+
+# Fuse BM25 over the pages' PDF text with the visual ranking
+HYBRID_RETRIEVAL = os.getenv('HYBRID_RETRIEVAL', 'true').lower() in ('1', 'true', 'yes')
+# Reciprocal rank fusion constant; larger values flatten the weight of top ranks
+RRF_K = int(os.getenv('RRF_K', 60))
+# Pages taken from each ranking before fusing
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', 20))
+# Skip the visual stage when the best lexical hit scores at least this much...
+LEXICAL_SHORTCUT_MIN_SCORE = float(os.getenv('LEXICAL_SHORTCUT_MIN_SCORE', 5.0))
+# ...and at least this many times the runner-up (0 disables the shortcut)
+LEXICAL_SHORTCUT_MARGIN = float(os.getenv('LEXICAL_SHORTCUT_MARGIN', 3.0))
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+PAGE_TEXT_FILE = 'page_text.json'
+
+LEXICAL_SHORTCUTS = Counter('localgpt_lexical_shortcuts_total', 'Searches answered from BM25 alone.')
+
+# Codes like INV-2023-0042 or 4.2.1 are kept whole as well as split into words
+_CODE_RE = re.compile(r'\w+(?:[-./]\w+)+')
+_WORD_RE = re.compile(r'\w+')
+
+def tokenize(text):
+    text = text.lower()
+    return _WORD_RE.findall(text) + _CODE_RE.findall(text)
+
+_missing_pdftotext_logged = threading.Event()
+
+def extract_pdf_text(path):
+    """
+    Extracts the text layer of each page of a PDF with poppler's pdftotext,
+    which pdf2image already requires.
+
+    Returns:
+        list: One string per page; empty for files without a text layer.
+        None if the text could not be extracted now (pdftotext missing or
+        failing, file not found), so the caller can try again later.
+    """
+    if not path.lower().endswith('.pdf'):
+        return []
+    if not os.path.exists(path):
+        return None
+    if shutil.which('pdftotext') is None:
+        if not _missing_pdftotext_logged.is_set():
+            _missing_pdftotext_logged.set()
+            logger.warning("pdftotext not found; pages are indexed without text.")
+        return None
+    try:
+        output = subprocess.run(['pdftotext', '-enc', 'UTF-8', '-layout', path, '-'],
+                                capture_output=True, check=True, timeout=300).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Text extraction failed for {os.path.basename(path)}: {e}")
+        return None
+    # pdftotext ends every page with a form feed
+    return output.decode('utf-8', errors='replace').split('\f')[:-1]
+
+def _index_folder(model):
+    index_root = getattr(model, 'index_root', None)
+    index_name = getattr(model, 'index_name', None)
+    if not index_root or not index_name:
+        return None
+    return os.path.join(index_root, index_name)
+
+def _load_page_texts(model):
+    folder = _index_folder(model)
+    if folder is None:
+        return {}
+    try:
+        with open(os.path.join(folder, PAGE_TEXT_FILE)) as f:
+            return {int(embed_id): text for embed_id, text in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+def save_page_texts(RAG, texts=None):
+    """
+    Extracts the text of every page of the index that has none yet and saves
+    it next to the index as page_text.json. Pages whose extraction failed get
+    an empty text but are not saved, so they are extracted again next time.
+
+    Returns:
+        dict: Embedding ID -> page text.
+    """
+    model = RAG.model
+    texts = dict(_load_page_texts(model) if texts is None else texts)
+    missing = {}
+    for embed_id, entry in model.embed_id_to_doc_id.items():
+        embed_id = int(embed_id)
+        if embed_id not in texts:
+            missing.setdefault(int(entry['doc_id']), []).append((embed_id, int(entry['page_id'])))
+    if not missing:
+        return texts
+
+    failed = set()
+    with span('text_extract'):
+        for doc_id, pages in missing.items():
+            path = model.doc_ids_to_file_names.get(doc_id) or model.doc_ids_to_file_names.get(str(doc_id)) or ''
+            page_texts = extract_pdf_text(str(path))
+            if page_texts is None:
+                failed.update(embed_id for embed_id, _ in pages)
+                page_texts = []
+            for embed_id, page_num in pages:
+                texts[embed_id] = page_texts[page_num - 1] if page_num <= len(page_texts) else ''
+
+    folder = _index_folder(model)
+    if folder is not None and os.path.isdir(folder) and len(failed) < sum(len(pages) for pages in missing.values()):
+        # Written to a temporary file first: uploads and queries may save the same index's text at once
+        path = os.path.join(folder, PAGE_TEXT_FILE)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({str(embed_id): text for embed_id, text in texts.items() if embed_id not in failed}, f)
+        os.replace(temp_path, path)
+    return texts
+
+class LexicalIndex:
+    """A BM25 inverted index over the text of an index's pages, keyed by embedding ID."""
+
+    def __init__(self, texts, size):
+        self.size = size
+        lengths = np.zeros(size, dtype=np.float32)
+        postings = {}  # term -> {embedding ID: term frequency}
+        for embed_id, text in texts.items():
+            if embed_id >= size:
+                continue
+            tokens = tokenize(text)
+            lengths[embed_id] = len(tokens)
+            for token in tokens:
+                counts = postings.setdefault(token, {})
+                counts[embed_id] = counts.get(embed_id, 0) + 1
+
+        average_length = float(lengths.mean()) if size and lengths.any() else 1.0
+        # Per-page part of the BM25 denominator, precomputed once
+        self.length_norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / average_length)
+        self.postings = {}
+        for term, counts in postings.items():
+            idf = math.log((size - len(counts) + 0.5) / (len(counts) + 0.5) + 1)
+            ids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            tfs = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+            self.postings[term] = (ids, tfs, idf)
+
+    def search(self, query, n, candidates=None):
+        """
+        Scores the pages that contain a query term, touching only their postings.
+
+        Args:
+            query (str): The user's query.
+            n (int): The number of pages to return.
+            candidates (np.ndarray, optional): Embedding IDs to restrict the search to.
+
+        Returns:
+            tuple: (embedding IDs, BM25 scores), best first.
+        """
+        scores = {}
+        allowed = None
+        if candidates is not None:
+            allowed = np.zeros(self.size, dtype=bool)
+            allowed[candidates] = True
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs, idf = posting
+            if allowed is not None:
+                keep = allowed[ids]
+                ids, tfs = ids[keep], tfs[keep]
+            term_scores = idf * tfs * (BM25_K1 + 1) / (tfs + self.length_norm[ids])
+            for embed_id, score in zip(ids.tolist(), term_scores.tolist()):
+                scores[embed_id] = scores.get(embed_id, 0.0) + score
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:n]
+        return [embed_id for embed_id, _ in ranked], [score for _, score in ranked]
+
+_lexical_indexes = weakref.WeakKeyDictionary()  # byaldi model -> LexicalIndex
+_build_locks = weakref.WeakKeyDictionary()  # byaldi model -> lock held while its index is built
+_backfills = weakref.WeakKeyDictionary()  # byaldi model -> thread extracting its missing page text
+_lexical_lock = threading.Lock()
+
+def _backfill_page_texts(RAG, texts, size):
+    model = RAG.model
+    try:
+        texts = save_page_texts(RAG, texts)
+        with span('lexical_index_build'):
+            index = LexicalIndex(texts, size)
+        with _lexical_lock:
+            _lexical_indexes[model] = index
+        logger.info(f"Backfilled page text for index '{getattr(model, 'index_name', None)}'.")
+    except Exception as e:
+        logger.warning(f"Could not backfill page text: {e}")
+    finally:
+        with _lexical_lock:
+            _backfills.pop(model, None)
+
+def lexical_index(RAG):
+    """
+    Returns the BM25 index of a RAG model, rebuilding it after pages are
+    added. Builds only block queries on the same model.
+
+    Returns:
+        LexicalIndex: The index, or None while pages of the model are still
+        waiting for their text. Indexes built before text extraction (or
+        pages whose upload could not store it) get it from a background
+        thread; searches are visual only until it is done.
+    """
+    model = RAG.model
+    size = len(model.indexed_embeddings)
+    with _lexical_lock:
+        index = _lexical_indexes.get(model)
+        if index is not None and index.size == size:
+            return index
+        if model in _backfills:
+            return None
+        build_lock = _build_locks.setdefault(model, threading.Lock())
+
+    with build_lock:
+        index = _lexical_indexes.get(model)
+        if index is not None and index.size == size:
+            return index
+        texts = _load_page_texts(model)
+        if len(texts) < size:
+            with _lexical_lock:
+                if model not in _backfills:
+                    _backfills[model] = threading.Thread(target=_backfill_page_texts, args=(RAG, texts, size),
+                                                         name='page-text-backfill', daemon=True)
+                    _backfills[model].start()
+            return None
+        with span('lexical_index_build'):
+            index = LexicalIndex(texts, size)
+        with _lexical_lock:
+            _lexical_indexes[model] = index
+        return index
+
+def lexical_is_confident(scores):
+    if LEXICAL_SHORTCUT_MARGIN <= 0 or not scores or scores[0] < LEXICAL_SHORTCUT_MIN_SCORE:
+        return False
+    return len(scores) == 1 or scores[0] >= LEXICAL_SHORTCUT_MARGIN * scores[1]
+
+def hybrid_search(RAG, query, k, filters=None, query_embedding=None, score_gap=RETRIEVAL_SCORE_GAP):
+    """
+    Fuses the BM25 and visual rankings of an index with reciprocal rank
+    fusion. When one page stands out lexically (an invoice number, a part
+    code) the visual stage is skipped. Visual candidates past a clear drop
+    in MaxSim score are left out before fusing; without lexical hits (or
+    while the index's page text is still being extracted) the remaining
+    visual ranking is returned as is. Every path scores by rank (RRF), so results
+    of several indexes can be merged by score.
+
+    Args:
+        RAG (RAGMultiModalModel): The index to search.
+        query (str): The user's query.
+        k (int): The number of results to return.
+        filters (dict, optional): Page filters from models.page_metadata.normalize_filters.
+        query_embedding (QueryEmbedding, optional): The encoded query, shared
+            with the other indexes searched for the question. Only encoded
+            if the visual stage runs.
+        score_gap (float): Visual score drop at which candidates stop (see
+            models.page_metadata.cut_on_score_gap).
+
+    Returns:
+        list: byaldi Result objects, best first.
+    """
+    model = RAG.model
+    candidates = page_metadata(RAG).select(filters) if filters else None
+    index = lexical_index(RAG)
+    with span('lexical_search'):
+        lexical_ids, lexical_scores = (index.search(query, max(k, HYBRID_CANDIDATES), candidates)
+                                       if index is not None else ([], []))
+
+    if lexical_is_confident(lexical_scores):
+        LEXICAL_SHORTCUTS.inc()
+        return [page_result(model, embed_id, 1 / (RRF_K + rank))
+                for rank, embed_id in enumerate(lexical_ids[:k], start=1)]
+
+    depth = max(k, HYBRID_CANDIDATES) if lexical_ids else k
+    visual = visual_search(RAG, query_embedding or QueryEmbedding(query), depth, filters)
+    # Raw MaxSim scores still measure relevance here; after fusion only ranks are left
+    visual = cut_on_score_gap(visual, score_gap)
+    if not lexical_ids:
+        for rank, result in enumerate(visual[:k], start=1):
+            result.score = 1 / (RRF_K + rank)
+        return visual[:k]
+
+    fused = {}
+    embed_ids_by_page = page_metadata(RAG).embed_ids_by_page
+    for rank, result in enumerate(visual, start=1):
+        embed_id = embed_ids_by_page[(int(result.doc_id), int(result.page_num))]
+        fused[embed_id] = fused.get(embed_id, 0.0) + 1 / (RRF_K + rank)
+    for rank, embed_id in enumerate(lexical_ids, start=1):
+        fused[embed_id] = fused.get(embed_id, 0.0) + 1 / (RRF_K + rank)
+    ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
+    return [page_result(model, embed_id, score) for embed_id, score in ranked]
@@ -0,0 +1,169 @@
+# models/library.py
+
+import os
+import re
+import threading
+from models.indexer import index_documents
+from models.snapshots import index_fingerprint, index_model_name, load_index
+from models.answer_cache import answer_cache
+from logger import get_logger
+from metrics import span
+
+logger = get_logger(__name__)
+
+# Shared library indexes live apart from the per-session indexes in .byaldi
+LIBRARY_INDEX_ROOT = os.path.abspath(os.getenv('LIBRARY_INDEX_ROOT', '.byaldi_library'))
+# Library names become folder names
+LIBRARY_NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+
+class LibraryRegistry:
+    """
+    Holds each shared library index in memory once per process, however many
+    sessions have it attached. An index is reloaded when it is rebuilt on disk.
+    """
+
+    def __init__(self, root=LIBRARY_INDEX_ROOT):
+        self.root = root
+        self._indexes = {}  # library name -> (RAG model, index version)
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def path(self, name):
+        if not LIBRARY_NAME_PATTERN.fullmatch(name or ''):
+            raise ValueError(f"Invalid library name: {name!r}")
+        return os.path.join(self.root, name)
+
+    def version(self, name):
+        """Returns the version of the library index on disk, or None if it does not exist."""
+        index_path = self.path(name)
+        if not os.path.isdir(index_path):
+            return None
+        return f"library:{name}:{index_fingerprint(index_path)}"
+
+    def model_name(self, name):
+        """Returns the indexer model the library was built with, or None if it has no index."""
+        return index_model_name(self.path(name))
+
+    def available(self):
+        """Returns the names of the libraries that have an index on disk."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if LIBRARY_NAME_PATTERN.fullmatch(name) and os.path.isdir(os.path.join(self.root, name)))
+
+    def get(self, name):
+        """
+        Returns (RAG model, index version) for a library, loading it on first
+        use. Returns (None, None) if the library has no index.
+        """
+        version = self.version(name)
+        if version is None:
+            return None, None
+        cached = self._indexes.get(name)
+        if cached is not None and cached[1] == version:
+            return cached
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        # Sessions asking for the same library wait for one load instead of each loading a copy
+        with load_lock:
+            cached = self._indexes.get(name)
+            if cached is not None and cached[1] == version:
+                return cached
+            with span('index_load'):
+                RAG = load_index(self.path(name))
+            self._store(name, RAG, version)
+            logger.info(f"Library index '{name}' loaded.")
+            return RAG, version
+
+    def build(self, name, folder_path, indexer_model='vidore/colpali'):
+        """
+        Indexes every document in a folder as the library `name`, replacing
+        any previous index of that name.
+
+        Returns:
+            RAGMultiModalModel: The RAG model with the library's pages.
+        """
+        index_path = self.path(name)
+        os.makedirs(self.root, exist_ok=True)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            RAG = index_documents(folder_path, index_name=name, index_path=index_path,
+                                  indexer_model=indexer_model, index_root=self.root)
+            self._store(name, RAG, self.version(name))
+        logger.info(f"Library '{name}' built from {folder_path} ({len(RAG.model.indexed_embeddings)} pages).")
+        return RAG
+
+    def unload(self, name):
+        with self._lock:
+            cached = self._indexes.pop(name, None)
+        if cached is not None:
+            answer_cache.invalidate_index(cached[1])
+
+    def _store(self, name, RAG, version):
+        with self._lock:
+            previous = self._indexes.get(name)
+            self._indexes[name] = (RAG, version)
+        if previous is not None and previous[1] != version:
+            # Answers computed against the old pages no longer apply
+            answer_cache.invalidate_index(previous[1])
+
+libraries = LibraryRegistry()
+
+def mismatched_libraries(library_names, model_name=None):
+    """
+    Returns the libraries whose index was built with another indexer model
+    than `model_name`, or than the first of them when it is None. Their
+    embeddings cannot be searched with the session's encoder.
+    """
+    mismatched = []
+    for name in library_names:
+        library_model = libraries.model_name(name)
+        if library_model is None:
+            continue
+        if model_name is None:
+            model_name = library_model
+        elif library_model != model_name:
+            mismatched.append(name)
+    return mismatched
+
+def attach_libraries(rag_model, index_version, library_names):
+    """
+    Combines a session's own index with the shared libraries attached to it.
+    Libraries built with another indexer model than the first index are
+    skipped, since the query is encoded once for all of them.
+
+    Args:
+        rag_model (RAGMultiModalModel): The session's index, or None if it has none.
+        index_version (str): The version of the session's index.
+        library_names (list): Names of the attached libraries.
+
+    Returns:
+        tuple: (RAG model, index version) when only one index is available,
+        (list of RAG models, tuple of their versions) when there are several,
+        or (None, None) when there is none.
+    """
+    sources = [rag_model] if rag_model is not None else []
+    versions = [index_version] if rag_model is not None else []
+    for name in library_names or []:
+        try:
+            RAG, version = libraries.get(name)
+        except Exception as e:
+            logger.error(f"Error loading library index '{name}': {e}")
+            continue
+        if RAG is None:
+            logger.warning(f"Library '{name}' is attached but has no index.")
+            continue
+        if sources and RAG.model.model_name != sources[0].model.model_name:
+            logger.error(f"Library '{name}' was indexed with {RAG.model.model_name}, not "
+                         f"{sources[0].model.model_name}; skipped.")
+            continue
+        sources.append(RAG)
+        versions.append(version)
+
+    if not sources:
+        return None, None
+    if len(sources) == 1:
+        return sources[0], versions[0]
+    return sources, tuple(versions)
@@ -0,0 +1,162 @@
+# models/model_config.py
+
+import copy
+import os
+import threading
+import time
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Seconds between checks of the ModelConfig table for changes
+MODEL_CONFIG_POLL_INTERVAL = float(os.getenv('MODEL_CONFIG_POLL_INTERVAL', 30))
+
+# Built-in settings per backend. A ModelConfig row whose model_type names a
+# backend is merged over these, with 'generation' merged key by key.
+DEFAULT_MODEL_CONFIGS = {
+    'qwen': {
+        'model_id': 'Qwen/Qwen2-VL-7B-Instruct',
+        'dtype': 'float16',
+        'device': 'auto',
+        'device_map': 'auto',
+        'quantization': None,
+        # Draft model for assisted (speculative) decoding, e.g. Qwen/Qwen2-VL-2B-Instruct
+        'assistant_model_id': None,
+        'generation': {'max_new_tokens': 128},
+    },
+    'gemini': {
+        'model_id': 'gemini-1.5-flash-002',
+        # Backend used while this API is failing or slow, e.g. 'qwen' (see models.failover)
+        'fallback_model': None,
+        'generation': {},
+    },
+    'gpt4': {
+        'model_id': 'gpt-4o',
+        'fallback_model': None,
+        'generation': {'max_tokens': 1024},
+    },
+    'llama-vision': {
+        'model_id': 'alpindale/Llama-3.2-11B-Vision-Instruct',
+        'dtype': 'float16',
+        'device': 'auto',
+        'device_map': 'auto',
+        'quantization': None,
+        'generation': {'max_new_tokens': 512},
+    },
+    'pixtral': {
+        'model_id': 'mistralai/Pixtral-12B-2409',
+        'local_dir': 'Pixtral',
+        'device': 'auto',
+        'generation': {'max_tokens': 256, 'temperature': 0.35},
+    },
+    'molmo': {
+        'model_id': 'allenai/MolmoE-1B-0924',
+        'dtype': 'auto',
+        'device': 'auto',
+        'device_map': 'auto',
+        'quantization': None,
+        'generation': {'max_new_tokens': 200},
+    },
+    'groq-llama-vision': {
+        'model_id': 'llava-v1.5-7b-4096-preview',
+        'fallback_model': None,
+        'generation': {},
+    },
+    'ollama-llama-vision': {
+        'model_id': 'llama3.2-vision',
+        'generation': {},
+    },
+}
+
+def merge_config(defaults, overrides):
+    """Returns `defaults` updated with `overrides`, merging the 'generation' dicts."""
+    merged = copy.deepcopy(defaults)
+    for key, value in (overrides or {}).items():
+        if key == 'generation' and isinstance(value, dict):
+            merged.setdefault('generation', {}).update(value)
+        else:
+            merged[key] = value
+    return merged
+
+def _fetch_rows():
+    """
+    Reads the active ModelConfig rows. Returns None if Django is not set up
+    or the table is unavailable, in which case the built-in defaults apply.
+    """
+    try:
+        from django.apps import apps
+        from django.db import close_old_connections
+        ModelConfig = apps.get_model('models_app', 'ModelConfig')
+        close_old_connections()
+        return list(ModelConfig.objects.filter(is_active=True).order_by('updated_at', 'id')
+                    .values('id', 'model_type', 'config', 'updated_at'))
+    except Exception as e:
+        logger.debug(f"ModelConfig rows unavailable, using built-in defaults: {e}")
+        return None
+
+class ModelConfigRegistry:
+    """
+    Holds the effective configuration of every backend, built from the
+    active ModelConfig rows and cached in memory. `refresh` re-reads the
+    table at most once per poll interval and reports which backends changed;
+    lookups never touch the database.
+    """
+
+    def __init__(self, poll_interval=MODEL_CONFIG_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._configs = {name: copy.deepcopy(config) for name, config in DEFAULT_MODEL_CONFIGS.items()}
+        self._fingerprint = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self, model_choice):
+        """Returns a copy of the effective configuration for a backend."""
+        with self._lock:
+            config = self._configs.get(model_choice)
+            return copy.deepcopy(config) if config is not None else None
+
+    def generation_params(self, model_choice):
+        return (self.get(model_choice) or {}).get('generation', {})
+
+    def preload_choices(self):
+        """Returns the backends whose configuration asks for them to be loaded at startup."""
+        with self._lock:
+            return [name for name, config in self._configs.items() if config.get('preload')]
+
+    def refresh(self, force=False):
+        """
+        Re-reads the active ModelConfig rows if the poll interval has passed.
+
+        Returns:
+            list: The backends whose effective configuration changed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not force and self._checked_at is not None and now - self._checked_at < self.poll_interval:
+                return []
+            self._checked_at = now
+
+        rows = _fetch_rows()
+        if rows is None:
+            return []
+        fingerprint = tuple((row['id'], row['updated_at']) for row in rows)
+        with self._lock:
+            if fingerprint == self._fingerprint:
+                return []
+            self._fingerprint = fingerprint
+
+            configs = {name: copy.deepcopy(config) for name, config in DEFAULT_MODEL_CONFIGS.items()}
+            for row in rows:
+                # Rows are ordered by updated_at, so the latest row for a backend wins
+                defaults = DEFAULT_MODEL_CONFIGS.get(row['model_type'])
+                if defaults is None:
+                    logger.warning(f"ModelConfig {row['id']} has unknown model_type '{row['model_type']}'; ignored.")
+                    continue
+                configs[row['model_type']] = merge_config(defaults, row['config'])
+            changed = [name for name in configs if configs[name] != self._configs.get(name)]
+            self._configs = configs
+        if changed:
+            logger.info(f"Model configuration changed for: {', '.join(changed)}")
+        return changed
+
+model_configs = ModelConfigRegistry()
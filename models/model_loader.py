@@ -1,6 +1,10 @@
 # models/model_loader.py
 
+import itertools
 import os
+import threading
+import time
+import weakref
 import torch
 from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
 from transformers import MllamaForConditionalGeneration
@@ -15,11 +19,28 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from logger import get_logger
+from metrics import span, record_cache_lookup
+from models.model_config import model_configs
+from models.vision_cache import vision_cache, install_per_image_cache, install_whole_call_cache
+from models.snapshots import build_model_snapshot, model_source, record_load
 
 logger = get_logger(__name__)
 
 # Cache for loaded models
 _model_cache = {}
+_loaded_configs = {}  # model_choice -> configuration the cached model was loaded with
+_load_locks = {}  # model_choice -> lock serializing loads of that model
+_load_locks_lock = threading.Lock()
+_watcher = None
+# Loaded model -> its draft model for assisted decoding. Kept out of the model's
+# attributes so the draft is not registered as a submodule, and dropped with it on reload.
+_assistant_models = weakref.WeakKeyDictionary()
+# Loaded model -> (model_id, load number), naming its entries in the vision cache
+_cache_namespaces = weakref.WeakKeyDictionary()
+_load_numbers = itertools.count(1)
+
+# Backends that are cheap to create and not kept in the cache
+UNCACHED_MODELS = {'gemini', 'ollama-llama-vision'}
 
 # Models that only support single image processing
 SINGLE_IMAGE_MODELS = {
@@ -30,10 +51,30 @@ SINGLE_IMAGE_MODELS = {
     'molmo': True
 }
 
+# Backends whose weights can be saved as warm-start snapshots, with their model classes
+SNAPSHOT_MODEL_CLASSES = {
+    'qwen': Qwen2VLForConditionalGeneration,
+    'llama-vision': MllamaForConditionalGeneration,
+}
+
+# Pages retrieved for models that take several images
+RETRIEVAL_K = int(os.getenv('RETRIEVAL_K', 3))
+
 def is_single_image_model(model_choice):
     """Returns True if the model only supports processing a single image."""
     return model_choice in SINGLE_IMAGE_MODELS
 
+def max_images_for_model(model_choice):
+    """
+    Returns how many retrieved pages the model will look at: 'max_images' from
+    its ModelConfig if set, otherwise 1 for single-image models and
+    RETRIEVAL_K for the rest.
+    """
+    configured = (model_configs.get(model_choice) or {}).get('max_images')
+    if configured:
+        return int(configured)
+    return 1 if is_single_image_model(model_choice) else RETRIEVAL_K
+
 def detect_device():
     """
     Detects the best available device (CUDA, MPS, or CPU).
@@ -45,59 +86,252 @@ def detect_device():
     else:
         return 'cpu'
 
+def resolve_device(config):
+    """Returns the configured device, detecting the best one for 'auto'."""
+    device = config.get('device', 'auto')
+    return detect_device() if device == 'auto' else device
+
+def pretrained_kwargs(config, device):
+    """
+    Builds the dtype, device placement and quantization arguments for
+    `from_pretrained` from a backend's configuration.
+    """
+    dtype = config.get('dtype', 'auto')
+    if dtype != 'auto':
+        # Half precision is slow or unsupported on CPU
+        dtype = torch.float32 if device == 'cpu' else getattr(torch, dtype)
+    kwargs = {'torch_dtype': dtype, 'device_map': config.get('device_map', 'auto')}
+    quantization = config.get('quantization')
+    if quantization:
+        from transformers import BitsAndBytesConfig
+        if quantization == '4bit':
+            kwargs['quantization_config'] = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.float16)
+        elif quantization == '8bit':
+            kwargs['quantization_config'] = BitsAndBytesConfig(load_in_8bit=True)
+        else:
+            raise ValueError(f"Unsupported quantization: {quantization}")
+    return kwargs
+
+def _place_model(model, config, device):
+    # Quantized weights are placed by bitsandbytes and cannot be moved
+    if not config.get('quantization'):
+        model.to(device)
+
+def load_assistant_model(model_class, config, device):
+    """
+    Loads the draft model named by 'assistant_model_id' for assisted
+    (speculative) decoding. The draft must share the main model's tokenizer
+    and processor. It is loaded unquantized with the main model's dtype and
+    placement.
+
+    Returns:
+        The draft model, or None if none is configured or it fails to load.
+    """
+    assistant_id = config.get('assistant_model_id')
+    if not assistant_id:
+        return None
+    try:
+        with span('assistant_model_load'):
+            assistant = model_class.from_pretrained(
+                model_source(assistant_id, config.get('dtype')),
+                **pretrained_kwargs(dict(config, quantization=None), device)
+            )
+            assistant.to(device)
+    except Exception as e:
+        logger.error(f"Loading assistant model '{assistant_id}' failed, generating without it: {e}", exc_info=True)
+        return None
+    logger.info(f"Assistant model '{assistant_id}' loaded for assisted decoding.")
+    return assistant
+
+def assistant_model_for(model):
+    """Returns the draft model loaded alongside `model`, or None."""
+    return _assistant_models.get(model)
+
+def snapshot_model(model_choice, force=False):
+    """
+    Saves a backend's weights, and its draft model's if it has one, converted
+    to the configured dtype as a warm-start snapshot (see models.snapshots).
+
+    Returns:
+        list: The snapshot folders written; up-to-date snapshots are skipped.
+    """
+    model_class = SNAPSHOT_MODEL_CLASSES.get(model_choice)
+    if model_class is None:
+        raise ValueError(f"Model '{model_choice}' does not support snapshots.")
+    config = model_configs.get(model_choice)
+    built = []
+    for model_id in (config['model_id'], config.get('assistant_model_id')):
+        if model_id:
+            folder = build_model_snapshot(model_class, AutoProcessor, model_id, config.get('dtype'), force=force)
+            if folder:
+                built.append(folder)
+    return built
+
+def _load_pretrained(model_choice, model_class, config, device):
+    """
+    Loads a transformers backend and its processor from the warm-start
+    snapshot of its weights if there is one, else from the Hugging Face cache.
+    """
+    source = model_source(config['model_id'], config.get('dtype'))
+    started = time.perf_counter()
+    model = model_class.from_pretrained(source, **pretrained_kwargs(config, device))
+    processor = AutoProcessor.from_pretrained(source)
+    seconds = time.perf_counter() - started
+    origin = 'hub' if source == config['model_id'] else 'snapshot'
+    record_load('model', model_choice, origin, seconds)
+    logger.info(f"Model '{model_choice}' weights loaded from {origin} in {seconds:.1f}s.")
+    return model, processor
+
 def load_model(model_choice):
     """
     Loads and caches the specified model.
     """
-    global _model_cache
-
+    check_model_configs()
     if model_choice in _model_cache:
+        record_cache_lookup('model', hit=True)
         logger.info(f"Model '{model_choice}' loaded from cache.")
         return _model_cache[model_choice]
 
+    with _load_lock(model_choice):
+        # Another request may have loaded it while this one waited
+        if model_choice in _model_cache:
+            record_cache_lookup('model', hit=True)
+            return _model_cache[model_choice]
+        record_cache_lookup('model', hit=False)
+        config = model_configs.get(model_choice)
+        with span('model_load'):
+            model = _load_uncached_model(model_choice, config or {})
+        if model_choice not in UNCACHED_MODELS:
+            _register_instance(model, config)
+            _model_cache[model_choice] = model
+            _loaded_configs[model_choice] = config
+        return model
+
+def _instance(loaded):
+    # Cached entries are the model alone or a (model, processor, ...) tuple
+    return loaded[0] if isinstance(loaded, tuple) else loaded
+
+def _register_instance(loaded, config):
+    namespace = ((config or {}).get('model_id'), next(_load_numbers))
+    try:
+        _cache_namespaces[_instance(loaded)] = namespace
+    except TypeError:
+        return  # Not weak-referenceable (e.g. an API client); nothing to cache for it
+    # Once the instance is freed no request can store under its namespace again
+    weakref.finalize(_instance(loaded), vision_cache.forget, namespace)
+
+def vision_cache_namespace(model):
+    """
+    Names a loaded model instance in the vision cache. Each load gets its
+    own namespace, so an instance still serving requests during a reload
+    never stores encodings under its replacement's name.
+    """
+    return _cache_namespaces.get(model)
+
+def _load_lock(model_choice):
+    with _load_locks_lock:
+        return _load_locks.setdefault(model_choice, threading.Lock())
+
+def reload_models(model_choices):
+    """
+    Loads the given cached models again with their current configuration and
+    swaps each one in once it is ready. Requests already running keep the
+    instance they started with, which is freed when they finish.
+    """
+    for model_choice in model_choices:
+        config = model_configs.get(model_choice)
+        with _load_lock(model_choice):
+            if model_choice not in _model_cache or _loaded_configs.get(model_choice) == config:
+                continue
+            logger.info(f"Reloading model '{model_choice}' with updated configuration.")
+            try:
+                with span('model_load'):
+                    model = _load_uncached_model(model_choice, config or {})
+            except Exception as e:
+                logger.error(f"Reloading model '{model_choice}' failed, keeping the current one: {e}", exc_info=True)
+                continue
+            _register_instance(model, config)
+            previous = _instance(_model_cache[model_choice])
+            _model_cache[model_choice] = model
+            _loaded_configs[model_choice] = config
+            # Encodings from the old weights or precision no longer apply
+            vision_cache.clear(vision_cache_namespace(previous))
+            logger.info(f"Model '{model_choice}' swapped to the updated configuration.")
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def check_model_configs():
+    """
+    Picks up ModelConfig changes (at most once per poll interval) and reloads
+    affected models in a background thread.
+    """
+    changed = [choice for choice in model_configs.refresh() if choice in _model_cache]
+    if changed:
+        threading.Thread(target=reload_models, args=(changed,), name='model-reload', daemon=True).start()
+
+def start_model_watcher():
+    """
+    Loads the backends configured with 'preload' and keeps polling the model
+    configuration, so changes are applied even while no requests arrive.
+    """
+    global _watcher
+    with _load_locks_lock:
+        if _watcher is not None:
+            return
+        _watcher = threading.Thread(target=_watch_model_configs, name='model-config-watcher', daemon=True)
+    _watcher.start()
+
+def _watch_model_configs():
+    model_configs.refresh(force=True)
+    for model_choice in model_configs.preload_choices():
+        try:
+            load_model(model_choice)
+            logger.info(f"Model '{model_choice}' preloaded.")
+        except Exception as e:
+            logger.error(f"Preloading model '{model_choice}' failed: {e}", exc_info=True)
+    while True:
+        time.sleep(model_configs.poll_interval)
+        check_model_configs()
+
+def _load_uncached_model(model_choice, config):
+    """
+    Loads the specified model from its source using its configuration.
+    """
     if model_choice == 'qwen':
-        device = detect_device()
-        model = Qwen2VLForConditionalGeneration.from_pretrained(
-            "Qwen/Qwen2-VL-7B-Instruct",
-            torch_dtype=torch.float16 if device != 'cpu' else torch.float32,
-            device_map="auto"
-        )
-        processor = AutoProcessor.from_pretrained("Qwen/Qwen2-VL-7B-Instruct")
-        model.to(device)
-        _model_cache[model_choice] = (model, processor, device)
-        logger.info("Qwen model loaded and cached.")
-        return _model_cache[model_choice]
+        device = resolve_device(config)
+        model, processor = _load_pretrained(model_choice, Qwen2VLForConditionalGeneration, config, device)
+        _place_model(model, config, device)
+        install_per_image_cache(model)
+        assistant = load_assistant_model(Qwen2VLForConditionalGeneration, config, device)
+        if assistant is not None:
+            _assistant_models[model] = assistant
+        logger.info("Qwen model loaded.")
+        return model, processor, device
 
     elif model_choice == 'gemini':
         api_key = os.getenv("GOOGLE_API_KEY")
         if not api_key:
             raise ValueError("GOOGLE_API_KEY not found in .env file")
         genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-1.5-flash-002')
+        model = genai.GenerativeModel(config['model_id'])
         return model, None
 
     elif model_choice == 'llama-vision':
-        device = detect_device()
-        model_id = "alpindale/Llama-3.2-11B-Vision-Instruct"
-        model = MllamaForConditionalGeneration.from_pretrained(
-            model_id,
-            torch_dtype=torch.float16 if device != 'cpu' else torch.float32,
-            device_map="auto"
-        )
-        processor = AutoProcessor.from_pretrained(model_id)
-        model.to(device)
-        _model_cache[model_choice] = (model, processor, device)
-        logger.info("Llama-Vision model loaded and cached.")
-        return _model_cache[model_choice]
+        device = resolve_device(config)
+        model, processor = _load_pretrained(model_choice, MllamaForConditionalGeneration, config, device)
+        _place_model(model, config, device)
+        install_whole_call_cache(model)
+        logger.info("Llama-Vision model loaded.")
+        return model, processor, device
     
     elif model_choice == "pixtral":
-        device = detect_device()
-        mistral_models_path = os.path.join(os.getcwd(), 'mistral_models', 'Pixtral')
+        device = resolve_device(config)
+        mistral_models_path = os.path.join(os.getcwd(), 'mistral_models', config.get('local_dir', 'Pixtral'))
         
         if not os.path.exists(mistral_models_path):
             os.makedirs(mistral_models_path, exist_ok=True)
             from huggingface_hub import snapshot_download
-            snapshot_download(repo_id="mistralai/Pixtral-12B-2409", 
+            snapshot_download(repo_id=config['model_id'], 
                               allow_patterns=["params.json", "consolidated.safetensors", "tekken.json"], 
                               local_dir=mistral_models_path)
 
@@ -108,35 +342,31 @@ def load_model(model_choice):
         tokenizer = MistralTokenizer.from_file(os.path.join(mistral_models_path, "tekken.json"))
         model = Transformer.from_folder(mistral_models_path)
         
-        _model_cache[model_choice] = (model, tokenizer, generate, device)
-        logger.info("Pixtral model loaded and cached.")
-        return _model_cache[model_choice]
+        logger.info("Pixtral model loaded.")
+        return model, tokenizer, generate, device
     
     elif model_choice == "molmo":
-        device = detect_device()
+        device = resolve_device(config)
         processor = AutoProcessor.from_pretrained(
-            'allenai/MolmoE-1B-0924',
+            config['model_id'],
             trust_remote_code=True,
             torch_dtype='auto',
             device_map='auto'
         )
         model = AutoModelForCausalLM.from_pretrained(
-            'allenai/MolmoE-1B-0924',
+            config['model_id'],
             trust_remote_code=True,
-            torch_dtype='auto',
-            device_map='auto'
+            **pretrained_kwargs(config, device)
         )
-        _model_cache[model_choice] = (model, processor, device)
-        return _model_cache[model_choice]
+        return model, processor, device
 
     elif model_choice == 'groq-llama-vision':
         api_key = os.getenv("GROQ_API_KEY")
         if not api_key:
             raise ValueError("GROQ_API_KEY not found in .env file")
         client = Groq(api_key=api_key)
-        _model_cache[model_choice] = client
-        logger.info("Groq Llama Vision model loaded and cached.")
-        return _model_cache[model_choice]
+        logger.info("Groq Llama Vision client created.")
+        return client
 
     elif model_choice == 'ollama-llama-vision':
         logger.info("Ollama Llama Vision model ready to use.")
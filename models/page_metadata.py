@@ -0,0 +1,250 @@
+# models/page_metadata.py
+
+import os
+import threading
+import weakref
+from datetime import datetime
+import numpy as np
+import torch
+from byaldi.objects import Result
+from logger import get_logger
+from metrics import span
+
+logger = get_logger(__name__)
+
+FILTER_KEYS = ('file_names', 'page_ranges', 'doc_types', 'uploaded_after', 'uploaded_before')
+# Visual results after a score drop larger than this fraction of the top score are not used (0 disables).
+# Only MaxSim scores are cut; RRF scores of hybrid retrieval differ too little between ranks
+RETRIEVAL_SCORE_GAP = float(os.getenv('RETRIEVAL_SCORE_GAP', 0.2))
+
+def upload_metadata(file_name, original_name, uploaded_at):
+    """
+    Builds the metadata stored with a document's pages in the byaldi index.
+    byaldi only keeps string and integer values.
+    """
+    extension = os.path.splitext(original_name or file_name)[1].lstrip('.').lower()
+    return {
+        'file_name': file_name,
+        'original_name': original_name or file_name,
+        'doc_type': extension,
+        'uploaded_at': int(uploaded_at.timestamp() if isinstance(uploaded_at, datetime) else uploaded_at),
+    }
+
+def parse_page_ranges(text):
+    """
+    Parses a page selection such as "1-3, 7" into [(1, 3), (7, 7)].
+
+    Raises:
+        ValueError: If the text is not a list of page numbers and ranges.
+    """
+    ranges = []
+    for part in str(text).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        start = int(start)
+        end = int(end) if end.strip() else start
+        if start < 1 or end < start:
+            raise ValueError(f"Invalid page range: {part!r}")
+        ranges.append((start, end))
+    return ranges
+
+def normalize_filters(raw):
+    """
+    Validates search filters from a form or API request.
+
+    Args:
+        raw (dict): Any of 'file_names' (list), 'page_ranges' (list of
+            (start, end) pairs or a string like "1-3,7"), 'doc_types' (list of
+            extensions), 'uploaded_after' and 'uploaded_before' (Unix
+            timestamps or datetimes). Empty values are ignored.
+
+    Returns:
+        dict: The filters in canonical form, or None if none were given.
+
+    Raises:
+        ValueError: If a filter has an invalid value.
+    """
+    filters = {}
+    for key, value in (raw or {}).items():
+        if key not in FILTER_KEYS:
+            raise ValueError(f"Unknown filter: {key}")
+        if value in (None, '', [], ()):
+            continue
+        if key == 'page_ranges':
+            if isinstance(value, str):
+                value = parse_page_ranges(value)
+            else:
+                value = [(int(start), int(end)) for start, end in value]
+            filters[key] = tuple(sorted(value))
+        elif key in ('file_names', 'doc_types'):
+            values = [value] if isinstance(value, str) else value
+            if key == 'doc_types':
+                values = [v.lstrip('.').lower() for v in values]
+            filters[key] = tuple(sorted(set(values)))
+        else:
+            filters[key] = int(value.timestamp() if isinstance(value, datetime) else float(value))
+    return filters or None
+
+class PageMetadataIndex:
+    """
+    Per-page metadata of one byaldi index, grouped by file so a filter can pick
+    its candidate pages without looking at every page.
+    """
+
+    def __init__(self, model):
+        embed_ids = sorted(int(embed_id) for embed_id in model.embed_id_to_doc_id)
+        self.size = len(embed_ids)
+        documents = {}  # doc_id -> (file_name, doc_type, uploaded_at)
+        pages_by_doc = {}
+        self.embed_ids_by_page = {}  # (doc_id, page number) -> embedding ID
+        for embed_id in embed_ids:
+            entry = model.embed_id_to_doc_id.get(embed_id, model.embed_id_to_doc_id.get(str(embed_id)))
+            doc_id = int(entry['doc_id'])
+            if doc_id not in documents:
+                documents[doc_id] = self._document_metadata(model, doc_id)
+            pages_by_doc.setdefault(doc_id, ([], []))
+            pages_by_doc[doc_id][0].append(embed_id)
+            pages_by_doc[doc_id][1].append(int(entry['page_id']))
+            self.embed_ids_by_page[(doc_id, int(entry['page_id']))] = embed_id
+
+        self.documents = documents
+        self.doc_ids_by_file = {}
+        for doc_id, (file_name, _, _) in documents.items():
+            self.doc_ids_by_file.setdefault(file_name, []).append(doc_id)
+        self.pages = {doc_id: (np.array(ids, dtype=np.int64), np.array(nums, dtype=np.int64))
+                      for doc_id, (ids, nums) in pages_by_doc.items()}
+
+    @staticmethod
+    def _document_metadata(model, doc_id):
+        metadata = model.doc_id_to_metadata.get(doc_id) or model.doc_id_to_metadata.get(str(doc_id)) or {}
+        path = model.doc_ids_to_file_names.get(doc_id) or model.doc_ids_to_file_names.get(str(doc_id)) or ''
+        file_name = metadata.get('file_name') or os.path.basename(path)
+        doc_type = metadata.get('doc_type') or os.path.splitext(file_name)[1].lstrip('.').lower()
+        uploaded_at = metadata.get('uploaded_at')
+        if uploaded_at is None and path and os.path.exists(path):
+            # Pages indexed before metadata was recorded fall back to the file's mtime
+            uploaded_at = int(os.path.getmtime(path))
+        return file_name, doc_type, uploaded_at
+
+    def select(self, filters):
+        """Returns the embedding IDs of the pages that match every filter, in index order."""
+        if 'file_names' in filters:
+            doc_ids = [doc_id for name in filters['file_names'] for doc_id in self.doc_ids_by_file.get(name, [])]
+        else:
+            doc_ids = list(self.pages)
+
+        selected = []
+        for doc_id in doc_ids:
+            _, doc_type, uploaded_at = self.documents[doc_id]
+            if 'doc_types' in filters and doc_type not in filters['doc_types']:
+                continue
+            if 'uploaded_after' in filters and (uploaded_at is None or uploaded_at < filters['uploaded_after']):
+                continue
+            if 'uploaded_before' in filters and (uploaded_at is None or uploaded_at > filters['uploaded_before']):
+                continue
+            embed_ids, page_numbers = self.pages[doc_id]
+            if 'page_ranges' in filters:
+                mask = np.zeros(len(page_numbers), dtype=bool)
+                for start, end in filters['page_ranges']:
+                    mask |= (page_numbers >= start) & (page_numbers <= end)
+                embed_ids = embed_ids[mask]
+            selected.append(embed_ids)
+        if not selected:
+            return np.array([], dtype=np.int64)
+        return np.sort(np.concatenate(selected))
+
+_metadata_indexes = weakref.WeakKeyDictionary()  # byaldi model -> PageMetadataIndex
+_metadata_lock = threading.Lock()
+
+def page_metadata(RAG):
+    """Returns the metadata index of a RAG model, rebuilding it after pages are added."""
+    model = RAG.model
+    with _metadata_lock:
+        index = _metadata_indexes.get(model)
+        if index is None or index.size != len(model.embed_id_to_doc_id):
+            with span('page_metadata_build'):
+                index = PageMetadataIndex(model)
+            _metadata_indexes[model] = index
+        return index
+
+def page_result(model, embed_id, score):
+    """Builds the byaldi Result for one page of an index."""
+    entry = model.embed_id_to_doc_id.get(embed_id, model.embed_id_to_doc_id.get(str(embed_id)))
+    doc_id = int(entry['doc_id'])
+    return Result(
+        doc_id=doc_id,
+        page_num=int(entry['page_id']),
+        score=float(score),
+        metadata=model.doc_id_to_metadata.get(doc_id, {}),
+        base64=model.collection.get(embed_id) if model.collection else None,
+    )
+
+def cut_on_score_gap(results, gap):
+    """
+    Keeps the results before the first drop in score larger than `gap` times
+    the top score. Results must be sorted best first.
+    """
+    if gap <= 0 or len(results) < 2 or results[0].score <= 0:
+        return results
+    top = results[0].score
+    for i in range(1, len(results)):
+        if (results[i - 1].score - results[i].score) / top > gap:
+            return results[:i]
+    return results
+
+class QueryEmbedding:
+    """
+    A query's token embeddings, computed on first use and shared by every
+    index searched for the same question. Indexes built with the same
+    indexer model encode a query identically, so one encoding scores them all.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self._embedding = None
+        self._lock = threading.Lock()
+
+    def get(self, model):
+        """Returns the embeddings (tokens x dim, on the CPU), encoding the query with `model` if needed."""
+        with self._lock:
+            if self._embedding is None:
+                with span('query_encode'), torch.inference_mode():
+                    embedding = model.encode_query(self.query)
+                    self._embedding = embedding.reshape(-1, embedding.shape[-1]).to('cpu')
+            return self._embedding
+
+def visual_search(RAG, query_embedding, k, filters=None):
+    """
+    Scores the pages of an index against an encoded query with the index's
+    MaxSim scorer. With filters only the matching pages are scored, so a
+    filtered query costs time in proportion to the matching subset rather
+    than the whole index.
+
+    Args:
+        RAG (RAGMultiModalModel): The index to search.
+        query_embedding (QueryEmbedding): The query, encoded once per question.
+        k (int): The number of results to return.
+        filters (dict, optional): Filters in the form returned by normalize_filters.
+
+    Returns:
+        list: byaldi Result objects, best first.
+    """
+    model = RAG.model
+    if filters:
+        embed_ids = page_metadata(RAG).select(filters)
+        candidates = [model.indexed_embeddings[embed_id] for embed_id in embed_ids]
+    else:
+        embed_ids = None
+        candidates = model.indexed_embeddings
+    if len(candidates) == 0:
+        return []
+
+    embedding = query_embedding.get(model)
+    with torch.inference_mode():
+        scores = model.processor.score([embedding], candidates).cpu().numpy()[0]
+    # Without filters every page is a candidate and its position is its embedding ID
+    positions = scores.argsort()[::-1][:k]
+    ids = embed_ids[positions] if embed_ids is not None else positions
+    return [page_result(model, int(embed_id), scores[position]) for embed_id, position in zip(ids, positions)]
@@ -0,0 +1,236 @@
+# models/page_store.py
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from logger import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: pages are only protected within a process
+    fcntl = None
+
+logger = get_logger(__name__)
+
+# Page blobs live under static/ so they can be served directly; they are
+# sharded by hash prefix to keep directories small.
+PAGE_STORE_FOLDER = os.path.join('static', 'pages')
+# One file per session listing the page hashes that session references
+PAGE_REFS_FOLDER = os.path.join('sessions', 'page_refs')
+# One file per page holding the number of sessions that reference it
+PAGE_COUNTS_FOLDER = os.path.join(PAGE_REFS_FOLDER, 'counts')
+# Temporary page files older than this were left by a crashed writer
+STALE_TEMP_AGE = 3600
+
+_lock = threading.Lock()
+
+def page_hash(image_data):
+    """Returns the content hash used as the key of a page blob."""
+    return hashlib.sha256(image_data).hexdigest()
+
+def page_relative_path(page_id):
+    """Returns the path of a page blob relative to the static folder."""
+    return os.path.join('pages', page_id[:2], page_id[2:4], f"{page_id}.png")
+
+def page_id_from_path(image_path):
+    """
+    Returns the page ID of a page store path, or None for other images.
+    """
+    parts = os.path.normpath(image_path).split(os.sep)
+    if len(parts) >= 4 and parts[-4] == 'pages':
+        return os.path.splitext(parts[-1])[0]
+    return None
+
+def _blob_path(page_id):
+    return os.path.join('static', page_relative_path(page_id))
+
+def _refs_file(session_id):
+    return os.path.join(PAGE_REFS_FOLDER, f"{session_id}.txt")
+
+def _read_refs(session_id):
+    refs_file = _refs_file(session_id)
+    if not os.path.exists(refs_file):
+        return set()
+    with open(refs_file, 'r') as f:
+        return {line.strip() for line in f if line.strip()}
+
+def _count_file(page_id, folder=PAGE_COUNTS_FOLDER):
+    return os.path.join(folder, page_id[:2], page_id)
+
+def _read_count(page_id):
+    try:
+        with open(_count_file(page_id), 'r') as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+def _write_count(page_id, count, folder=PAGE_COUNTS_FOLDER):
+    count_file = _count_file(page_id, folder)
+    if count <= 0:
+        if os.path.exists(count_file):
+            os.remove(count_file)
+        return
+    os.makedirs(os.path.dirname(count_file), exist_ok=True)
+    # Replaced whole, so a crash never leaves a blob with a truncated count
+    with open(count_file + '.tmp', 'w') as f:
+        f.write(str(count))
+    os.replace(count_file + '.tmp', count_file)
+
+def _ensure_counts():
+    """
+    Builds the per-page reference counts from the session ref files, once,
+    for stores written before counts were kept. Call with the store locked.
+    """
+    if os.path.isdir(PAGE_COUNTS_FOLDER):
+        return
+    counts = {}
+    for filename in os.listdir(PAGE_REFS_FOLDER):
+        if filename.endswith('.txt'):
+            for page_id in _read_refs(filename[:-4]):
+                counts[page_id] = counts.get(page_id, 0) + 1
+    building = PAGE_COUNTS_FOLDER + '.tmp'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    for page_id, count in counts.items():
+        _write_count(page_id, count, building)
+    os.replace(building, PAGE_COUNTS_FOLDER)
+    logger.info(f"Built reference counts for {len(counts)} pages.")
+
+@contextmanager
+def _store_locked():
+    """
+    Serializes changes to blobs and ref files across threads and, through a
+    lock file, across processes (the Flask app and the Django API share the
+    store). Liveness is always read from the reference counts on disk, never
+    from per-process state.
+    """
+    with _lock:
+        os.makedirs(PAGE_REFS_FOLDER, exist_ok=True)
+        with open(os.path.join(PAGE_REFS_FOLDER, '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                _ensure_counts()
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _add_ref(page_id, session_id):
+    if page_id not in _read_refs(session_id):
+        with open(_refs_file(session_id), 'a') as f:
+            f.write(page_id + '\n')
+        _write_count(page_id, _read_count(page_id) + 1)
+
+def _write_temp(blob_path, image):
+    """Writes the page next to its blob under a temporary name, so readers never see a partial blob."""
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    tmp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    image.save(tmp_path, format='PNG')
+    return tmp_path
+
+def store_page(image_data, image, session_id):
+    """
+    Stores a page image once, keyed by the hash of its encoded bytes, and
+    records a reference to it for the session.
+
+    Args:
+        image_data (bytes): The encoded page as returned by the index.
+        image (PIL.Image.Image): The decoded page, written as PNG on first store.
+        session_id (str): The session referencing the page.
+
+    Returns:
+        tuple: (page_id, relative_path) where relative_path is under the static folder.
+    """
+    page_id = page_hash(image_data)
+    blob_path = _blob_path(page_id)
+
+    # Encode outside the lock; the blob is published and referenced in one locked step,
+    # so garbage collection never sees it unreferenced
+    tmp_path = None if os.path.exists(blob_path) else _write_temp(blob_path, image)
+    with _store_locked():
+        if not os.path.exists(blob_path):
+            # Deleted since the check above (by a session release or garbage collection)
+            os.replace(tmp_path or _write_temp(blob_path, image), blob_path)
+            tmp_path = None
+            logger.debug(f"Stored new page blob: {blob_path}")
+        _add_ref(page_id, session_id)
+    if tmp_path is not None:
+        os.remove(tmp_path)
+
+    return page_id, page_relative_path(page_id)
+
+def reference_page(page_id, session_id):
+    """
+    Records that the session uses an already stored page.
+
+    Returns:
+        bool: False if the page blob no longer exists.
+    """
+    with _store_locked():
+        if not os.path.exists(_blob_path(page_id)):
+            return False
+        _add_ref(page_id, session_id)
+    return True
+
+def release_session(session_id):
+    """
+    Drops every page reference held by the session and deletes blobs that
+    are no longer referenced by any session.
+
+    Returns:
+        int: The number of page blobs deleted.
+    """
+    with _store_locked():
+        refs = _read_refs(session_id)
+        refs_file = _refs_file(session_id)
+        if os.path.exists(refs_file):
+            os.remove(refs_file)
+        # Counts change under the lock only, so a page another session (or
+        # process) referenced meanwhile is kept
+        orphaned = set()
+        for ref in refs:
+            count = _read_count(ref) - 1
+            _write_count(ref, count)
+            if count <= 0:
+                orphaned.add(ref)
+                try:
+                    os.remove(_blob_path(ref))
+                except FileNotFoundError:
+                    pass
+    logger.info(f"Released {len(refs)} page references for session {session_id}, deleted {len(orphaned)} blobs.")
+    return len(orphaned)
+
+def collect_garbage():
+    """
+    Deletes page blobs that no session references, e.g. left behind by a
+    crash between writing a blob and recording its reference, and temporary
+    page files of writers that crashed before publishing them.
+
+    Returns:
+        int: The number of page blobs deleted.
+    """
+    if not os.path.exists(PAGE_STORE_FOLDER):
+        return 0
+    deleted = 0
+    stale = time.time() - STALE_TEMP_AGE
+    with _store_locked():
+        for root, _, files in os.walk(PAGE_STORE_FOLDER):
+            for filename in files:
+                path = os.path.join(root, filename)
+                page_id, ext = os.path.splitext(filename)
+                if ext == '.png' and not os.path.exists(_count_file(page_id)):
+                    os.remove(path)
+                    deleted += 1
+                elif ext == '.tmp':
+                    # Written outside the lock, so only old ones are known to be abandoned
+                    try:
+                        if os.path.getmtime(path) < stale:
+                            os.remove(path)
+                    except FileNotFoundError:
+                        pass
+    logger.info(f"Page store garbage collection deleted {deleted} blobs.")
+    return deleted
@@ -0,0 +1,182 @@
+# models/pipeline.py
+
+import os
+from models.retriever import retrieve_documents, PAGES_SKIPPED
+from models.failover import failover
+from models.model_loader import max_images_for_model, RETRIEVAL_K
+from models.shared_pages import release_pages
+from models.answer_cache import answer_cache, query_vector, ANSWER_CACHE_ENABLED
+from models.admission import admission, estimate_tokens, AdmissionRejected
+from models.conversation import depends_on_history, prompt_with_context
+from models.page_metadata import QueryEmbedding
+from models.single_flight import single_flight, SINGLE_FLIGHT_ENABLED
+from models.page_store import page_id_from_path, reference_page
+from metrics import span
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static')
+# Hand decoded pages to the generator through shared memory instead of re-reading them from disk
+SHARE_PAGE_BUFFERS = os.getenv('SHARE_PAGE_BUFFERS', 'false').lower() in ('1', 'true', 'yes')
+
+def retrieve_pages(rag_model, query, session_id, generation_model, filters=None, query_embedding=None):
+    """
+    Retrieves the pages relevant to the query, as many as the generator will
+    look at. `query_embedding` is the query already encoded for the answer
+    cache, if it was.
+
+    Returns:
+        tuple: (retrieved_images relative to the static folder, shared page
+        handles or None). The caller frees the handles with
+        models.shared_pages.release_pages.
+    """
+    # Only fetch as many pages as the generator will look at
+    k = max_images_for_model(generation_model)
+    if k < RETRIEVAL_K:
+        PAGES_SKIPPED.inc(RETRIEVAL_K - k, reason='model_limit')
+    if SHARE_PAGE_BUFFERS:
+        retrieved_images, page_handles = retrieve_documents(rag_model, query, session_id, k=k, share_pages=True,
+                                                            filters=filters, query_embedding=query_embedding)
+    else:
+        retrieved_images = retrieve_documents(rag_model, query, session_id, k=k, filters=filters,
+                                              query_embedding=query_embedding)
+        page_handles = None
+    logger.info(f"Retrieved images: {retrieved_images}")
+    return retrieved_images, page_handles
+
+def generate_answer(retrieved_images, query, session_id, generation_model, resized_height, resized_width,
+                    page_handles=None, max_tokens=None, history=None, user_key=None):
+    """
+    Generates an answer from retrieved pages. `history` (from
+    models.conversation.conversation_context) is given to the generator with
+    the question. If the generator is down or slow its fallback backend may
+    answer instead (see models.failover), admitted on behalf of `user_key`.
+
+    Returns:
+        tuple: (response_text, used_images, answered_by), with image paths
+        relative to the static folder and the backend that generated the
+        answer.
+    """
+    # Generate response with full image paths
+    full_image_paths = [os.path.join(STATIC_FOLDER, img) for img in retrieved_images]
+    with span('generation'):
+        response_text, used_images, answered_by = failover.generate(
+            full_image_paths,
+            prompt_with_context(history, query),
+            session_id,
+            resized_height,
+            resized_width,
+            generation_model,
+            page_handles=page_handles,
+            max_tokens=max_tokens,
+            user_key=user_key
+        )
+
+    # Get relative paths for used images
+    relative_images = [os.path.relpath(img, STATIC_FOLDER) for img in used_images]
+    return response_text, relative_images, answered_by
+
+def answer_query(rag_model, index_version, query, session_id, generation_model='qwen',
+                 resized_height=280, resized_width=280, user_key=None, limits=None, filters=None,
+                 history=None):
+    """
+    Answers a query against a session's index, reusing the answer to an
+    earlier query with the same normalized text or a similar enough query
+    embedding (see models.answer_cache.AnswerCache) if the answer cache has
+    one. The query is encoded once for the cache and retrieval.
+    `rag_model` and `index_version` may also be the list of indexes and tuple
+    of versions returned by models.library.attach_libraries. `filters`
+    restricts retrieval to matching pages (see models.page_metadata).
+    `history` is the conversation context for follow-up questions. Questions
+    that refer back to it (see models.conversation.depends_on_history) bypass
+    the answer cache; others are cached as if asked on their own.
+
+    Cache misses go through admission control, keyed by `user_key` (the
+    session ID if not given) with the per-user `limits` from
+    users_app.profiles.get_user_limits, and raise
+    models.admission.AdmissionRejected when the user is over budget. Identical
+    requests in flight at the same time (see models.single_flight) share one
+    retrieval and generation; a waiting request whose leader was rejected by
+    admission control runs on its own instead.
+
+    Returns:
+        dict: 'retrieved_images', 'response_text', 'images' (pages used for the
+        answer, relative to the static folder), 'cache_hit' and 'model' (the
+        backend that answered; differs from `generation_model` when a
+        fallback stepped in).
+    """
+    cached = None
+    query_embedding = QueryEmbedding(query)
+    # Libraries share the session index's encoder (see models.library)
+    encoder_index = rag_model[0] if isinstance(rag_model, (list, tuple)) else rag_model
+
+    def embed():
+        return query_vector(encoder_index, query_embedding) if encoder_index is not None else None
+
+    cache_key = answer_cache.scope_key(index_version, session_id, generation_model, resized_height, resized_width,
+                                       filters)
+    # A follow-up like "and on the next page?" means something else in every conversation
+    cacheable = ANSWER_CACHE_ENABLED and not (history and depends_on_history(query))
+    if cacheable:
+        try:
+            cached = answer_cache.lookup(cache_key, query, session_id, embed)
+        except Exception as e:
+            logger.warning(f"Answer cache lookup failed: {e}")
+
+    if cached is not None:
+        similarity = f", similarity {cached['similarity']:.3f}" if 'similarity' in cached else ''
+        logger.info(f"Answer cache hit (cached query: {cached['query']}{similarity}) for query: {query}")
+        return {
+            'retrieved_images': cached['images'],
+            'response_text': cached['answer'],
+            'images': cached['images'],
+            'cache_hit': True,
+            'model': generation_model,
+        }
+
+    def answer():
+        retrieved_images, page_handles = retrieve_pages(rag_model, query, session_id, generation_model, filters,
+                                                        query_embedding)
+        try:
+            # Only generation holds a model slot; retrieval runs before queueing for one
+            with admission.admit(user_key or session_id, generation_model, **(limits or {})) as ticket:
+                response_text, relative_images, answered_by = generate_answer(
+                    retrieved_images, query, session_id, generation_model, resized_height, resized_width,
+                    page_handles=page_handles, max_tokens=ticket.max_tokens, history=history,
+                    user_key=user_key or session_id)
+                admission.settle(ticket, estimate_tokens(response_text))
+        finally:
+            # Free the shared page buffers once generation is complete
+            release_pages(page_handles)
+        # Only answers grounded in pages are worth reusing; errors come back without images.
+        # A fallback's answer is not what this model would have said.
+        if cacheable and relative_images and answered_by == generation_model:
+            try:
+                vector = embed()
+            except Exception as e:
+                logger.warning(f"Could not embed the query for the answer cache: {e}")
+                vector = None
+            answer_cache.store(cache_key, query, response_text, relative_images, vector)
+        return {
+            'retrieved_images': retrieved_images,
+            'response_text': response_text,
+            'images': relative_images,
+            'cache_hit': False,
+            'model': answered_by,
+        }
+
+    if not SINGLE_FLIGHT_ENABLED:
+        return answer()
+    # Double clicks, client retries and other tabs share one retrieval and generation
+    flight_key = cache_key + (' '.join(query.split()), history or None)
+    # A rejection is about the leader's budget, not this user's
+    result, shared = single_flight.run(flight_key, answer, private_errors=(AdmissionRejected,))
+    if shared:
+        # The leader may be another session (ANSWER_CACHE_SCOPE=index); keep its pages alive for this one
+        page_ids = [page_id_from_path(img) for img in set(result['retrieved_images']) | set(result['images'])]
+        if not all(page_id and reference_page(page_id, session_id) for page_id in page_ids):
+            logger.info(f"Pages of an identical request were collected; answering again: {query}")
+            return answer()
+        logger.info(f"Reused the answer of an identical request in flight for query: {query}")
+    return dict(result)
@@ -0,0 +1,72 @@
+# models/resize_cache.py
+
+import os
+import threading
+from collections import OrderedDict
+from PIL import Image
+from logger import get_logger
+from models.page_store import page_id_from_path
+from metrics import record_cache_lookup, span, Gauge
+
+logger = get_logger(__name__)
+
+# Upper bound on the raw pixel bytes held by the cache
+RESIZE_CACHE_MAX_BYTES = int(os.getenv('RESIZE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+RESIZE_CACHE_BYTES = Gauge('localgpt_resize_cache_bytes', 'Raw pixel bytes held by the resized page cache.')
+
+_cache = OrderedDict()  # (page_key, height, width) -> raw RGB bytes
+_cache_bytes = 0
+_lock = threading.Lock()
+
+def page_key(image_path):
+    """
+    Returns a stable cache key for a page. Pages from the content-addressed
+    page store are keyed by their hash; other files by path and mtime.
+    """
+    page_id = page_id_from_path(image_path)
+    if page_id:
+        return page_id
+    return f"{os.path.abspath(image_path)}:{os.path.getmtime(image_path)}"
+
+def get_resized_page(image_path, height, width, open_image=Image.open):
+    """
+    Returns the page resized to (width, height), decoding and resampling it
+    only on the first request for that page and size.
+
+    Args:
+        image_path (str): Path of the page image.
+        height (int): Target height in pixels.
+        width (int): Target width in pixels.
+        open_image (callable): Loader used on a miss, e.g. one that reads
+            from a shared-memory page buffer.
+
+    Returns:
+        PIL.Image.Image: The resized RGB page.
+    """
+    global _cache_bytes
+
+    key = (page_key(image_path), height, width)
+    with _lock:
+        data = _cache.get(key)
+        if data is not None:
+            _cache.move_to_end(key)
+    record_cache_lookup('resize', hit=data is not None)
+    if data is not None:
+        return Image.frombytes('RGB', (width, height), data)
+
+    with span('image_resize'):
+        with open_image(image_path) as image:
+            resized = image.convert('RGB').resize((width, height), resample=Image.BICUBIC)
+    data = resized.tobytes()
+
+    if len(data) <= RESIZE_CACHE_MAX_BYTES:
+        with _lock:
+            if key not in _cache:
+                _cache[key] = data
+                _cache_bytes += len(data)
+            while _cache_bytes > RESIZE_CACHE_MAX_BYTES:
+                _, evicted = _cache.popitem(last=False)
+                _cache_bytes -= len(evicted)
+            RESIZE_CACHE_BYTES.set(_cache_bytes)
+    return resized
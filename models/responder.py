@@ -1,7 +1,12 @@
 # models/responder.py
 
-from models.model_loader import load_model, is_single_image_model
-from transformers import GenerationConfig
+from models.model_loader import (load_model, max_images_for_model, check_model_configs, assistant_model_for,
+                                 vision_cache_namespace)
+from models.model_config import model_configs
+from models.shared_pages import page_image
+from models.resize_cache import get_resized_page, page_key
+from models.vision_cache import page_keys, timed_generation
+from transformers import GenerationConfig, StoppingCriteria, StoppingCriteriaList
 import google.generativeai as genai
 from dotenv import load_dotenv
 from logger import get_logger
@@ -18,18 +23,123 @@ import ollama
 
 logger = get_logger(__name__)
 
+# Seconds a remote API call (gpt4, gemini, groq-llama-vision) may take before it fails
+REMOTE_TIMEOUT = float(os.getenv('REMOTE_TIMEOUT', 120))
+
 # Function to encode the image
 def encode_image(image_path):
   with open(image_path, "rb") as image_file:
     return base64.b64encode(image_file.read()).decode('utf-8')
 
-def generate_response(images, query, session_id, resized_height=280, resized_width=280, model_choice='qwen'):
+def open_image(image_path, page_handles_by_path=None):
+    """
+    Opens a page image, building it from its shared-memory buffer when a
+    handle is available instead of decoding the file from disk.
+    """
+    handle = (page_handles_by_path or {}).get(image_path)
+    if handle is not None:
+        return page_image(handle)
+    return Image.open(image_path)
+
+class GenerationCancelled(Exception):
+    """Raised when a local generation was stopped through its stop event."""
+
+class StopOnEvent(StoppingCriteria):
+    """Ends a local generation at the next token once `event` is set."""
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+def with_stop_event(params, stop_event):
+    """Adds a stopping criterion for `stop_event` to a transformers generate call's parameters."""
+    if stop_event is None:
+        return params
+    return dict(params, stopping_criteria=StoppingCriteriaList([StopOnEvent(stop_event)]))
+
+def check_stopped(model_choice, stop_event):
+    # A stopped generation ends early; its truncated text is not an answer
+    if stop_event is not None and stop_event.is_set():
+        raise GenerationCancelled(f"Generation with '{model_choice}' was stopped.")
+
+def generation_kwargs(model_choice, length_key, max_tokens=None):
+    """
+    Returns the model's configured generation parameters with the output
+    length (`length_key`) capped at the caller's token budget.
+    """
+    params = dict(model_configs.generation_params(model_choice))
+    if max_tokens:
+        params[length_key] = min(params[length_key], max_tokens) if length_key in params else max_tokens
+    return params
+
+def qwen_inputs(processor, images, query, resized_height, resized_width, page_handles_by_path=None):
+    """
+    Builds the Qwen2-VL chat prompt and processor inputs for a query over
+    page images.
+
+    Returns:
+        tuple: (processor inputs, resized_height, resized_width), with the
+        dimensions snapped to what Qwen accepts.
+    """
+    from qwen_vl_utils import smart_resize
+    # Ensure dimensions are multiples of 28 and within Qwen's pixel limits
+    resized_height = (resized_height // 28) * 28
+    resized_width = (resized_width // 28) * 28
+    resized_height, resized_width = smart_resize(resized_height, resized_width)
+
+    image_contents = []
+    image_inputs = []
+    for image in images:
+        image_contents.append({
+            "type": "image",
+            "image": image,  # Use the full path
+            "resized_height": resized_height,
+            "resized_width": resized_width
+        })
+        # Resized pages are cached, so repeat pages skip decode and resampling
+        image_inputs.append(get_resized_page(
+            image, resized_height, resized_width,
+            open_image=lambda path: open_image(path, page_handles_by_path)
+        ))
+    messages = [
+        {
+            "role": "user",
+            "content": image_contents + [{"type": "text", "text": query}],
+        }
+    ]
+    text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    inputs = processor(
+        text=[text],
+        images=image_inputs,
+        videos=None,
+        padding=True,
+        return_tensors="pt",
+    )
+    return inputs, resized_height, resized_width
+
+def with_assistant(model, params):
+    """Adds the model's draft model, if one is loaded, for assisted (speculative) decoding."""
+    assistant = assistant_model_for(model)
+    if assistant is not None:
+        params = dict(params, assistant_model=assistant)
+    return params
+
+def generate_response(images, query, session_id, resized_height=280, resized_width=280, model_choice='qwen', page_handles=None, max_tokens=None, raise_errors=False, stop_event=None):
     """
     Generates a response using the selected model based on the query and images.
+    If page_handles is given, page_handles[i] is the shared-memory handle for
+    images[i] and local models read pixels from it rather than from disk.
+    max_tokens, if given, caps the number of tokens generated.
+    Backend errors come back as the response text unless raise_errors is set
+    (see models.failover). Setting stop_event (a threading.Event) ends a local
+    transformers generation early with GenerationCancelled.
     Returns: (response_text, used_images)
     """
     try:
         logger.info(f"Generating response using model '{model_choice}'.")
+        check_model_configs()
         
         # Convert resized_height and resized_width to integers
         resized_height = int(resized_height)
@@ -37,6 +147,7 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
         
         # Ensure images are full paths
         full_image_paths = [os.path.join('static', img) if not img.startswith('static') else img for img in images]
+        page_handles_by_path = dict(zip(full_image_paths, page_handles or []))
         
         # Check if any valid images exist
         valid_images = [img for img in full_image_paths if os.path.exists(img)]
@@ -45,44 +156,25 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
             logger.warning("No valid images found for analysis.")
             return "No images could be loaded for analysis.", []
 
-        # If model only supports single image, use only the first image
-        if is_single_image_model(model_choice):
-            valid_images = [valid_images[0]]
-            logger.info(f"Model {model_choice} only supports single image, using first image only.")
+        # Retrieval already stops at the model's page limit; this guards other callers
+        max_images = max_images_for_model(model_choice)
+        if len(valid_images) > max_images:
+            valid_images = valid_images[:max_images]
+            logger.info(f"Model {model_choice} takes at most {max_images} images, using the first {max_images}.")
 
         if model_choice == 'qwen':
-            from qwen_vl_utils import process_vision_info
             # Load cached model
             model, processor, device = load_model('qwen')
-            # Ensure dimensions are multiples of 28
-            resized_height = (resized_height // 28) * 28
-            resized_width = (resized_width // 28) * 28
-
-            image_contents = []
-            for image in valid_images:
-                image_contents.append({
-                    "type": "image",
-                    "image": image,  # Use the full path
-                    "resized_height": resized_height,
-                    "resized_width": resized_width
-                })
-            messages = [
-                {
-                    "role": "user",
-                    "content": image_contents + [{"type": "text", "text": query}],
-                }
-            ]
-            text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-            image_inputs, video_inputs = process_vision_info(messages)
-            inputs = processor(
-                text=[text],
-                images=image_inputs,
-                videos=video_inputs,
-                padding=True,
-                return_tensors="pt",
-            )
+            inputs, resized_height, resized_width = qwen_inputs(
+                processor, valid_images, query, resized_height, resized_width, page_handles_by_path)
             inputs = inputs.to(device)
-            generated_ids = model.generate(**inputs, max_new_tokens=128)
+            # Pages already encoded at this size skip the vision tower
+            namespace = vision_cache_namespace(model)
+            keys = [(namespace, page_key(image), resized_height, resized_width) for image in valid_images]
+            params = with_assistant(model, generation_kwargs('qwen', 'max_new_tokens', max_tokens))
+            with timed_generation('qwen'), page_keys(keys):
+                generated_ids = model.generate(**inputs, **with_stop_event(params, stop_event))
+            check_stopped('qwen', stop_event)
             generated_ids_trimmed = [
                 out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
             ]
@@ -101,7 +193,7 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
                 for img_path in valid_images:
                     if os.path.exists(img_path):
                         try:
-                            img = Image.open(img_path)
+                            img = open_image(img_path, page_handles_by_path)
                             content.append(img)
                         except Exception as e:
                             logger.error(f"Error opening image {img_path}: {e}")
@@ -111,7 +203,9 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
                 if len(content) == 1:  # Only text, no images
                     return "No images could be loaded for analysis.", []
                 
-                response = model.generate_content(content)
+                generation_config = generation_kwargs('gemini', 'max_output_tokens', max_tokens) or None
+                response = model.generate_content(content, generation_config=generation_config,
+                                                  request_options={'timeout': REMOTE_TIMEOUT})
                 
                 if response.text:
                     generated_text = response.text
@@ -122,17 +216,19 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
             
             except Exception as e:
                 logger.error(f"Error in Gemini processing: {str(e)}", exc_info=True)
+                if raise_errors:
+                    raise
                 return f"An error occurred while processing the images: {str(e)}", []
         
         elif model_choice == 'gpt4':
             api_key = os.getenv("OPENAI_API_KEY")
-            client = OpenAI(api_key=api_key)
+            client = OpenAI(api_key=api_key, timeout=REMOTE_TIMEOUT)
             
             try:
                 content = [{"type": "text", "text": query}]
                 
                 for img_path in valid_images:
-                    logger.info(f"Processing image: {img_path}")
+                    logger.debug(f"Processing image: {img_path}")
                     if os.path.exists(img_path):
                         base64_image = encode_image(img_path)
                         content.append({
@@ -148,14 +244,14 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
                     return "No images could be loaded for analysis.", []
                 
                 response = client.chat.completions.create(
-                    model="gpt-4o",
+                    model=model_configs.get('gpt4')['model_id'],
                     messages=[
                         {
                             "role": "user",
                             "content": content
                         }
                     ],
-                    max_tokens=1024
+                    **generation_kwargs('gpt4', 'max_tokens', max_tokens)
                 )
                 
                 generated_text = response.choices[0].message.content
@@ -164,6 +260,8 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
             
             except Exception as e:
                 logger.error(f"Error in GPT-4 processing: {str(e)}", exc_info=True)
+                if raise_errors:
+                    raise
                 return f"An error occurred while processing the images: {str(e)}", []
         
         elif model_choice == 'llama-vision':
@@ -174,7 +272,7 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
             # For simplicity, use the first image
             image_path = valid_images[0] if valid_images else None
             if image_path and os.path.exists(image_path):
-                image = Image.open(image_path).convert('RGB')
+                image = open_image(image_path, page_handles_by_path).convert('RGB')
             else:
                 return "No valid image found for analysis.", []
 
@@ -188,8 +286,12 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
             input_text = processor.apply_chat_template(messages, add_generation_prompt=True)
             inputs = processor(image, input_text, return_tensors="pt").to(device)
 
-            # Generate response
-            output = model.generate(**inputs, max_new_tokens=512)
+            # Generate response; a page already encoded skips the vision tower
+            key = (vision_cache_namespace(model), page_key(image_path), image.height, image.width)
+            params = generation_kwargs('llama-vision', 'max_new_tokens', max_tokens)
+            with timed_generation('llama-vision'), page_keys([key]):
+                output = model.generate(**inputs, **with_stop_event(params, stop_event))
+            check_stopped('llama-vision', stop_event)
             response = processor.decode(output[0], skip_special_tokens=True)
             return response, valid_images
         
@@ -217,7 +319,7 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
             images = encoded.images
             tokens = encoded.tokens
 
-            out_tokens, _ = generate_func([tokens], model, images=[images], max_tokens=256, temperature=0.35, eos_id=tokenizer.instruct_tokenizer.tokenizer.eos_id)
+            out_tokens, _ = generate_func([tokens], model, images=[images], **generation_kwargs('pixtral', 'max_tokens', max_tokens), eos_id=tokenizer.instruct_tokenizer.tokenizer.eos_id)
             result = tokenizer.decode(out_tokens[0])
 
             logger.info("Response generated using Pixtral model.")
@@ -230,7 +332,7 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
             for img_path in valid_images[:1]:  # Process only the first image for now
                 if os.path.exists(img_path):
                     try:
-                        img = Image.open(img_path).convert('RGB')
+                        img = open_image(img_path, page_handles_by_path).convert('RGB')
                         pil_images.append(img)
                     except Exception as e:
                         logger.error(f"Error opening image {img_path}: {e}")
@@ -258,9 +360,11 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
                 with torch.no_grad():  # Disable gradient calculation
                     output = model.generate_from_batch(
                         inputs,
-                        GenerationConfig(max_new_tokens=200, stop_strings="<|endoftext|>"),
-                        tokenizer=processor.tokenizer
+                        GenerationConfig(**generation_kwargs('molmo', 'max_new_tokens', max_tokens), stop_strings="<|endoftext|>"),
+                        tokenizer=processor.tokenizer,
+                        **with_stop_event({}, stop_event)
                     )
+                check_stopped('molmo', stop_event)
 
                 # Only get generated tokens; decode them to text
                 generated_tokens = output[0, inputs['input_ids'].size(1):]
@@ -268,8 +372,12 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
 
                 return generated_text, valid_images
 
+            except GenerationCancelled:
+                raise
             except Exception as e:
                 logger.error(f"Error in Molmo processing: {str(e)}", exc_info=True)
+                if raise_errors:
+                    raise
                 return f"An error occurred while processing the images: {str(e)}", []
             finally:
                 # Close the opened images to free up resources
@@ -305,13 +413,17 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
                             "content": content
                         }
                     ],
-                    model="llava-v1.5-7b-4096-preview",
+                    model=model_configs.get('groq-llama-vision')['model_id'],
+                    timeout=REMOTE_TIMEOUT,
+                    **generation_kwargs('groq-llama-vision', 'max_tokens', max_tokens)
                 )
                 generated_text = chat_completion.choices[0].message.content
                 logger.info("Response generated using Groq Llama Vision model.")
                 return generated_text, valid_images
             except Exception as e:
                 logger.error(f"Error in Groq Llama Vision processing: {str(e)}", exc_info=True)
+                if raise_errors:
+                    raise
                 return f"An error occurred while processing the image: {str(e)}", []
         elif model_choice == 'ollama-llama-vision':
             try:
@@ -322,8 +434,9 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
                 }
                 
                 response = ollama.chat(
-                    model='llama3.2-vision',
-                    messages=[message]
+                    model=model_configs.get('ollama-llama-vision')['model_id'],
+                    messages=[message],
+                    options=generation_kwargs('ollama-llama-vision', 'num_predict', max_tokens) or None
                 )
                 
                 logger.info("Response generated using Ollama Llama Vision model.")
@@ -331,10 +444,19 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
                 
             except Exception as e:
                 logger.error(f"Error in Ollama Llama Vision processing: {str(e)}", exc_info=True)
+                if raise_errors:
+                    raise
                 return f"An error occurred while processing the image: {str(e)}", []
         else:
             logger.error(f"Invalid model choice: {model_choice}")
             return "Invalid model selected.", []
+    except GenerationCancelled as e:
+        logger.info(str(e))
+        if raise_errors:
+            raise
+        return str(e), []
     except Exception as e:
         logger.error(f"Error generating response: {e}")
+        if raise_errors:
+            raise
         return f"An error occurred while generating the response: {str(e)}", []
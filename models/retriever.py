@@ -5,56 +5,134 @@ import os
 from PIL import Image
 from io import BytesIO
 from logger import get_logger
-import time
-import hashlib
+from metrics import Counter, Histogram, span
+from concurrent.futures import ThreadPoolExecutor
+from models.page_store import store_page
+from models.page_metadata import RETRIEVAL_SCORE_GAP, QueryEmbedding, cut_on_score_gap, visual_search
+from models.lexical import HYBRID_RETRIEVAL, hybrid_search
+from models.shared_pages import publish_page, release_pages
 
 logger = get_logger(__name__)
 
-def retrieve_documents(RAG, query, session_id, k=3):
+# Threads that search the indexes of a federated query in parallel
+RETRIEVAL_WORKERS = int(os.getenv('RETRIEVAL_WORKERS', 4))
+_search_pool = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix='retrieval')
+PAGES_DECODED = Histogram('localgpt_retrieval_pages_decoded', 'Pages decoded and stored per retrieval.',
+                          buckets=(0, 1, 2, 3, 4, 5, 8, 10, 20))
+PAGES_SKIPPED = Counter('localgpt_retrieval_pages_skipped_total',
+                        'Pages not retrieved or decoded, by reason.', labels=('reason',))
+
+def search_indexes(RAG, query, k, filters=None, score_gap=RETRIEVAL_SCORE_GAP, query_embedding=None):
+    """
+    Searches one index, or several in parallel, and returns the overall top-k.
+
+    Every index returns its own top-k, so merging them by score gives the
+    exact top-k of the union. The query is encoded once and that encoding
+    scores every index, which is why all of them must be built with the
+    same indexer model (see models.library). An index that fails is logged and
+    left out. With filters, only the matching pages of each index are scored.
+    With HYBRID_RETRIEVAL each index fuses BM25 and visual rankings first
+    (see models.lexical.hybrid_search), cutting its visual candidates at
+    `score_gap` before fusion, and results are merged by their rank-based
+    RRF scores.
+
+    Args:
+        RAG (RAGMultiModalModel or list): The index or indexes to search.
+        query (str): The user's query.
+        k (int): The number of results to return.
+        filters (dict, optional): Page filters from models.page_metadata.normalize_filters.
+        score_gap (float): Visual score drop at which hybrid retrieval stops
+            taking candidates (see cut_on_score_gap).
+        query_embedding (QueryEmbedding, optional): The query, if the caller
+            has already encoded it (e.g. for the answer cache).
+
+    Returns:
+        list: byaldi search results, best first.
+    """
+    query_embedding = query_embedding or QueryEmbedding(query)
+
+    def search(index):
+        if HYBRID_RETRIEVAL:
+            return hybrid_search(index, query, k, filters, query_embedding, score_gap)
+        return visual_search(index, query_embedding, k, filters)
+
+    if not isinstance(RAG, (list, tuple)):
+        return search(RAG)
+    if len(RAG) == 1:
+        return search(RAG[0])
+
+    futures = [_search_pool.submit(search, index) for index in RAG]
+    results = []
+    for future in futures:
+        try:
+            results.extend(future.result())
+        except Exception as e:
+            logger.error(f"Error searching one of {len(RAG)} indexes: {e}")
+    results.sort(key=lambda result: result.score, reverse=True)
+    return results[:k]
+
+def retrieve_documents(RAG, query, session_id, k=3, share_pages=False, filters=None, score_gap=None,
+                       query_embedding=None):
     """
     Retrieves relevant documents based on the user query using Byaldi.
 
     Args:
-        RAG (RAGMultiModalModel): The RAG model with the indexed documents.
+        RAG (RAGMultiModalModel or list): The RAG model with the indexed
+            documents, or several whose results are merged (see search_indexes).
         query (str): The user's query.
-        session_id (str): The session ID to store images in per-session folder.
+        session_id (str): The session ID that references the retrieved pages.
         k (int): The number of documents to retrieve.
+        share_pages (bool): Also publish the decoded pages to shared memory.
+        filters (dict, optional): Restricts the search to pages matching these
+            filters (see models.page_metadata.normalize_filters).
+        score_gap (float, optional): Visual score drop at which to stop (see
+            cut_on_score_gap); defaults to RETRIEVAL_SCORE_GAP. With
+            HYBRID_RETRIEVAL it cuts each index's visual candidates before
+            fusion, since fused scores are ranks rather than relevance.
+        query_embedding (QueryEmbedding, optional): The already encoded query.
 
     Returns:
         list: A list of image filenames corresponding to the retrieved documents.
+        If share_pages is True, a tuple (images, page_handles) is returned instead,
+        where page_handles[i] refers to the decoded pixels of images[i].
     """
+    page_handles = []
     try:
         logger.info(f"Retrieving documents for query: {query}")
-        results = RAG.search(query, k=k)
+        score_gap = RETRIEVAL_SCORE_GAP if score_gap is None else score_gap
+        with span('rag_search'):
+            results = search_indexes(RAG, query, k, filters, score_gap, query_embedding)
+        # Pages past a clear drop in visual relevance are never decoded or stored
+        kept = results if HYBRID_RETRIEVAL else cut_on_score_gap(results, score_gap)
+        if len(kept) < len(results):
+            PAGES_SKIPPED.inc(len(results) - len(kept), reason='score_gap')
+            logger.info(f"Score gap cut retrieval from {len(results)} to {len(kept)} pages.")
+        results = kept
         images = []
-        session_images_folder = os.path.join('static', 'images', session_id)
-        os.makedirs(session_images_folder, exist_ok=True)
-        
+
         for i, result in enumerate(results):
             if result.base64:
-                image_data = base64.b64decode(result.base64)
-                image = Image.open(BytesIO(image_data))
-                
-                # Generate a unique filename based on the image content
-                image_hash = hashlib.md5(image_data).hexdigest()
-                image_filename = f"retrieved_{image_hash}.png"
-                image_path = os.path.join(session_images_folder, image_filename)
-                
-                if not os.path.exists(image_path):
-                    image.save(image_path, format='PNG')
-                    logger.debug(f"Retrieved and saved image: {image_path}")
-                else:
-                    logger.debug(f"Image already exists: {image_path}")
-                
-                # Store the relative path from the static folder
-                relative_path = os.path.join('images', session_id, image_filename)
+                with span('image_decode_save'):
+                    image_data = base64.b64decode(result.base64)
+                    image = Image.open(BytesIO(image_data))
+
+                    # Pages are stored once across sessions, keyed by content hash
+                    page_id, relative_path = store_page(image_data, image, session_id)
                 images.append(relative_path)
-                logger.info(f"Added image to list: {relative_path}")
+                if share_pages:
+                    page_handles.append(publish_page(image))
+                logger.debug(f"Added image to list: {relative_path}")
             else:
                 logger.warning(f"No base64 data for document {result.doc_id}, page {result.page_num}")
         
+        PAGES_DECODED.observe(len(images))
         logger.info(f"Total {len(images)} documents retrieved. Image paths: {images}")
+        if share_pages:
+            return images, page_handles
         return images
     except Exception as e:
         logger.error(f"Error retrieving documents: {e}")
+        if share_pages:
+            release_pages(page_handles)
+            return [], []
         return []
\ No newline at end of file
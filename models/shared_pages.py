@@ -0,0 +1,124 @@
+# models/shared_pages.py
+
+import atexit
+import threading
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+import numpy as np
+from PIL import Image
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Shared-memory blocks owned by this process: name -> [SharedMemory, refcount]
+_owned_blocks = {}
+_owned_lock = threading.Lock()
+
+def _attach(name):
+    """
+    Attaches to an existing shared-memory block without registering it with
+    this process's resource tracker, so a consumer exiting does not unlink
+    a block that the producer still owns.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no `track` argument
+        return shared_memory.SharedMemory(name=name)
+
+def publish_page(image):
+    """
+    Copies the decoded pixels of a page into a new shared-memory block.
+
+    Args:
+        image (PIL.Image.Image): The decoded page image.
+
+    Returns:
+        dict: A picklable handle (block name, width, height, mode) that can be
+        passed to another process instead of the encoded image.
+    """
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    width, height = image.size
+    size = width * height * 3
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    pixels = np.ndarray((height, width, 3), dtype=np.uint8, buffer=shm.buf)
+    pixels[:] = np.asarray(image)
+    del pixels
+    with _owned_lock:
+        _owned_blocks[shm.name] = [shm, 1]
+    logger.debug(f"Published page {width}x{height} to shared memory block {shm.name}")
+    return {'shm_name': shm.name, 'width': width, 'height': height, 'mode': 'RGB'}
+
+def acquire_page(handle):
+    """Adds a reference to a block owned by this process."""
+    with _owned_lock:
+        entry = _owned_blocks.get(handle['shm_name'])
+        if entry is None:
+            raise KeyError(f"Shared page {handle['shm_name']} is not owned by this process")
+        entry[1] += 1
+
+def release_page(handle):
+    """
+    Drops a reference to a block owned by this process. The block is closed
+    and unlinked once the last reference is released.
+    """
+    with _owned_lock:
+        entry = _owned_blocks.get(handle['shm_name'])
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _owned_blocks[handle['shm_name']]
+    shm = entry[0]
+    try:
+        shm.close()
+        shm.unlink()
+        logger.debug(f"Released shared memory block {handle['shm_name']}")
+    except FileNotFoundError:
+        pass
+
+def release_pages(handles):
+    """Releases every handle in `handles`; safe to call with None."""
+    for handle in handles or []:
+        release_page(handle)
+
+@contextmanager
+def open_page(handle):
+    """
+    Maps a shared page and yields a read-only (height, width, 3) uint8 array
+    backed directly by the shared buffer. The array must not be used after
+    the context exits; wrap it with `torch.from_numpy` for a zero-copy tensor.
+    """
+    with _owned_lock:
+        entry = _owned_blocks.get(handle['shm_name'])
+    shm = entry[0] if entry else _attach(handle['shm_name'])
+    pixels = np.ndarray((handle['height'], handle['width'], 3), dtype=np.uint8, buffer=shm.buf)
+    pixels.flags.writeable = False
+    try:
+        yield pixels
+    finally:
+        del pixels
+        if entry is None:
+            shm.close()
+
+def page_image(handle):
+    """
+    Builds a PIL image from a shared page. The pixels are copied once out of
+    the shared buffer so the image stays valid after the block is released.
+    """
+    with open_page(handle) as pixels:
+        return Image.fromarray(pixels)
+
+@atexit.register
+def _cleanup_owned_blocks():
+    with _owned_lock:
+        blocks = list(_owned_blocks.values())
+        _owned_blocks.clear()
+    for shm, _ in blocks:
+        try:
+            shm.close()
+            shm.unlink()
+        except Exception:
+            pass
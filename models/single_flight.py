@@ -0,0 +1,235 @@
+# models/single_flight.py
+
+import hashlib
+import json
+import os
+import threading
+import time
+from logger import get_logger
+from metrics import Counter
+
+try:
+    import fcntl
+except ImportError:  # Windows: requests are only coalesced within a process
+    fcntl = None
+
+logger = get_logger(__name__)
+
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Folder for the lock and result files shared by worker processes (unset: coalesce within a process only)
+SINGLE_FLIGHT_LOCK_DIR = os.getenv('SINGLE_FLIGHT_LOCK_DIR')
+# Longest a duplicate request waits for the one in flight before running itself
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', 300))
+# Result and lock files older than this are deleted when the next flight finishes
+SINGLE_FLIGHT_RESULT_TTL = float(os.getenv('SINGLE_FLIGHT_RESULT_TTL', 60))
+
+COALESCED = Counter('localgpt_coalesced_requests_total',
+                    'Requests answered with the result of an identical request already in flight.',
+                    labels=('scope',))
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+def _is_current(lock_file, lock_path):
+    """Whether `lock_file` is still the file at `lock_path`, not one unlinked by an expiry sweep."""
+    try:
+        path_stat, file_stat = os.stat(lock_path), os.fstat(lock_file.fileno())
+    except FileNotFoundError:
+        return False
+    return (path_stat.st_dev, path_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino)
+
+class SingleFlight:
+    """
+    Runs one call per key at a time and hands its result to identical calls
+    that arrive while it is in flight. Callers in the same process wait on
+    the leader thread; with `lock_dir`, callers in other worker processes
+    wait on a lock file and read the leader's result from a file next to it.
+    """
+
+    def __init__(self, lock_dir=SINGLE_FLIGHT_LOCK_DIR, timeout=SINGLE_FLIGHT_TIMEOUT,
+                 result_ttl=SINGLE_FLIGHT_RESULT_TTL):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.timeout = timeout
+        self.result_ttl = result_ttl
+        self._calls = {}  # key -> _Call
+        self._lock = threading.Lock()
+        if lock_dir and fcntl is None:
+            logger.warning("File locks are not available on this platform; requests are coalesced per process only.")
+
+    def run(self, key, fn, private_errors=()):
+        """
+        Calls `fn()` unless an identical call is in flight, in which case its
+        result is returned (or its exception raised) instead.
+
+        Args:
+            key (tuple): Identifies identical calls; its repr must be stable
+                across processes.
+            fn (callable): Computes the result. With a lock folder the result
+                must be JSON-serializable.
+            private_errors (tuple): Exception types that only concern the
+                caller that raised them (e.g. its user's rate limit). Callers
+                waiting on such a call run `fn()` themselves instead.
+
+        Returns:
+            tuple: (result, True if it came from another call).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+
+        if not leader:
+            if call.done.wait(self.timeout):
+                COALESCED.inc(scope='thread')
+                if isinstance(call.error, private_errors):
+                    return fn(), False
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            logger.warning(f"Gave up waiting {self.timeout:.0f}s for an identical request; running it again.")
+            return fn(), False
+
+        shared = False
+        try:
+            if self.lock_dir:
+                call.result, shared = self._run_across_processes(key, fn)
+            else:
+                call.result = fn()
+            return call.result, shared
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.followers:
+                logger.info(f"Answered {call.followers} identical in-flight requests with one result.")
+            call.done.set()
+
+    def _paths(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.lock_dir, f"{digest}.lock"), os.path.join(self.lock_dir, f"{digest}.json")
+
+    def _read_result(self, result_path, since):
+        """The result written by a flight that finished after `since`, if any."""
+        try:
+            with open(result_path, encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return stored if stored.get('finished_at', 0) >= since else None
+
+    def _lock_file(self, lock_path, deadline):
+        """
+        Opens and locks the lock file at `lock_path`, waiting until `deadline`
+        (time.monotonic()) at most.
+
+        Returns:
+            file: The locked file, or None if the deadline passed.
+        """
+        while True:
+            lock_file = open(lock_path, 'a')
+            try:
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() >= deadline:
+                            lock_file.close()
+                            return None
+                        time.sleep(0.05)
+                # The file may have expired and been unlinked while this worker waited on it;
+                # locking it would not exclude workers that open the path afresh
+                if _is_current(lock_file, lock_path):
+                    return lock_file
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    def _run_across_processes(self, key, fn):
+        os.makedirs(self.lock_dir, exist_ok=True)
+        lock_path, result_path = self._paths(key)
+        started = time.time()
+        lock_file = self._lock_file(lock_path, time.monotonic() + self.timeout)
+        if lock_file is None:
+            logger.warning(f"Gave up waiting {self.timeout:.0f}s for another worker's identical "
+                           f"request; running it again.")
+            return fn(), False
+        with lock_file:
+            try:
+                # Another worker answered the same question while this one was waiting for the lock
+                stored = self._read_result(result_path, started)
+                if stored is not None:
+                    COALESCED.inc(scope='process')
+                    return stored['result'], True
+                result = fn()
+                self._write_result(result_path, result)
+                return result, False
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_result(self, result_path, result):
+        temp_path = f"{result_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'finished_at': time.time(), 'result': result}, f)
+            os.replace(temp_path, result_path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not share the result with other workers: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self._remove_expired()
+
+    def _remove_expired(self):
+        cutoff = time.time() - self.result_ttl
+        for name in os.listdir(self.lock_dir):
+            path = os.path.join(self.lock_dir, name)
+            try:
+                if name.endswith('.lock'):
+                    if os.path.getmtime(path) < cutoff:
+                        self._remove_flight(path, f"{path[:-len('.lock')]}.json", cutoff)
+                elif name.endswith('.json'):
+                    if not os.path.exists(f"{path[:-len('.json')]}.lock") and os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                elif name.endswith('.tmp') and os.path.getmtime(path) < cutoff:
+                    # Left by a worker that died while writing its result
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _remove_flight(self, lock_path, result_path, cutoff):
+        """
+        Deletes an expired flight's result and lock file together while
+        holding its lock. Flights in progress hold the lock and are skipped;
+        workers that opened the lock file before it was unlinked notice when
+        they lock it (see _lock_file) and start over on a new one.
+        """
+        with open(lock_path, 'rb') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                if not _is_current(lock_file, lock_path):
+                    return
+                # A flight may have finished between the listing and the lock
+                if os.path.exists(result_path) and os.path.getmtime(result_path) >= cutoff:
+                    return
+                for path in (result_path, lock_path):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+single_flight = SingleFlight()
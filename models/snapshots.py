@@ -0,0 +1,434 @@
+# models/snapshots.py
+
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+import weakref
+from collections import deque
+from collections.abc import MutableMapping
+import srsly
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from byaldi import RAGMultiModalModel
+from models.lexical import PAGE_TEXT_FILE
+from logger import get_logger
+from metrics import span, Histogram
+
+logger = get_logger(__name__)
+
+# Snapshots of indexes and model weights, built with `python manage.py build_snapshots`
+SNAPSHOT_ROOT = os.path.abspath(os.getenv('SNAPSHOT_ROOT', '.snapshots'))
+# Load indexes and models from an up-to-date snapshot when there is one
+WARM_START = os.getenv('WARM_START', 'true').lower() in ('1', 'true', 'yes')
+SNAPSHOT_FORMAT = 1
+
+MANIFEST_FILE = 'snapshot.json'
+TENSORS_FILE = 'embeddings.safetensors'
+COLLECTION_FILE = 'collection.bin'
+
+LOAD_SECONDS = Histogram('localgpt_load_seconds', 'Time to load an index, encoder or model by where it was read from.',
+                         labels=('kind', 'source'), buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+
+_load_report = deque(maxlen=1000)  # (kind, name, source, seconds) of every load in this process
+
+def record_load(kind, name, source, seconds):
+    """Records how long an index ('index'), indexer ('encoder') or generation model ('model') took to load."""
+    LOAD_SECONDS.observe(seconds, kind=kind, source=source)
+    _load_report.append((kind, name, source, seconds))
+
+def load_report():
+    """Returns the loads recorded so far as dicts, slowest first."""
+    return [{'kind': kind, 'name': name, 'source': source, 'seconds': round(seconds, 3)}
+            for kind, name, source, seconds in sorted(_load_report, key=lambda entry: entry[3], reverse=True)]
+
+def log_load_report(title='Startup'):
+    """Logs the time spent loading indexes and models, by kind and by where they were read from."""
+    totals = {}
+    for kind, _, source, seconds in _load_report:
+        count, total = totals.get((kind, source), (0, 0.0))
+        totals[(kind, source)] = (count + 1, total + seconds)
+    if not totals:
+        logger.info(f"{title}: nothing loaded.")
+        return
+    lines = [f"{kind} from {source}: {count} in {total:.2f}s" for (kind, source), (count, total) in sorted(totals.items())]
+    slowest = load_report()[:5]
+    lines.append("slowest: " + ', '.join(f"{entry['kind']} {entry['name']} {entry['seconds']}s" for entry in slowest))
+    logger.info(f"{title} load report: " + '; '.join(lines))
+
+def _replace_folder(tmp, folder):
+    """
+    Moves a finished snapshot into place. Processes that mapped the old files
+    keep reading them; they are only unlinked, never rewritten in place.
+    """
+    old = f"{folder}.old-{os.getpid()}"
+    if os.path.isdir(folder):
+        os.rename(folder, old)
+    os.rename(tmp, folder)
+    shutil.rmtree(old, ignore_errors=True)
+
+# Indexer weights shared by every index in the process
+
+_encoders = {}  # indexer model name -> byaldi ColPaliModel without an index
+_encoders_lock = threading.Lock()
+
+def shared_encoder(model_name):
+    """
+    Returns byaldi's model for `model_name` with no index attached, loading
+    the weights once per process. byaldi itself loads a copy of the weights
+    for every index.
+    """
+    with _encoders_lock:
+        encoder = _encoders.get(model_name)
+        if encoder is None:
+            started = time.perf_counter()
+            with span('encoder_load'):
+                # device=None lets byaldi pick CUDA, MPS or the CPU instead of assuming CUDA
+                encoder = RAGMultiModalModel.from_pretrained(model_name, device=None).model
+            record_load('encoder', model_name, 'hub', time.perf_counter() - started)
+            _encoders[model_name] = encoder
+        return encoder
+
+def _index_model(encoder, index_root, index_name=None, state=None):
+    """
+    Builds a RAGMultiModalModel for an index around a shared encoder. The
+    attributes are the ones byaldi's own loader sets.
+    """
+    state = state or {}
+    model = object.__new__(type(encoder))
+    # Weights, processor, device and settings come from the encoder
+    model.__dict__.update(encoder.__dict__)
+    embed_id_to_doc_id = state.get('embed_id_to_doc_id', {})
+    doc_ids = {int(entry['doc_id']) for entry in embed_id_to_doc_id.values()}
+    model.__dict__.update(
+        index_name=index_name,
+        index_root=index_root,
+        load_from_index=bool(state),
+        full_document_collection=state.get('full_document_collection', False),
+        resize_stored_images=state.get('resize_stored_images', False),
+        max_image_width=state.get('max_image_width'),
+        max_image_height=state.get('max_image_height'),
+        collection=state.get('collection', {}),
+        indexed_embeddings=state.get('embeddings', []),
+        embed_id_to_doc_id=embed_id_to_doc_id,
+        doc_ids_to_file_names=state.get('doc_ids_to_file_names', {}),
+        doc_id_to_metadata=state.get('doc_id_to_metadata', {}),
+        highest_doc_id=max(doc_ids) if doc_ids else -1,
+        doc_ids=doc_ids,
+    )
+    RAG = RAGMultiModalModel()
+    RAG.model = model
+    return RAG
+
+def empty_index(model_name, index_root='.byaldi'):
+    """Returns a RAGMultiModalModel with no pages yet that shares the process's encoder weights."""
+    return _index_model(shared_encoder(model_name), index_root)
+
+# Index snapshots
+
+_snapshot_backed = weakref.WeakSet()  # byaldi models whose pages are mapped from a snapshot
+
+class SnapshotCollection(MutableMapping):
+    """
+    The stored page images of an index, read from the memory-mapped snapshot
+    when a page is asked for. Pages added later are kept in memory.
+    """
+
+    def __init__(self, path, embed_ids, offsets):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b''
+        self._positions = {embed_id: (offsets[i], offsets[i + 1]) for i, embed_id in enumerate(embed_ids)}
+        self._added = {}
+        self._removed = set()
+
+    def __getitem__(self, embed_id):
+        if embed_id in self._added:
+            return self._added[embed_id]
+        if embed_id in self._removed or embed_id not in self._positions:
+            raise KeyError(embed_id)
+        start, end = self._positions[embed_id]
+        return self._map[start:end].decode('ascii')
+
+    def __setitem__(self, embed_id, value):
+        if embed_id in self._positions:
+            # The mapped page is shadowed by the new value
+            self._removed.add(embed_id)
+        self._added[embed_id] = value
+
+    def __delitem__(self, embed_id):
+        if embed_id in self._added:
+            del self._added[embed_id]
+        elif embed_id in self._positions and embed_id not in self._removed:
+            self._removed.add(embed_id)
+        else:
+            raise KeyError(embed_id)
+
+    def __iter__(self):
+        for embed_id in self._positions:
+            if embed_id not in self._removed:
+                yield embed_id
+        yield from self._added
+
+    def __len__(self):
+        # byaldi checks the collection's truth value on every search
+        return len(self._positions) - len(self._removed) + len(self._added)
+
+def index_snapshot_path(index_path):
+    index_path = os.path.realpath(index_path)
+    digest = hashlib.sha1(index_path.encode()).hexdigest()[:12]
+    return os.path.join(SNAPSHOT_ROOT, 'indexes', f"{os.path.basename(index_path)}-{digest}")
+
+def index_fingerprint(index_path):
+    """
+    Identifies the current contents of a byaldi index folder. byaldi rewrites
+    its files whenever pages are added, which changes the fingerprint.
+    """
+    entries = []
+    for root, _, files in os.walk(index_path):
+        for name in files:
+            if name == PAGE_TEXT_FILE:
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            entries.append(f"{os.path.relpath(path, index_path)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1('\n'.join(sorted(entries)).encode()).hexdigest()
+
+def index_model_name(index_path):
+    """The indexer model a byaldi index folder was built with, or None if there is no index."""
+    config_path = os.path.join(index_path, 'index_config.json.gz')
+    if not os.path.exists(config_path):
+        return None
+    return srsly.read_gzip_json(config_path)['model_name']
+
+def read_index_files(index_path):
+    """
+    Reads a byaldi index folder the way byaldi's from_index does, without
+    loading the encoder.
+
+    Returns:
+        dict: The index state ('model_name', 'embeddings', 'collection',
+        'embed_id_to_doc_id', 'doc_ids_to_file_names', 'doc_id_to_metadata'
+        and the index_config settings).
+    """
+    config = srsly.read_gzip_json(os.path.join(index_path, 'index_config.json.gz'))
+    state = {
+        'model_name': config['model_name'],
+        'full_document_collection': config.get('full_document_collection', False),
+        'resize_stored_images': config.get('resize_stored_images', False),
+        'max_image_width': config.get('max_image_width'),
+        'max_image_height': config.get('max_image_height'),
+        'collection': {},
+        'embeddings': [],
+    }
+    if state['full_document_collection']:
+        collection_path = os.path.join(index_path, 'collection')
+        for name in sorted(os.listdir(collection_path), key=lambda name: int(name.split('.')[0])):
+            if name.endswith('.json.gz'):
+                chunk = srsly.read_gzip_json(os.path.join(collection_path, name))
+                state['collection'].update({int(k): v for k, v in chunk.items()})
+
+    embeddings_path = os.path.join(index_path, 'embeddings')
+    files = [name for name in os.listdir(embeddings_path) if name.startswith('embeddings_') and name.endswith('.pt')]
+    for name in sorted(files, key=lambda name: int(name[len('embeddings_'):-len('.pt')])):
+        state['embeddings'].extend(torch.load(os.path.join(embeddings_path, name), map_location='cpu'))
+
+    embed_id_to_doc_id = srsly.read_gzip_json(os.path.join(index_path, 'embed_id_to_doc_id.json.gz'))
+    state['embed_id_to_doc_id'] = {int(k): v for k, v in embed_id_to_doc_id.items()}
+    for key, file_name in (('doc_ids_to_file_names', 'doc_ids_to_file_names.json.gz'),
+                           ('doc_id_to_metadata', 'metadata.json.gz')):
+        path = os.path.join(index_path, file_name)
+        state[key] = {int(k): v for k, v in srsly.read_gzip_json(path).items()} if os.path.exists(path) else {}
+    return state
+
+def build_index_snapshot(index_path, force=False):
+    """
+    Writes a snapshot of a byaldi index: the page embeddings concatenated in
+    one safetensors file, the stored page images in one flat file, and the
+    id maps as plain JSON. All of it loads with mmap, without unpickling
+    or decompressing.
+
+    Args:
+        index_path (str): The byaldi index folder.
+        force (bool): Rebuild even if the snapshot is up to date.
+
+    Returns:
+        tuple: (snapshot folder, seconds to read the byaldi files, or None if
+        the snapshot was already up to date).
+    """
+    index_path = os.path.abspath(index_path)
+    folder = index_snapshot_path(index_path)
+    # Taken before reading, so pages added meanwhile leave the snapshot stale rather than wrong
+    fingerprint = index_fingerprint(index_path)
+    if not force and _read_manifest(folder, fingerprint) is not None:
+        return folder, None
+
+    started = time.perf_counter()
+    state = read_index_files(index_path)
+    read_seconds = time.perf_counter() - started
+    embeddings = state['embeddings']
+    if not embeddings:
+        raise ValueError(f"Index {index_path} has no pages.")
+
+    tmp = f"{folder}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    sizes = [embedding.shape[0] for embedding in embeddings]
+    collection_ids = sorted(state['collection'])
+    collection_offsets = [0]
+    with open(os.path.join(tmp, COLLECTION_FILE), 'wb') as f:
+        for embed_id in collection_ids:
+            data = state['collection'][embed_id].encode('ascii')
+            f.write(data)
+            collection_offsets.append(collection_offsets[-1] + len(data))
+    save_file({
+        'embeddings': torch.cat([embedding.reshape(size, -1) for embedding, size in zip(embeddings, sizes)]),
+        'offsets': torch.tensor([0] + sizes, dtype=torch.int64).cumsum(0),
+        'collection_ids': torch.tensor(collection_ids, dtype=torch.int64),
+        'collection_offsets': torch.tensor(collection_offsets, dtype=torch.int64),
+    }, os.path.join(tmp, TENSORS_FILE))
+
+    manifest = {key: value for key, value in state.items() if key not in ('embeddings', 'collection')}
+    manifest.update(format=SNAPSHOT_FORMAT, source=fingerprint, index_path=index_path,
+                    pages=len(embeddings), created_at=time.time())
+    with open(os.path.join(tmp, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+    _replace_folder(tmp, folder)
+    return folder, read_seconds
+
+def _read_manifest(folder, fingerprint):
+    try:
+        with open(os.path.join(folder, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('format') != SNAPSHOT_FORMAT or manifest.get('source') != fingerprint:
+        return None
+    return manifest
+
+def read_index_snapshot(index_path):
+    """
+    Maps an index's snapshot into memory. Pages are read from disk when a
+    search first touches them.
+
+    Returns:
+        dict: The index state as from read_index_files, or None if there is
+        no snapshot or the index changed since it was taken.
+    """
+    folder = index_snapshot_path(index_path)
+    manifest = _read_manifest(folder, index_fingerprint(index_path))
+    if manifest is None:
+        return None
+    tensors = {}
+    # safe_open maps the file; each tensor is a view into the mapping
+    with safe_open(os.path.join(folder, TENSORS_FILE), framework='pt') as f:
+        for name in f.keys():
+            tensors[name] = f.get_tensor(name)
+    offsets = tensors['offsets'].tolist()
+    sizes = [end - start for start, end in zip(offsets, offsets[1:])]
+    state = {key: value for key, value in manifest.items()
+             if key not in ('format', 'source', 'index_path', 'pages', 'created_at')}
+    state['embeddings'] = list(torch.split(tensors['embeddings'], sizes))
+    state['collection'] = SnapshotCollection(os.path.join(folder, COLLECTION_FILE),
+                                             tensors['collection_ids'].tolist(),
+                                             tensors['collection_offsets'].tolist())
+    for key in ('embed_id_to_doc_id', 'doc_ids_to_file_names', 'doc_id_to_metadata'):
+        state[key] = {int(k): v for k, v in state[key].items()}
+    return state
+
+def load_index(index_path):
+    """
+    Loads a byaldi index, from its snapshot if it is up to date and from the
+    byaldi files otherwise. Either way the indexer weights are shared with
+    every other index of the same model in the process.
+
+    Args:
+        index_path (str): The byaldi index folder.
+
+    Returns:
+        RAGMultiModalModel: The loaded index.
+    """
+    index_path = os.path.abspath(index_path)
+    name = os.path.basename(index_path)
+    started = time.perf_counter()
+    state = None
+    if WARM_START:
+        try:
+            state = read_index_snapshot(index_path)
+        except Exception as e:
+            logger.warning(f"Snapshot of index '{name}' could not be read, loading the byaldi files: {e}")
+    source = 'snapshot' if state is not None else 'byaldi'
+    if state is None:
+        state = read_index_files(index_path)
+    seconds = time.perf_counter() - started
+
+    RAG = _index_model(shared_encoder(state['model_name']), os.path.dirname(index_path), name, state)
+    if source == 'snapshot':
+        _snapshot_backed.add(RAG.model)
+    record_load('index', name, source, seconds)
+    return RAG
+
+def detach_snapshot(RAG):
+    """
+    Copies a snapshot-backed index into memory before pages are added. byaldi
+    re-saves every page on each write, and a view into the mapped snapshot
+    would save the whole mapping with it.
+    """
+    model = RAG.model
+    if model not in _snapshot_backed:
+        return
+    model.indexed_embeddings = [embedding.clone() for embedding in model.indexed_embeddings]
+    model.collection = dict(model.collection.items())
+    _snapshot_backed.discard(model)
+
+# Generation model snapshots
+
+def model_snapshot_path(model_id, dtype):
+    return os.path.join(SNAPSHOT_ROOT, 'models', model_id.replace('/', '--'), str(dtype or 'auto'))
+
+def model_source(model_id, dtype):
+    """
+    Returns the snapshot folder of a model's weights in `dtype` if there is
+    one, else `model_id`, for passing to from_pretrained.
+    """
+    if not WARM_START or not model_id:
+        return model_id
+    folder = model_snapshot_path(model_id, dtype)
+    try:
+        with open(os.path.join(folder, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return model_id
+    if manifest.get('format') != SNAPSHOT_FORMAT or manifest.get('model_id') != model_id:
+        return model_id
+    return folder
+
+def build_model_snapshot(model_class, processor_class, model_id, dtype, force=False):
+    """
+    Saves a model's weights converted to `dtype` as safetensors, with its
+    processor, so later loads read them without conversion.
+
+    Returns:
+        str: The snapshot folder, or None if it was already built.
+    """
+    folder = model_snapshot_path(model_id, dtype)
+    if not force and model_source(model_id, dtype) == folder:
+        return None
+    torch_dtype = 'auto' if dtype in (None, 'auto') else getattr(torch, dtype)
+    # Converted on the CPU so building does not need room on the GPU next to the serving models
+    model = model_class.from_pretrained(model_id, torch_dtype=torch_dtype, device_map='cpu', low_cpu_mem_usage=True)
+    processor = processor_class.from_pretrained(model_id)
+    tmp = f"{folder}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    model.save_pretrained(tmp, safe_serialization=True)
+    processor.save_pretrained(tmp)
+    with open(os.path.join(tmp, MANIFEST_FILE), 'w') as f:
+        json.dump({'format': SNAPSHOT_FORMAT, 'model_id': model_id, 'dtype': str(dtype or 'auto'),
+                   'created_at': time.time()}, f)
+    os.makedirs(os.path.dirname(folder), exist_ok=True)
+    _replace_folder(tmp, folder)
+    del model
+    return folder
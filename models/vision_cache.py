@@ -0,0 +1,201 @@
+# models/vision_cache.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import torch
+from logger import get_logger
+from metrics import record_cache_lookup, span, Gauge, Histogram
+
+logger = get_logger(__name__)
+
+# Upper bound on the bytes of vision-encoder outputs kept, on the model's device
+VISION_CACHE_MAX_BYTES = int(os.getenv('VISION_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+VISION_CACHE_ENABLED = os.getenv('VISION_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+VISION_CACHE_BYTES = Gauge('localgpt_vision_cache_bytes', 'Bytes of vision-encoder outputs held by the cache.')
+GENERATION_SECONDS = Histogram('localgpt_local_generation_seconds',
+                               'Local model generation latency by whether the pages were already encoded.',
+                               labels=('model', 'pages'))
+
+_local = threading.local()
+
+def _tensor_bytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (tuple, list)):
+        return sum(_tensor_bytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_tensor_bytes(v) for v in value.values())
+    return 0
+
+class VisionEncoderCache:
+    """
+    LRU cache of vision-encoder outputs keyed by (model instance, page key,
+    height, width), bounded by the bytes of the cached tensors. The model
+    instance is named by models.model_loader.vision_cache_namespace.
+    """
+
+    def __init__(self, max_bytes=VISION_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (output, bytes)
+        self._bytes = 0
+        self._retired = set()  # namespaces of replaced model instances still alive
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        record_cache_lookup('vision', hit=entry is not None)
+        return entry[0] if entry is not None else None
+
+    def put(self, key, output):
+        size = _tensor_bytes(output)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries or key[0] in self._retired:
+                return
+            self._entries[key] = (output, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+            VISION_CACHE_BYTES.set(self._bytes)
+
+    def clear(self, namespace=None):
+        """
+        Drops every entry, or those of one model instance after it was
+        replaced. The replaced instance may still be finishing requests; what
+        it encodes from then on is not cached.
+        """
+        with self._lock:
+            if namespace is not None:
+                self._retired.add(namespace)
+            for key in [k for k in self._entries if namespace is None or k[0] == namespace]:
+                self._bytes -= self._entries.pop(key)[1]
+            VISION_CACHE_BYTES.set(self._bytes)
+
+    def forget(self, namespace):
+        """Drops a namespace whose model instance was freed, and anything still cached under it."""
+        self.clear(namespace)
+        with self._lock:
+            self._retired.discard(namespace)
+
+vision_cache = VisionEncoderCache()
+
+@contextmanager
+def page_keys(keys):
+    """
+    Names the pages of the next vision-encoder call on this thread, in the
+    order their images appear in the prompt. Each key is
+    (vision_cache_namespace(model), page key, height, width).
+    """
+    _local.keys = list(keys)
+    try:
+        yield
+    finally:
+        _local.keys = None
+
+def _detached(output):
+    """A copy of a vision tower output that shares no storage or autograd graph with it."""
+    if isinstance(output, torch.Tensor):
+        return output.detach().clone()
+    if isinstance(output, (tuple, list)):
+        return type(output)(_detached(value) for value in output)
+    if isinstance(output, dict):
+        # Also rebuilds transformers ModelOutput dataclasses
+        return type(output)(**{name: _detached(value) for name, value in output.items()})
+    return output
+
+def _take_keys():
+    keys = getattr(_local, 'keys', None)
+    _local.keys = None
+    return keys
+
+def _set_outcome(hits, total):
+    _local.outcome = 'warm' if hits == total else 'cold' if hits == 0 else 'mixed'
+
+def _submodule(model, name):
+    # Newer transformers releases nest the towers under model.model
+    return getattr(model, name, None) or getattr(getattr(model, 'model', None), name, None)
+
+def install_per_image_cache(model, attribute='visual'):
+    """
+    Caches the output of a Qwen2-VL style vision tower per image. The tower
+    takes the patches of all images concatenated with a (num_images, 3)
+    grid_thw tensor and encodes each image independently, so cached images
+    are left out of the call and their outputs spliced back in order.
+    """
+    vision_tower = _submodule(model, attribute)
+    if vision_tower is None:
+        logger.warning(f"No '{attribute}' module found; vision outputs will not be cached.")
+        return
+    original = vision_tower.forward
+    merge = getattr(vision_tower, 'spatial_merge_size', 2) ** 2
+
+    def forward(pixel_values, grid_thw=None, **kwargs):
+        keys = _take_keys()
+        if not VISION_CACHE_ENABLED or keys is None or grid_thw is None or len(keys) != len(grid_thw):
+            return original(pixel_values, grid_thw=grid_thw, **kwargs)
+
+        patch_counts = [int(count) for count in grid_thw.prod(dim=1).tolist()]
+        outputs = [vision_cache.get(key) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        _set_outcome(len(keys) - len(missing), len(keys))
+        if missing:
+            starts = [sum(patch_counts[:i]) for i in range(len(patch_counts))]
+            pixels = torch.cat([pixel_values[starts[i]:starts[i] + patch_counts[i]] for i in missing])
+            with span('vision_encode'):
+                encoded = original(pixels, grid_thw=grid_thw[missing], **kwargs)
+            if not isinstance(encoded, torch.Tensor):
+                # Unknown output layout; encode everything without caching
+                return original(pixel_values, grid_thw=grid_thw, **kwargs)
+            for i, output in zip(missing, encoded.split([patch_counts[i] // merge for i in missing])):
+                # Copies, so a cached page does not keep the whole batch's output alive
+                outputs[i] = output.detach().clone()
+                vision_cache.put(keys[i], outputs[i])
+        return torch.cat(outputs)
+
+    vision_tower.forward = forward
+
+def install_whole_call_cache(model, attribute='vision_model'):
+    """
+    Caches the whole output of a vision tower call keyed by all of its pages,
+    for models such as Llama 3.2 Vision that take one image per request.
+    """
+    vision_tower = _submodule(model, attribute)
+    if vision_tower is None:
+        logger.warning(f"No '{attribute}' module found; vision outputs will not be cached.")
+        return
+    original = vision_tower.forward
+
+    def forward(*args, **kwargs):
+        keys = _take_keys()
+        if not VISION_CACHE_ENABLED or not keys:
+            return original(*args, **kwargs)
+        key = keys[0] if len(keys) == 1 else (keys[0][0], tuple(keys))
+        output = vision_cache.get(key)
+        _set_outcome(int(output is not None), 1)
+        if output is None:
+            with span('vision_encode'):
+                output = original(*args, **kwargs)
+            # A copy, as for single pages, so the cache holds no views into the call's buffers
+            output = _detached(output)
+            vision_cache.put(key, output)
+        return output
+
+    vision_tower.forward = forward
+
+@contextmanager
+def timed_generation(model_choice):
+    """Records generation latency labelled by whether the pages' encodings were cached."""
+    _local.outcome = None
+    started = time.perf_counter()
+    yield
+    outcome = getattr(_local, 'outcome', None) or 'uncached'
+    GENERATION_SECONDS.observe(time.perf_counter() - started, model=model_choice, pages=outcome)
@@ -1,3 +1,9 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import ModelConfig
+
+
+@admin.register(ModelConfig)
+class ModelConfigAdmin(admin.ModelAdmin):
+    list_display = ('name', 'model_type', 'is_active', 'updated_at')
+    list_filter = ('model_type', 'is_active')
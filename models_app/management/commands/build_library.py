@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from models.library import libraries
+
+
+class Command(BaseCommand):
+    help = "Indexes a folder of documents as a shared library that chat sessions can attach."
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help="Library name (letters, digits, '-' and '_').")
+        parser.add_argument('folder', help="Folder with the library's documents.")
+        parser.add_argument('--indexer-model', default='vidore/colpali', help="Indexer model to embed pages with.")
+
+    def handle(self, *args, **options):
+        try:
+            RAG = libraries.build(options['name'], options['folder'], options['indexer_model'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"Library '{options['name']}' indexed with {len(RAG.model.indexed_embeddings)} pages."))
@@ -0,0 +1,68 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from models.library import libraries
+from models.snapshots import build_index_snapshot, read_index_snapshot
+from models_app.processing import INDEX_FOLDER
+
+
+class Command(BaseCommand):
+    help = ("Builds warm-start snapshots of the session and library indexes, and of model weights with --model, "
+            "and reports how long each index takes to load both ways.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--index', action='append', default=[],
+                            help="Index folder to snapshot (repeatable). Default: every session and library index.")
+        parser.add_argument('--model', action='append', default=[],
+                            help="Backend whose weights to snapshot in its configured dtype, e.g. qwen (repeatable).")
+        parser.add_argument('--force', action='store_true', help="Rebuild snapshots that are up to date.")
+
+    def handle(self, *args, **options):
+        index_paths = options['index'] or self.default_indexes()
+        failed = 0
+        for index_path in index_paths:
+            name = os.path.basename(os.path.normpath(index_path))
+            try:
+                folder, byaldi_seconds = build_index_snapshot(index_path, force=options['force'])
+                started = time.perf_counter()
+                state = read_index_snapshot(index_path)
+                snapshot_seconds = time.perf_counter() - started
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"{name}: {e}")
+                continue
+            if state is None:
+                failed += 1
+                self.stderr.write(f"{name}: changed while the snapshot was written; run the command again.")
+            elif byaldi_seconds is None:
+                self.stdout.write(f"{name}: up to date ({len(state['embeddings'])} pages, "
+                                  f"loads in {snapshot_seconds:.2f}s)")
+            else:
+                self.stdout.write(f"{name}: {len(state['embeddings'])} pages, loads in {snapshot_seconds:.2f}s "
+                                  f"instead of {byaldi_seconds:.2f}s -> {folder}")
+
+        if options['model']:
+            from models.model_loader import snapshot_model
+            for model_choice in options['model']:
+                try:
+                    built = snapshot_model(model_choice, force=options['force'])
+                except Exception as e:
+                    raise CommandError(f"Snapshot of model '{model_choice}' failed: {e}")
+                for folder in built:
+                    self.stdout.write(f"{model_choice}: weights saved to {folder}")
+                if not built:
+                    self.stdout.write(f"{model_choice}: up to date")
+
+        if failed:
+            raise CommandError(f"{failed} of {len(index_paths)} index snapshots failed.")
+        self.stdout.write(self.style.SUCCESS(f"{len(index_paths)} index snapshots ready."))
+
+    def default_indexes(self):
+        paths = []
+        if os.path.isdir(INDEX_FOLDER):
+            paths.extend(os.path.join(INDEX_FOLDER, name) for name in sorted(os.listdir(INDEX_FOLDER))
+                         if os.path.isdir(os.path.join(INDEX_FOLDER, name)))
+        paths.extend(libraries.path(name) for name in libraries.available())
+        return paths
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:25
+
+import models_app.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModelConfig',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('model_type', models.CharField(max_length=255)),
+                ('config', models.JSONField()),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UploadedFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(max_length=500, storage=models_app.models.get_upload_storage, upload_to='uploads/%Y/%m/%d/')),
+                ('file_type', models.CharField(choices=[('document', 'Document'), ('image', 'Image'), ('video', 'Video'), ('audio', 'Audio')], max_length=10)),
+                ('session_id', models.CharField(blank=True, default='', max_length=64)),
+                ('original_name', models.CharField(blank=True, default='', max_length=255)),
+                ('size', models.BigIntegerField(default=0)),
+                ('content_hash', models.CharField(blank=True, default='', max_length=64)),
+                ('uploaded_at', models.DateTimeField(auto_now_add=True)),
+                ('processed', models.BooleanField(default=False)),
+                ('processing_results', models.JSONField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['processed', 'uploaded_at'], name='models_app__process_c3e2d4_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('content_hash', ''), _negated=True), fields=('session_id', 'content_hash'), name='unique_upload_per_session')],
+            },
+        ),
+    ]
@@ -1,5 +1,14 @@
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
 from django.db import models
 
+# Flask uploads are written under uploaded_documents/<session_id>/
+upload_storage = FileSystemStorage(location=settings.UPLOAD_ROOT)
+
+def get_upload_storage():
+    # A callable keeps the deployment's absolute upload path out of migrations
+    return upload_storage
+
 class UploadedFile(models.Model):
     FILE_TYPES = [
         ('document', 'Document'),
@@ -8,16 +17,36 @@ class UploadedFile(models.Model):
         ('audio', 'Audio'),
     ]
 
-    file = models.FileField(upload_to='uploads/%Y/%m/%d/')
+    file = models.FileField(upload_to='uploads/%Y/%m/%d/', storage=get_upload_storage, max_length=500)
     file_type = models.CharField(max_length=10, choices=FILE_TYPES)
+    session_id = models.CharField(max_length=64, blank=True, default='')
+    original_name = models.CharField(max_length=255, blank=True, default='')
+    size = models.BigIntegerField(default=0)
+    content_hash = models.CharField(max_length=64, blank=True, default='')
     uploaded_at = models.DateTimeField(auto_now_add=True)
     processed = models.BooleanField(default=False)
     processing_results = models.JSONField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['processed', 'uploaded_at']),
+        ]
+        constraints = [
+            # A session stores each content once; a failed upload is retried on its own row
+            models.UniqueConstraint(fields=['session_id', 'content_hash'], condition=~models.Q(content_hash=''),
+                                    name='unique_upload_per_session'),
+        ]
+
     def __str__(self):
         return f"{self.file_type}: {self.file.name}"
 
 class ModelConfig(models.Model):
+    """
+    Overrides the built-in settings of a generation backend. `model_type` names
+    the backend (e.g. 'qwen'); `config` may set model_id, dtype, device,
+    device_map, quantization ('4bit'/'8bit'), preload and generation
+    parameters. See models/model_config.py.
+    """
     name = models.CharField(max_length=255)
     model_type = models.CharField(max_length=255)
     config = models.JSONField()
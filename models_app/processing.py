@@ -0,0 +1,246 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+
+from logger import get_logger
+from metrics import span
+from models.converters import convert_to_pdf
+from models.indexer import index_file
+from models.page_metadata import upload_metadata
+
+from .models import UploadedFile
+
+logger = get_logger(__name__)
+
+INDEX_FOLDER = os.path.join(os.getcwd(), '.byaldi')
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp')
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+def upload_setting(name, default):
+    return getattr(settings, 'UPLOAD_PROCESSING', {}).get(name, default)
+
+
+def upload_status(upload):
+    """'queued', 'indexed' or 'failed'."""
+    return (upload.processing_results or {}).get('status', 'queued')
+
+
+def duplicate_of(session_id, content_hash):
+    """Returns the session's upload with the same content, if any (there is at most one)."""
+    return UploadedFile.objects.filter(session_id=session_id, content_hash=content_hash).first()
+
+
+def _claim_name(folder, filename):
+    """
+    Creates an empty file under a name not taken in `folder` and returns the
+    name. The name is claimed atomically, so concurrent uploads of files with
+    the same name never overwrite each other.
+    """
+    base, ext = os.path.splitext(filename)
+    name, counter = filename, 1
+    while True:
+        try:
+            os.close(os.open(os.path.join(folder, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return name
+        except FileExistsError:
+            name = f"{base}_{counter}{ext}"
+            counter += 1
+
+
+def save_upload(stream, filename, session_id, indexer_model='vidore/colpali', max_bytes=None, chunk_size=None):
+    """
+    Streams an upload to uploaded_documents/<session_id>/ chunk by chunk,
+    hashing it on the way, and records it as an UploadedFile.
+
+    Args:
+        stream: A file-like object with the upload's content.
+        filename (str): The sanitized file name.
+        session_id (str): The session whose index the file is added to.
+        indexer_model (str): The indexer model used if the session has no index yet.
+
+    Returns:
+        tuple: (UploadedFile, created). `created` is False when the session
+        already has a file with the same content that is indexed or still
+        queued (see upload_status); nothing is stored then. A file whose
+        earlier upload failed is queued again on the same row.
+
+    Raises:
+        UploadTooLarge: The upload exceeds UPLOAD_PROCESSING['MAX_FILE_BYTES'].
+    """
+    max_bytes = max_bytes or upload_setting('MAX_FILE_BYTES', 200 * 1024 ** 2)
+    chunk_size = chunk_size or upload_setting('CHUNK_BYTES', 1024 ** 2)
+    session_folder = os.path.join(settings.UPLOAD_ROOT, session_id)
+    os.makedirs(session_folder, exist_ok=True)
+    part_path = os.path.join(session_folder, f".{uuid.uuid4().hex}.part")
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(part_path, 'wb') as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"{filename} is larger than {max_bytes} bytes.")
+                digest.update(chunk)
+                f.write(chunk)
+
+        content_hash = digest.hexdigest()
+        existing = duplicate_of(session_id, content_hash)
+        if existing is not None and upload_status(existing) != 'failed':
+            logger.info(f"Upload {filename} duplicates {existing.original_name} in session {session_id} "
+                        f"({upload_status(existing)}); skipped.")
+            return existing, False
+
+        name = _claim_name(session_folder, filename)
+        os.replace(part_path, os.path.join(session_folder, name))
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    fields = dict(
+        file=f"{session_id}/{name}",
+        file_type='image' if name.lower().endswith(IMAGE_EXTENSIONS) else 'document',
+        original_name=filename,
+        size=size,
+        processed=False,
+        processing_results={'status': 'queued', 'indexer_model': indexer_model},
+    )
+    if existing is not None:
+        # Retry of a failed upload; only one of several concurrent retries requeues it
+        if UploadedFile.objects.filter(pk=existing.pk, processing_results__status='failed').update(**fields):
+            _remove_file(existing.file.path)
+            existing.refresh_from_db()
+            logger.info(f"File saved: {existing.file.path} ({size} bytes), retrying a failed upload")
+            return existing, True
+        upload = None
+    else:
+        try:
+            with transaction.atomic():
+                upload = UploadedFile.objects.create(session_id=session_id, content_hash=content_hash, **fields)
+        except IntegrityError:
+            # The same content was uploaded to the session concurrently (unique on session and hash)
+            upload = None
+    if upload is None:
+        _remove_file(os.path.join(session_folder, name))
+        existing = duplicate_of(session_id, content_hash)
+        logger.info(f"Upload {filename} duplicates {existing.original_name} in session {session_id} "
+                    f"({upload_status(existing)}); skipped.")
+        return existing, False
+    logger.info(f"File saved: {upload.file.path} ({size} bytes)")
+    return upload, True
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class UploadProcessor:
+    """
+    Processes UploadedFile rows on a pool of worker threads: each file is
+    converted to PDF if needed, then its pages are rendered and embedded into
+    the session's byaldi index. Files of the same session are processed one
+    at a time because they share an index; different sessions run in
+    parallel.
+
+    `indexes` maps session IDs to loaded RAG models and may be shared with a
+    caller's own registry so each index is only loaded once. Callables in
+    `listeners` are called with (session_id, RAG) after a file is indexed.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.indexes = {}
+        self.listeners = []
+        self._executor = None
+        self._session_locks = {}
+        self._lock = threading.Lock()
+
+    def _session_lock(self, session_id):
+        with self._lock:
+            return self._session_locks.setdefault(session_id, threading.Lock())
+
+    def submit(self, upload_id):
+        """Queues an UploadedFile for processing. Returns a Future of the updated row."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='upload-worker')
+        return self._executor.submit(self.process, upload_id)
+
+    def resume_pending(self):
+        """Queues every upload that was not processed, e.g. after a restart."""
+        pending = list(UploadedFile.objects.filter(processed=False).order_by('uploaded_at')
+                       .values_list('pk', flat=True))
+        for upload_id in pending:
+            self.submit(upload_id)
+        if pending:
+            logger.info(f"Resumed processing of {len(pending)} uploads.")
+        return len(pending)
+
+    def process(self, upload_id):
+        close_old_connections()
+        try:
+            upload = UploadedFile.objects.get(pk=upload_id)
+            if upload.processed:
+                return upload
+            session_id = upload.session_id
+            results = dict(upload.processing_results or {})
+            indexer_model = results.get('indexer_model', 'vidore/colpali')
+            RAG = None
+
+            with self._session_lock(session_id):
+                started = time.perf_counter()
+                timings = {}
+                try:
+                    with span('upload_convert'):
+                        convert_started = time.perf_counter()
+                        index_path = convert_to_pdf(upload.file.path)
+                        timings['convert'] = time.perf_counter() - convert_started
+                    with span('upload_index'):
+                        index_started = time.perf_counter()
+                        RAG, pages = index_file(
+                            index_path, session_id,
+                            RAG=self.indexes.get(session_id),
+                            index_path=os.path.join(INDEX_FOLDER, session_id),
+                            indexer_model=indexer_model,
+                            metadata=upload_metadata(os.path.basename(upload.file.name), upload.original_name,
+                                                     upload.uploaded_at),
+                        )
+                        timings['render_and_embed'] = time.perf_counter() - index_started
+                    self.indexes[session_id] = RAG
+                    results.update(status='indexed', pages=pages)
+                except Exception as e:
+                    logger.error(f"Processing upload {upload.original_name} failed: {e}", exc_info=True)
+                    results.update(status='failed', error=str(e))
+                timings['total'] = time.perf_counter() - started
+                results['timings'] = {stage: round(seconds, 3) for stage, seconds in timings.items()}
+
+                upload.processed = True
+                upload.processing_results = results
+                upload.save(update_fields=['processed', 'processing_results'])
+
+            if RAG is not None:
+                for listener in self.listeners:
+                    listener(session_id, RAG)
+            return upload
+        finally:
+            close_old_connections()
+
+
+upload_processor = UploadProcessor(workers=upload_setting('WORKERS', 2))
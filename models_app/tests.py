@@ -1,3 +1,860 @@
-from django.test import TestCase
+import base64
+import fcntl
+import gc
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import torch
+from byaldi.objects import Result
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from PIL import Image
+from rest_framework.test import APIClient
+
+from chat_app.models import ChatSession
+from models.admission import AdmissionController, AdmissionRejected, TokenBucket
+from models.answer_cache import AnswerCache, literal_terms, normalize_query, query_vector
+from models.conversation import conversation_context, depends_on_history
+from models.failover import CLOSED, HALF_OPEN, OPEN, BackendHealth, Failover
+from models.lexical import (PAGE_TEXT_FILE, LexicalIndex, _backfills, _lexical_indexes, lexical_index, save_page_texts,
+                            tokenize)
+from models.model_loader import _register_instance, vision_cache_namespace
+from models.page_metadata import normalize_filters, parse_page_ranges
+from models.page_store import collect_garbage, reference_page, release_session, store_page
+from models.pipeline import answer_query
+from models.responder import GenerationCancelled
+from models.retriever import cut_on_score_gap, retrieve_documents, search_indexes
+from models.single_flight import SingleFlight
+from models.snapshots import SnapshotCollection
+from models.vision_cache import VisionEncoderCache, install_whole_call_cache, page_keys, vision_cache
+
+from .models import UploadedFile
+from .processing import save_upload, upload_status
+
+
+class AnswerCacheTests(SimpleTestCase):
+    key = ('index-v1', 'session-1', 'qwen', 280, 280, None)
+    images = ['pages/ab/cd/abcd.png']
+
+    def setUp(self):
+        self.cache = AnswerCache(ttl=60, scope='session', max_entries=2)
+        patcher = mock.patch('models.answer_cache.reference_page', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rephrasing_with_filler_words_hits(self):
+        self.cache.store(self.key, "What is the total of invoice 1042?", "$310", self.images)
+        hit = self.cache.lookup(self.key, "Please, tell me: what is the total of invoice 1042", 'session-1')
+        self.assertEqual(hit['answer'], "$310")
+
+    def test_tense_is_not_filler(self):
+        self.assertNotEqual(normalize_query("What was the revenue?"), normalize_query("What is the revenue?"))
+        self.assertNotEqual(literal_terms("What was the revenue?"), literal_terms("What is the revenue?"))
+        self.assertEqual(literal_terms("What is the revenue?"), literal_terms("revenue"))
+
+    def test_similar_query_embedding_hits(self):
+        vector = torch.nn.functional.normalize(torch.tensor([1.0, 0.2, 0.0]), dim=0)
+        close = torch.nn.functional.normalize(torch.tensor([1.0, 0.25, 0.0]), dim=0)
+        far = torch.nn.functional.normalize(torch.tensor([1.0, 1.0, 0.0]), dim=0)
+        self.cache.store(self.key, "What is the total of invoice 1042?", "$310", self.images, vector)
+        hit = self.cache.lookup(self.key, "How much does invoice 1042 come to?", 'session-1', lambda: close)
+        self.assertEqual(hit['answer'], "$310")
+        self.assertGreater(hit['similarity'], 0.95)
+        self.assertIsNone(self.cache.lookup(self.key, "Who issued invoice 1042?", 'session-1', lambda: far))
+
+    def test_similar_query_with_other_literals_misses(self):
+        vector = torch.tensor([1.0, 0.0])
+        self.cache.store(self.key, "What is the total of invoice 1042?", "$310", self.images, vector)
+        self.assertIsNone(self.cache.lookup(self.key, "How much is invoice 1043?", 'session-1', lambda: vector))
+        self.assertIsNone(self.cache.lookup(self.key, "What was the total of invoice 1042?", 'session-1',
+                                            lambda: vector))
+
+    def test_query_vector_pools_only_the_query_tokens(self):
+        class Processor:
+            def process_queries(self, queries):
+                # BOS, "Query:", one ID per word, then two augmentation tokens
+                return {'input_ids': torch.tensor([[1, 2] + [10 + len(w) for w in queries[0].split()] + [0, 0]])}
+
+        model = mock.Mock(processor=Processor())
+        embedding = mock.Mock(query='invoice total')
+        # Prefix and padding rows point elsewhere; the two query tokens average to (0, 1)
+        embedding.get.return_value = torch.tensor([[5.0, 0], [5.0, 0], [-1.0, 1], [1.0, 1], [5.0, 0], [5.0, 0]])
+        vector = query_vector(mock.Mock(model=model), embedding)
+        self.assertTrue(torch.allclose(vector, torch.tensor([0.0, 1.0])))
+
+    def test_number_only_difference_misses(self):
+        self.cache.store(self.key, "What is the total of invoice 1042?", "$310", self.images)
+        self.assertIsNone(self.cache.lookup(self.key, "What is the total of invoice 1043?", 'session-1'))
+
+    def test_keyword_only_difference_misses(self):
+        self.cache.store(self.key, "What was the revenue in 2023?", "$5M", self.images)
+        self.assertIsNone(self.cache.lookup(self.key, "What was the profit in 2023?", 'session-1'))
+
+    def test_negation_and_word_order_are_kept(self):
+        self.assertNotEqual(normalize_query("pages with tables"), normalize_query("pages without tables"))
+        self.assertNotEqual(normalize_query("revenue minus cost"), normalize_query("cost minus revenue"))
+
+    def test_other_scope_misses(self):
+        self.cache.store(self.key, "total of invoice 1042", "$310", self.images)
+        other = ('index-v2',) + self.key[1:]
+        self.assertIsNone(self.cache.lookup(other, "total of invoice 1042", 'session-1'))
+
+    def test_expired_entry_misses(self):
+        self.cache.store(self.key, "total of invoice 1042", "$310", self.images)
+        with mock.patch('models.answer_cache.time.time', return_value=10 ** 12):
+            self.assertIsNone(self.cache.lookup(self.key, "total of invoice 1042", 'session-1'))
+
+    def test_entry_with_collected_page_is_dropped(self):
+        self.cache.store(self.key, "total of invoice 1042", "$310", self.images)
+        with mock.patch('models.answer_cache.reference_page', return_value=False):
+            self.assertIsNone(self.cache.lookup(self.key, "total of invoice 1042", 'session-1'))
+        self.assertIsNone(self.cache.lookup(self.key, "total of invoice 1042", 'session-1'))
+
+    def test_oldest_entries_are_evicted(self):
+        for n in range(3):
+            self.cache.store(self.key, f"total of invoice {n}", str(n), self.images)
+        self.assertIsNone(self.cache.lookup(self.key, "total of invoice 0", 'session-1'))
+        self.assertEqual(self.cache.lookup(self.key, "total of invoice 2", 'session-1')['answer'], '2')
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def test_token_bucket_refills_at_rate(self):
+        with mock.patch('models.admission.time.monotonic', return_value=100.0):
+            bucket = TokenBucket(rate=10, capacity=100)
+            self.assertEqual(bucket.try_consume(80), 0)
+            self.assertAlmostEqual(bucket.try_consume(40), 2.0)
+        with mock.patch('models.admission.time.monotonic', return_value=102.0):
+            self.assertEqual(bucket.try_consume(40), 0)
+            self.assertFalse(bucket.is_full(102.0))
+        self.assertTrue(bucket.is_full(112.0))
+
+    def test_spent_budget_is_rejected(self):
+        controller = AdmissionController(model_slots=2)
+        with controller.admit('alice', 'qwen', max_tokens=600, tokens_per_minute=1000) as ticket:
+            controller.settle(ticket, 600)
+        with self.assertRaises(AdmissionRejected) as rejected:
+            with controller.admit('alice', 'qwen', max_tokens=600, tokens_per_minute=1000):
+                pass
+        self.assertEqual(rejected.exception.reason, 'rate_limited')
+        with controller.admit('bob', 'qwen', max_tokens=600, tokens_per_minute=1000):
+            pass
+
+    def test_freed_slots_go_round_robin(self):
+        controller = AdmissionController(model_slots=1)
+        order = []
+
+        def request(user_key, name):
+            with controller.admit(user_key, 'qwen', tokens_per_minute=0):
+                order.append(name)
+
+        def queued(count):
+            with controller._condition:
+                return sum(len(q) for state in controller._users.values() for q in state.waiting.values()) == count
+
+        threads = []
+        with controller.admit('alice', 'qwen', tokens_per_minute=0):
+            for count, (user_key, name) in enumerate([('alice', 'a2'), ('alice', 'a3'), ('bob', 'b1')], 1):
+                threads.append(threading.Thread(target=request, args=(user_key, name)))
+                threads[-1].start()
+                while not queued(count):
+                    time.sleep(0.01)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, ['a2', 'b1', 'a3'])
+
+    def test_idle_users_are_evicted(self):
+        controller = AdmissionController(evict_interval=0)
+        with controller.admit('alice', 'qwen', tokens_per_minute=0):
+            self.assertIn('alice', controller._users)
+        self.assertNotIn('alice', controller._users)
+        with controller.admit('bob', 'qwen', max_tokens=100, tokens_per_minute=1000) as ticket:
+            controller.settle(ticket, 100)
+        # Kept until the spent tokens have refilled
+        self.assertIn('bob', controller._users)
+        with mock.patch('models.admission.time.monotonic', return_value=time.monotonic() + 60):
+            with controller.admit('carol', 'qwen', tokens_per_minute=0):
+                pass
+        self.assertEqual(controller._users, {})
+
+
+class SaveUploadTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        overrides = override_settings(UPLOAD_ROOT=root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.root = root
+
+    def test_same_name_gets_a_new_file(self):
+        first, _ = save_upload(io.BytesIO(b'one'), 'report.pdf', 'session-1')
+        second, _ = save_upload(io.BytesIO(b'two'), 'report.pdf', 'session-1')
+        self.assertEqual(first.file.name, 'session-1/report.pdf')
+        self.assertEqual(second.file.name, 'session-1/report_1.pdf')
+        with open(os.path.join(self.root, 'session-1', 'report.pdf'), 'rb') as f:
+            self.assertEqual(f.read(), b'one')
+
+    def test_duplicate_reports_the_original_status(self):
+        first, created = save_upload(io.BytesIO(b'same'), 'a.pdf', 'session-1')
+        self.assertTrue(created)
+        duplicate, created = save_upload(io.BytesIO(b'same'), 'b.pdf', 'session-1')
+        self.assertFalse(created)
+        self.assertEqual(duplicate.pk, first.pk)
+        self.assertEqual(upload_status(duplicate), 'queued')
+        self.assertEqual(os.listdir(os.path.join(self.root, 'session-1')), ['a.pdf'])
+
+    def test_failed_upload_is_requeued_on_its_row(self):
+        first, _ = save_upload(io.BytesIO(b'same'), 'a.pdf', 'session-1')
+        UploadedFile.objects.filter(pk=first.pk).update(processed=True, processing_results={'status': 'failed'})
+        retry, created = save_upload(io.BytesIO(b'same'), 'a.pdf', 'session-1')
+        self.assertTrue(created)
+        self.assertEqual(retry.pk, first.pk)
+        self.assertFalse(retry.processed)
+        self.assertEqual(upload_status(retry), 'queued')
+        self.assertEqual(UploadedFile.objects.count(), 1)
+
+    def test_content_is_unique_per_session(self):
+        save_upload(io.BytesIO(b'same'), 'a.pdf', 'session-1')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UploadedFile.objects.create(file='session-1/b.pdf', file_type='document', session_id='session-1',
+                                        content_hash=hashlib.sha256(b'same').hexdigest())
+        _, created = save_upload(io.BytesIO(b'same'), 'a.pdf', 'session-2')
+        self.assertTrue(created)
+
+
+class UploadListViewTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='pw')
+        self.other = User.objects.create_user('other', password='pw')
+        self.chat = ChatSession.objects.create(user=self.owner, title='Docs')
+        self.client = APIClient()
+
+    def test_other_users_session_is_not_found(self):
+        self.client.force_authenticate(self.other)
+        response = self.client.get('/api/models/uploads/', {'session_id': str(self.chat.pk)})
+        self.assertEqual(response.status_code, 404)
+        with mock.patch('models_app.views.save_upload') as save:
+            response = self.client.post('/api/models/uploads/', {'session_id': str(self.chat.pk),
+                                                                 'file': SimpleUploadedFile('a.pdf', b'x')})
+        self.assertEqual(response.status_code, 404)
+        save.assert_not_called()
+
+    def test_owner_lists_uploads(self):
+        self.client.force_authenticate(self.owner)
+        response = self.client.get('/api/models/uploads/', {'session_id': str(self.chat.pk)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'uploads': []})
+
+
+def png_base64():
+    buffer = io.BytesIO()
+    Image.new('RGB', (4, 4)).save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+PAGE_PNG = png_base64()
+
+
+class FakeProcessor:
+    @staticmethod
+    def score(queries, candidates):
+        # Each fake page embedding holds its MaxSim score
+        return torch.stack([candidate[0] for candidate in candidates])[None]
+
+
+class FakeModel:
+    """The parts of a byaldi model that retrieval reads."""
+
+    def __init__(self, doc_id, pages):
+        self.embed_id_to_doc_id = {i: {'doc_id': doc_id, 'page_id': i + 1} for i in range(pages)}
+        self.indexed_embeddings = [torch.zeros(1) for _ in range(pages)]
+        self.doc_id_to_metadata = {doc_id: {'file_name': f'doc{doc_id}.pdf'}}
+        self.doc_ids_to_file_names = {doc_id: f'doc{doc_id}.pdf'}
+        self.collection = {i: PAGE_PNG for i in range(pages)}
+        self.processor = FakeProcessor()
+        self.encoded = []
+
+    def encode_query(self, query):
+        self.encoded.append(query)
+        return torch.ones(1, 1, 1)
+
+
+class FakeIndex:
+    """An index whose visual ranking is fixed: `visual` lists (page number, MaxSim score), best first."""
+
+    def __init__(self, doc_id, visual, texts):
+        self.model = FakeModel(doc_id, len(texts))
+        for page, score in visual:
+            self.model.indexed_embeddings[page - 1] = torch.tensor([score])
+        _lexical_indexes[self.model] = LexicalIndex(dict(enumerate(texts)), len(texts))
+
+
+class HybridSearchTests(SimpleTestCase):
+    def test_indexes_without_lexical_hits_are_scored_by_rank(self):
+        # Raw MaxSim scores are in the tens; they must not outrank RRF scores of other indexes
+        visual_only = FakeIndex(0, [(1, 30.0), (2, 20.0)], ['cover page', 'contents'])
+        fused = FakeIndex(1, [(1, 15.0), (2, 14.0)], ['invoice total due', 'terms'])
+        with mock.patch('models.retriever.HYBRID_RETRIEVAL', True):
+            results = search_indexes([visual_only, fused], 'invoice total', 2)
+        self.assertEqual([(r.doc_id, r.page_num) for r in results], [(1, 1), (0, 1)])
+        self.assertTrue(all(r.score < 1 for r in results))
+
+    def test_query_is_encoded_once_for_every_index(self):
+        indexes = [FakeIndex(doc_id, [(1, 30.0 - doc_id), (2, 10.0)], ['cover', 'contents']) for doc_id in range(3)]
+        with mock.patch('models.retriever.HYBRID_RETRIEVAL', False):
+            results = search_indexes(indexes, 'invoice total', 2)
+        self.assertEqual([(r.doc_id, r.score) for r in results], [(0, 30.0), (1, 29.0)])
+        with mock.patch('models.retriever.HYBRID_RETRIEVAL', True):
+            search_indexes(indexes, 'invoice total', 2)
+        self.assertEqual(sum(len(index.model.encoded) for index in indexes), 2)
+
+    def test_pages_found_by_both_rankings_come_first(self):
+        index = FakeIndex(0, [(1, 30.0), (2, 29.0), (3, 28.0)], ['cover', 'invoice total', 'invoice total due'])
+        with mock.patch('models.retriever.HYBRID_RETRIEVAL', True), \
+                mock.patch('models.lexical.LEXICAL_SHORTCUT_MARGIN', 0):
+            results = search_indexes(index, 'invoice total due', 3)
+        self.assertEqual([r.page_num for r in results], [3, 2, 1])
+        self.assertAlmostEqual(results[0].score, 1 / 63 + 1 / 61)
+
+    def test_confident_lexical_hit_skips_the_visual_search(self):
+        index = FakeIndex(0, [(1, 30.0)], ['cover', 'invoice INV-2023-0042', 'terms'])
+        with mock.patch('models.retriever.HYBRID_RETRIEVAL', True), \
+                mock.patch('models.lexical.LEXICAL_SHORTCUT_MIN_SCORE', 0.5):
+            results = search_indexes(index, 'INV-2023-0042', 1)
+        self.assertEqual(index.model.encoded, [])
+        self.assertEqual([r.page_num for r in results], [2])
+
+
+class ScoreGapTests(SimpleTestCase):
+    def results(self, *scores):
+        return [Result(doc_id=0, page_num=page, score=score) for page, score in enumerate(scores, start=1)]
+
+    def test_cuts_at_first_large_visual_drop(self):
+        self.assertEqual(len(cut_on_score_gap(self.results(30.0, 28.0, 12.0, 11.0), 0.2)), 2)
+        self.assertEqual(len(cut_on_score_gap(self.results(30.0, 28.0, 26.0), 0.2)), 3)
+        self.assertEqual(len(cut_on_score_gap(self.results(30.0, 5.0), 0)), 2)
+
+    def test_fused_results_keep_k_pages_when_rankings_agree(self):
+        # Both rankings put page 1 first: it fuses to 2/61, the next pages to 1/62 and 1/63,
+        # a drop a relative gap cut would stop at
+        index = FakeIndex(0, [(1, 30.0), (2, 29.0), (3, 28.0)], ['invoice total due', 'appendix', 'cover'])
+        stored = mock.patch('models.retriever.store_page', side_effect=lambda data, image, session_id:
+                            (None, f'pages/{len(data)}-{session_id}.png'))
+        with mock.patch('models.retriever.HYBRID_RETRIEVAL', True), stored:
+            images = retrieve_documents(index, 'invoice total due', 'session-1', k=3)
+        self.assertEqual(len(images), 3)
+
+    def test_hybrid_retrieval_cuts_visual_candidates_before_fusion(self):
+        # Pages 3 and 4 are far behind visually; page 4 still comes back because its text matches
+        index = FakeIndex(0, [(1, 30.0), (2, 29.0), (3, 5.0), (4, 4.0)], ['cover', 'contents', 'terms', 'invoice'])
+        with mock.patch('models.retriever.HYBRID_RETRIEVAL', True), \
+                mock.patch('models.lexical.LEXICAL_SHORTCUT_MARGIN', 0):
+            results = search_indexes(index, 'invoice', 4)
+            self.assertEqual(sorted(r.page_num for r in results), [1, 2, 4])
+            self.assertEqual([r.page_num for r in search_indexes(index, 'total', 4)], [1, 2])
+
+
+class PageTextTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        model = FakeModel(0, 2)
+        model.embed_id_to_doc_id[2] = {'doc_id': 1, 'page_id': 1}
+        model.doc_ids_to_file_names[1] = 'doc1.pdf'
+        model.index_root, model.index_name = self.root, 'index'
+        os.makedirs(os.path.join(self.root, 'index'))
+        self.RAG = mock.Mock(model=model)
+
+    def saved(self):
+        with open(os.path.join(self.root, 'index', PAGE_TEXT_FILE)) as f:
+            return json.load(f)
+
+    def test_failed_extraction_is_retried_not_saved(self):
+        extracted = {'doc0.pdf': None, 'doc1.pdf': ['invoice 1042']}
+        with mock.patch('models.lexical.extract_pdf_text', side_effect=extracted.get):
+            texts = save_page_texts(self.RAG)
+        self.assertEqual(texts, {0: '', 1: '', 2: 'invoice 1042'})
+        self.assertEqual(self.saved(), {'2': 'invoice 1042'})
+
+        extracted['doc0.pdf'] = ['cover', 'contents']
+        with mock.patch('models.lexical.extract_pdf_text', side_effect=extracted.get) as extract:
+            texts = save_page_texts(self.RAG)
+        extract.assert_called_once_with('doc0.pdf')
+        self.assertEqual(self.saved(), {'0': 'cover', '1': 'contents', '2': 'invoice 1042'})
+
+    def test_missing_text_is_backfilled_off_the_query_path(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_extract(path):
+            started.set()
+            release.wait(5)
+            return ['invoice 1042']
+
+        with mock.patch('models.lexical.extract_pdf_text', side_effect=slow_extract):
+            self.assertIsNone(lexical_index(self.RAG))
+            started.wait(5)
+            # Searches meanwhile go visual only instead of waiting for pdftotext
+            self.assertIsNone(lexical_index(self.RAG))
+            release.set()
+            _backfills[self.RAG.model].join(5)
+        index = lexical_index(self.RAG)
+        self.assertEqual(index.search('invoice 1042', 1)[0], [0])
+        self.assertEqual(set(self.saved()), {'0', '1', '2'})
+
+
+class VisionCacheTests(SimpleTestCase):
+    def test_each_load_gets_its_own_namespace(self):
+        old, new = torch.nn.Linear(1, 1), torch.nn.Linear(1, 1)
+        _register_instance((old, 'processor', 'cpu'), {'model_id': 'Qwen/Qwen2-VL-7B-Instruct'})
+        _register_instance((new, 'processor', 'cpu'), {'model_id': 'Qwen/Qwen2-VL-7B-Instruct'})
+        self.assertEqual(vision_cache_namespace(old)[0], 'Qwen/Qwen2-VL-7B-Instruct')
+        self.assertNotEqual(vision_cache_namespace(old), vision_cache_namespace(new))
+
+    def test_replaced_instance_no_longer_stores(self):
+        cache = VisionEncoderCache(max_bytes=1024)
+        old, new = ('qwen', 1), ('qwen', 2)
+        cache.put((old, 'page', 280, 280), torch.zeros(4))
+        cache.clear(old)
+        # The old instance finishes a request after the swap
+        cache.put((old, 'page', 280, 280), torch.zeros(4))
+        cache.put((new, 'page', 280, 280), torch.ones(4))
+        self.assertIsNone(cache.get((old, 'page', 280, 280)))
+        self.assertTrue(torch.equal(cache.get((new, 'page', 280, 280)), torch.ones(4)))
+
+    def test_freed_instance_releases_its_namespace(self):
+        model = torch.nn.Linear(1, 1)
+        _register_instance(model, {'model_id': 'Qwen/Qwen2-VL-7B-Instruct'})
+        namespace = vision_cache_namespace(model)
+        vision_cache.clear(namespace)
+        self.assertIn(namespace, vision_cache._retired)
+        del model
+        gc.collect()
+        self.assertNotIn(namespace, vision_cache._retired)
+
+    def test_whole_call_output_is_cached_as_a_copy(self):
+        batch = torch.arange(8.0)
+        model = mock.Mock(vision_model=mock.Mock(forward=lambda pixels: (batch[:4], {'hidden': batch[4:]})))
+        install_whole_call_cache(model)
+        key = (('llama', 1), 'page', 280, 280)
+        with page_keys([key]):
+            model.vision_model.forward(None)
+        cached = vision_cache.get(key)
+        batch.zero_()
+        self.assertEqual(cached[0].tolist(), [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(cached[1]['hidden'].tolist(), [4.0, 5.0, 6.0, 7.0])
+        vision_cache.forget(('llama', 1))
+
+
+class SingleFlightTests(SimpleTestCase):
+    def run_with_follower(self, leader_fn, follower_fn):
+        """Runs leader_fn, and follower_fn under the same key while leader_fn is in flight."""
+        flight = SingleFlight(lock_dir=None)
+        entered, release = threading.Event(), threading.Event()
+        outcomes = {}
+
+        def leader():
+            entered.set()
+            release.wait(5)
+            return leader_fn()
+
+        def call(name, fn):
+            try:
+                outcomes[name] = flight.run('key', fn, private_errors=(AdmissionRejected,))
+            except Exception as e:
+                outcomes[name] = e
+
+        leading = threading.Thread(target=call, args=('leader', leader))
+        leading.start()
+        entered.wait(5)
+        following = threading.Thread(target=call, args=('follower', follower_fn))
+        following.start()
+        while not flight._calls['key'].followers:
+            time.sleep(0.01)
+        release.set()
+        leading.join(5)
+        following.join(5)
+        return outcomes
+
+    def test_follower_gets_the_leaders_result(self):
+        follower = mock.Mock(return_value='own')
+        outcomes = self.run_with_follower(lambda: 'shared', follower)
+        self.assertEqual(outcomes, {'leader': ('shared', False), 'follower': ('shared', True)})
+        follower.assert_not_called()
+
+    def test_follower_shares_the_leaders_error(self):
+        def fail():
+            raise RuntimeError('backend down')
+        outcomes = self.run_with_follower(fail, mock.Mock())
+        self.assertIsInstance(outcomes['follower'], RuntimeError)
+
+    def test_follower_runs_itself_when_the_leader_is_rejected(self):
+        def reject():
+            raise AdmissionRejected('rate_limited', 'Token budget exhausted for alice')
+        outcomes = self.run_with_follower(reject, lambda: 'own')
+        self.assertIsInstance(outcomes['leader'], AdmissionRejected)
+        self.assertEqual(outcomes['follower'], ('own', False))
+
+
+    def age(self, *paths):
+        for path in paths:
+            os.utime(path, (time.time() - 120, time.time() - 120))
+
+    def test_expired_results_take_their_lock_files_along(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir, ignore_errors=True)
+        flight = SingleFlight(lock_dir=lock_dir, result_ttl=60)
+        self.assertEqual(flight.run('old', lambda: 'answer'), ('answer', False))
+        old_lock, old_result = flight._paths('old')
+        stale_temp = os.path.join(lock_dir, 'crashed.json.123.tmp')
+        open(stale_temp, 'w').close()
+        self.age(old_lock, old_result, stale_temp)
+
+        busy_lock, _ = flight._paths('busy')
+        with open(busy_lock, 'a') as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            self.age(busy_lock)
+            flight.run('new', lambda: 'answer')
+        self.assertEqual(sorted(os.listdir(lock_dir)),
+                         sorted(os.path.basename(path) for path in (busy_lock, *flight._paths('new'))))
+
+    def test_waiter_on_an_unlinked_lock_file_starts_over(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir, ignore_errors=True)
+        flight = SingleFlight(lock_dir=lock_dir)
+        lock_path, _ = flight._paths('key')
+        waiting, locked = threading.Event(), []
+        sleep = time.sleep
+
+        def wait(seconds):
+            waiting.set()
+            sleep(seconds)
+
+        with open(lock_path, 'a') as expired:
+            fcntl.flock(expired, fcntl.LOCK_EX)
+            with mock.patch('time.sleep', side_effect=wait):
+                waiter = threading.Thread(
+                    target=lambda: locked.append(flight._lock_file(lock_path, time.monotonic() + 5)))
+                waiter.start()
+                waiting.wait(5)
+                # What an expiry sweep does: unlink while holding the lock, then release it
+                os.remove(lock_path)
+                fcntl.flock(expired, fcntl.LOCK_UN)
+                waiter.join(5)
+            expired_inode = os.fstat(expired.fileno()).st_ino
+        with locked[0]:
+            self.assertNotEqual(os.fstat(locked[0].fileno()).st_ino, expired_inode)
+            self.assertEqual(os.fstat(locked[0].fileno()).st_ino, os.stat(lock_path).st_ino)
+
+
+class AnswerQueryTests(SimpleTestCase):
+    def test_shared_answer_references_pages_for_the_follower(self):
+        result = {'retrieved_images': ['pages/ab/cd/abcd.png'], 'images': ['pages/ab/cd/abcd.png'],
+                  'response_text': '$310', 'cache_hit': False, 'model': 'qwen'}
+        with mock.patch('models.pipeline.ANSWER_CACHE_ENABLED', False), \
+                mock.patch('models.pipeline.single_flight.run', return_value=(result, True)), \
+                mock.patch('models.pipeline.reference_page', return_value=True) as reference:
+            answer = answer_query(None, 'index-v1', 'total of invoice 1042', 'session-2', 'qwen')
+        self.assertEqual(answer['response_text'], '$310')
+        reference.assert_called_once_with('abcd', 'session-2')
+
+    def test_standalone_questions_use_the_cache_in_later_turns(self):
+        cached = {'query': 'total of invoice 1042', 'answer': '$310', 'images': ['pages/ab/cd/abcd.png']}
+        history = 'Recent conversation:\nUser: Who is the supplier?\nAssistant: Acme.'
+        with mock.patch('models.pipeline.ANSWER_CACHE_ENABLED', True), \
+                mock.patch('models.pipeline.answer_cache.lookup', return_value=cached) as lookup, \
+                mock.patch('models.pipeline.single_flight.run', return_value=({'response_text': 'fresh'}, False)):
+            answer = answer_query(None, 'index-v1', 'What is the total of invoice 1042?', 'session-1',
+                                  history=history)
+            self.assertEqual((answer['response_text'], answer['cache_hit']), ('$310', True))
+            answer = answer_query(None, 'index-v1', 'And what is its due date?', 'session-1', history=history)
+            self.assertEqual(answer['response_text'], 'fresh')
+        lookup.assert_called_once()
+
+
+class FailoverTests(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+        patcher = mock.patch('models.failover.generate_response', side_effect=self.generate_response)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backends = {}
+
+    def generate_response(self, images, query, session_id, resized_height, resized_width, model_choice,
+                          stop_event=None, **kwargs):
+        self.calls.append(model_choice)
+        return self.backends[model_choice](stop_event)
+
+    def test_losing_local_generation_is_stopped(self):
+        stopped = threading.Event()
+
+        def slow_local(stop_event):
+            if stop_event.wait(5):
+                stopped.set()
+                raise GenerationCancelled("Generation with 'qwen' was stopped.")
+            return 'late', ['page.png']
+
+        self.backends = {'qwen': slow_local, 'gpt4': lambda stop_event: ('fast', ['page.png'])}
+        failover = Failover(hedge_enabled=True, hedge_min_samples=1)
+        failover.health('qwen').latencies.append(0.01)
+        text, _, backend = failover.generate(['page.png'], 'q', 'session-1', model_choice='qwen', fallback='gpt4')
+        self.assertEqual((text, backend), ('fast', 'gpt4'))
+        self.assertTrue(stopped.wait(5))
+        # A stopped call is neither a success nor a failure of the backend
+        self.assertEqual((failover.health('qwen').failures, len(failover.health('qwen').latencies)), (0, 1))
+
+    def test_fallback_waits_for_a_slot_of_its_model(self):
+        def down(stop_event):
+            raise RuntimeError('backend down')
+
+        self.backends = {'gpt4': down, 'qwen': lambda stop_event: ('local', ['page.png'])}
+        controller = AdmissionController(model_slots=1, queue_timeout=0.2)
+        failover = Failover(hedge_enabled=False, admission_controller=controller)
+        with controller.admit('someone-else', 'qwen', tokens_per_minute=0):
+            text, _, _ = failover.generate(['page.png'], 'q', 'session-1', model_choice='gpt4', fallback='qwen',
+                                           user_key='alice')
+        self.assertIn('No qwen slot became free', text)
+        self.assertEqual(self.calls, ['gpt4'])
+        text, _, backend = failover.generate(['page.png'], 'q', 'session-1', model_choice='gpt4', fallback='qwen',
+                                             user_key='alice')
+        self.assertEqual((text, backend), ('local', 'qwen'))
+
+
+class LexicalIndexTests(SimpleTestCase):
+    texts = {
+        0: 'Quarterly report revenue revenue revenue and costs',
+        1: 'Invoice INV-2023-0042 total due 310',
+        2: 'Revenue summary for the year',
+    }
+
+    def test_codes_are_kept_whole(self):
+        self.assertIn('inv-2023-0042', tokenize('Invoice INV-2023-0042'))
+        self.assertIn('0042', tokenize('Invoice INV-2023-0042'))
+
+    def test_bm25_ranks_by_term_frequency_and_rarity(self):
+        index = LexicalIndex(self.texts, 3)
+        ids, scores = index.search('revenue', 3)
+        self.assertEqual(ids, [0, 2])
+        self.assertGreater(scores[0], scores[1])
+        self.assertEqual(index.search('inv-2023-0042', 3)[0], [1])
+        self.assertEqual(index.search('unknown words', 3), ([], []))
+
+    def test_candidates_restrict_the_search(self):
+        index = LexicalIndex(self.texts, 3)
+        self.assertEqual(index.search('revenue', 3, candidates=np.array([2]))[0], [2])
+
+
+class PageFilterTests(SimpleTestCase):
+    def test_page_ranges_are_parsed(self):
+        self.assertEqual(parse_page_ranges('1-3, 7,'), [(1, 3), (7, 7)])
+        for invalid in ('0-2', '5-3', 'a-b'):
+            with self.assertRaises(ValueError):
+                parse_page_ranges(invalid)
+
+    def test_filters_are_normalized(self):
+        filters = normalize_filters({'page_ranges': '7, 1-3', 'doc_types': ['.PDF', 'png', 'pdf'],
+                                     'file_names': 'a.pdf', 'uploaded_after': '1700000000.5', 'uploaded_before': ''})
+        self.assertEqual(filters, {'page_ranges': ((1, 3), (7, 7)), 'doc_types': ('pdf', 'png'),
+                                   'file_names': ('a.pdf',), 'uploaded_after': 1700000000})
+        self.assertIsNone(normalize_filters({'file_names': [], 'page_ranges': None}))
+        with self.assertRaises(ValueError):
+            normalize_filters({'owner': 'alice'})
+
+
+class PageStoreTests(SimpleTestCase):
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, ignore_errors=True)
+        cwd = os.getcwd()
+        os.chdir(folder)
+        self.addCleanup(os.chdir, cwd)
+        self.image = Image.new('RGB', (4, 4))
+
+    def blobs(self):
+        return [name for _, _, files in os.walk(os.path.join('static', 'pages')) for name in files]
+
+    def test_page_lives_until_its_last_session_is_released(self):
+        page_id, path = store_page(b'page-1', self.image, 'session-1')
+        self.assertEqual(store_page(b'page-1', self.image, 'session-2'), (page_id, path))
+        self.assertEqual(self.blobs(), [f'{page_id}.png'])
+        self.assertEqual(release_session('session-1'), 0)
+        self.assertTrue(os.path.exists(os.path.join('static', path)))
+        self.assertEqual(release_session('session-2'), 1)
+        self.assertEqual(self.blobs(), [])
+        self.assertFalse(reference_page(page_id, 'session-3'))
+
+    def test_reference_keeps_a_page_alive(self):
+        page_id, _ = store_page(b'page-1', self.image, 'session-1')
+        self.assertTrue(reference_page(page_id, 'session-2'))
+        release_session('session-1')
+        self.assertEqual(self.blobs(), [f'{page_id}.png'])
+
+    def test_garbage_collection_deletes_unreferenced_blobs(self):
+        page_id, path = store_page(b'page-1', self.image, 'session-1')
+        # A blob published by a writer that crashed before counting its reference,
+        # and the temporary files of writers that crashed earlier still
+        folder = os.path.dirname(os.path.join('static', path))
+        for name in ('0' * 64 + '.png', f'{page_id}.png.1.2.tmp', f'{page_id}.png.3.4.tmp'):
+            open(os.path.join(folder, name), 'w').close()
+        os.utime(os.path.join(folder, f'{page_id}.png.1.2.tmp'), (0, 0))
+        self.assertEqual(collect_garbage(), 1)
+        self.assertEqual(sorted(self.blobs()), [f'{page_id}.png', f'{page_id}.png.3.4.tmp'])
+
+    def test_counts_are_built_from_ref_files_of_older_stores(self):
+        page_id, _ = store_page(b'page-1', self.image, 'session-1')
+        store_page(b'page-1', self.image, 'session-2')
+        shutil.rmtree(os.path.join('sessions', 'page_refs', 'counts'))
+        self.assertEqual(release_session('session-1'), 0)
+        self.assertEqual(collect_garbage(), 0)
+        self.assertEqual(release_session('session-2'), 1)
+
+
+class ConversationContextTests(SimpleTestCase):
+    def chat(self, turns, start=0):
+        messages = []
+        for n in range(start, start + turns):
+            messages.append({'role': 'user', 'content': f'Question {n}?'})
+            messages.append({'role': 'assistant', 'content': f'<p>Answer {n}. More detail.</p>'})
+        return messages
+
+    def test_recent_messages_are_quoted(self):
+        context, summary = conversation_context(self.chat(2))
+        self.assertEqual(context, 'Recent conversation:\nUser: Question 0?\nAssistant: Answer 0. More detail.\n'
+                                  'User: Question 1?\nAssistant: Answer 1. More detail.')
+        self.assertEqual(summary, {'text': '', 'turns': 0})
+
+    def test_older_messages_are_folded_into_the_summary(self):
+        context, summary = conversation_context(self.chat(3))
+        self.assertEqual(summary, {'text': 'User asked: Question 0?\nAssistant answered: Answer 0.', 'turns': 2})
+        self.assertTrue(context.startswith('Summary of the earlier conversation:\nUser asked: Question 0?'))
+        self.assertNotIn('User: Question 0?', context)
+
+        # Later turns only pass the messages after those already summarized
+        context, summary = conversation_context(self.chat(3, start=1), summary, offset=2)
+        self.assertEqual(summary['turns'], 4)
+        self.assertIn('Assistant answered: Answer 1.', summary['text'])
+        self.assertIn('User: Question 3?', context)
+
+    def test_no_budget_means_no_history(self):
+        self.assertEqual(conversation_context(self.chat(3), budget=0), ('', {'text': '', 'turns': 0}))
+
+    def test_follow_ups_depend_on_history(self):
+        for query in ('What does it cost?', 'And in 2023?', 'what about the second invoice', 'Why?',
+                      'Summarize the previous answer'):
+            self.assertTrue(depends_on_history(query), query)
+        for query in ('What is the total of invoice 1042?', 'Who signed the contract with Acme?'):
+            self.assertFalse(depends_on_history(query), query)
+
+
+class BackendHealthTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('models.failover.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.health = BackendHealth('gpt4', failure_threshold=2, reset_seconds=30)
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        self.health.record_failure(0.1)
+        self.health.record_success(0.1)
+        self.health.record_failure(0.1)
+        self.assertEqual(self.health.state, CLOSED)
+        self.health.record_failure(0.1)
+        self.assertEqual(self.health.state, OPEN)
+        self.assertFalse(self.health.allow())
+
+    def test_one_trial_call_after_the_reset_period(self):
+        self.health.record_failure(0.1)
+        self.health.record_failure(0.1)
+        self.now += 30
+        self.assertTrue(self.health.allow())
+        self.assertEqual(self.health.state, HALF_OPEN)
+        self.assertFalse(self.health.allow())
+        self.health.record_success(0.2)
+        self.assertEqual(self.health.state, CLOSED)
+        self.assertTrue(self.health.allow())
+
+    def test_failed_trial_reopens_the_circuit(self):
+        self.health.record_failure(0.1)
+        self.health.record_failure(0.1)
+        self.now += 30
+        self.assertTrue(self.health.allow())
+        self.health.record_failure(0.1)
+        self.assertEqual(self.health.state, OPEN)
+        self.assertFalse(self.health.allow())
+
+    def test_hedge_delay_needs_enough_samples(self):
+        self.assertIsNone(self.health.hedge_delay(95, min_samples=3))
+        for seconds in (0.1, 0.2, 0.3, 0.4):
+            self.health.record_success(seconds)
+        self.assertEqual(self.health.hedge_delay(50, min_samples=3), 0.2)
+
+
+class SnapshotCollectionTests(SimpleTestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+        with open(self.path, 'w', encoding='ascii') as f:
+            f.write('aaaabbcccccc')
+        self.collection = SnapshotCollection(self.path, [0, 1, 2], [0, 4, 6, 12])
+
+    def test_pages_are_read_from_the_mapped_file(self):
+        self.assertEqual([self.collection[i] for i in (0, 1, 2)], ['aaaa', 'bb', 'cccccc'])
+        self.assertEqual(len(self.collection), 3)
+        with self.assertRaises(KeyError):
+            self.collection[3]
+
+    def test_added_pages_shadow_mapped_ones(self):
+        self.collection[1] = 'new'
+        self.collection[3] = 'dddd'
+        self.assertEqual(self.collection[1], 'new')
+        self.assertEqual(sorted(self.collection), [0, 1, 2, 3])
+        self.assertEqual(len(self.collection), 4)
+
+    def test_deleted_pages_are_gone(self):
+        del self.collection[0]
+        self.collection[3] = 'dddd'
+        del self.collection[3]
+        self.assertNotIn(0, self.collection)
+        self.assertEqual(list(self.collection), [1, 2])
+        with self.assertRaises(KeyError):
+            del self.collection[0]
+
+
+class FailoverStateTests(SimpleTestCase):
+    setUp = FailoverTests.setUp
+    generate_response = FailoverTests.generate_response
+
+    def down(self, stop_event):
+        raise RuntimeError('backend down')
+
+    def test_errors_fall_back_and_open_the_circuit(self):
+        self.backends = {'gpt4': self.down, 'qwen': lambda stop_event: ('local', ['page.png'])}
+        failover = Failover(hedge_enabled=False, failure_threshold=2, reset_seconds=60,
+                            admission_controller=AdmissionController())
+        for _ in range(2):
+            self.assertEqual(failover.generate(['page.png'], 'q', 's', model_choice='gpt4', fallback='qwen')[2], 'qwen')
+        self.assertEqual(failover.health('gpt4').state, OPEN)
+        # With the circuit open the primary is not called at all
+        self.calls.clear()
+        self.assertEqual(failover.generate(['page.png'], 'q', 's', model_choice='gpt4', fallback='qwen')[2], 'qwen')
+        self.assertEqual(self.calls, ['qwen'])
+
+    def test_without_fallback_the_error_is_the_answer(self):
+        self.backends = {'gpt4': self.down}
+        failover = Failover(hedge_enabled=False, failure_threshold=1)
+        text, images, backend = failover.generate(['page.png'], 'q', 's', model_choice='gpt4')
+        self.assertEqual((images, backend), ([], 'gpt4'))
+        self.assertIn('backend down', text)
+        text, _, _ = failover.generate(['page.png'], 'q', 's', model_choice='gpt4')
+        self.assertIn('unavailable after repeated failures', text)
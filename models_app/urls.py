@@ -5,4 +5,6 @@ app_name = 'models'
 
 urlpatterns = [
     path('', views.ModelListView.as_view(), name='model-list'),
-]
\ No newline at end of file
+    path('libraries/', views.LibraryListView.as_view(), name='library-list'),
+    path('uploads/', views.UploadListView.as_view(), name='upload-list'),
+]
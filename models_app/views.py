@@ -1,6 +1,76 @@
+import re
+
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from django.utils.text import get_valid_filename
+from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
+from chat_app.models import ChatSession
+from models.library import libraries
+
+from .models import ModelConfig, UploadedFile
+from .processing import UploadTooLarge, save_upload, upload_processor, upload_status
+
+# Session IDs name folders on disk, so only plain identifiers are accepted
+SESSION_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+
+UPLOAD_FIELDS = ('id', 'session_id', 'original_name', 'file_type', 'size', 'content_hash',
+                 'uploaded_at', 'processed', 'processing_results')
+
+def owned_session(request, session_id):
+    """The requesting user's ChatSession with this ID; raises Http404 for anyone else's or an unknown one."""
+    try:
+        return ChatSession.objects.get(pk=session_id, user=request.user)
+    except (ChatSession.DoesNotExist, ValidationError):
+        raise Http404("No such chat session.")
+
 class ModelListView(APIView):
     def get(self, request):
-        return Response({"message": "Models API is working!"})
+        configs = ModelConfig.objects.filter(is_active=True).values('id', 'name', 'model_type', 'updated_at')
+        return Response({"models": list(configs)})
+
+class LibraryListView(APIView):
+    """Lists the shared library indexes that sessions can attach."""
+
+    def get(self, request):
+        return Response({"libraries": libraries.available()})
+
+class UploadListView(APIView):
+    """
+    GET lists a session's uploads with their processing state. POST streams
+    files to disk and queues them for indexing; it returns before indexing
+    finishes, so clients poll GET until `processed` is set. Both only accept
+    the requesting user's own chat sessions.
+    """
+
+    def get(self, request):
+        session_id = request.query_params.get('session_id')
+        if not session_id:
+            return Response({"error": "session_id is required."}, status=status.HTTP_400_BAD_REQUEST)
+        owned_session(request, session_id)
+        uploads = UploadedFile.objects.filter(session_id=session_id).order_by('uploaded_at').values(*UPLOAD_FIELDS)
+        return Response({"uploads": list(uploads)})
+
+    def post(self, request):
+        session_id = request.data.get('session_id', '')
+        files = request.FILES.getlist('file')
+        if not SESSION_ID_PATTERN.fullmatch(session_id) or not files:
+            return Response({"error": "A valid session_id and at least one file are required."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        owned_session(request, session_id)
+        indexer_model = request.data.get('indexer_model', 'vidore/colpali')
+
+        results = []
+        for file in files:
+            try:
+                upload, created = save_upload(file, get_valid_filename(file.name), session_id, indexer_model)
+            except UploadTooLarge as e:
+                results.append({"original_name": file.name, "error": str(e)})
+                continue
+            if created:
+                upload_processor.submit(upload.pk)
+            results.append({"id": upload.pk, "original_name": file.name, "duplicate": not created,
+                            "status": upload_status(upload)})
+        return Response({"uploads": results}, status=status.HTTP_202_ACCEPTED)
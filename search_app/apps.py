@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def _create_fts_index(sender, using, **kwargs):
+    from django.db import connections
+    from .fts import ensure_fts_index
+    ensure_fts_index(connections[using])
 
 
 class SearchAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'search_app'
+
+    def ready(self):
+        post_migrate.connect(_create_fts_index, sender=self)
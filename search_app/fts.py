@@ -0,0 +1,77 @@
+import re
+
+from django.db import connection
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+FTS_TABLE = 'search_app_searchquery_fts'
+SOURCE_TABLE = 'search_app_searchquery'
+
+# External-content FTS5 index over SearchQuery.query, kept in sync by triggers
+_FTS_STATEMENTS = [
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        query, content='{SOURCE_TABLE}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {SOURCE_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, query) VALUES (new.id, new.query);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {SOURCE_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, query) VALUES ('delete', old.id, old.query);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF query ON {SOURCE_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, query) VALUES ('delete', old.id, old.query);
+        INSERT INTO {FTS_TABLE}(rowid, query) VALUES (new.id, new.query);
+    END""",
+]
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def fts_available(using=connection):
+    return using.vendor == 'sqlite'
+
+
+def ensure_fts_index(using=connection):
+    """
+    Creates the FTS5 table and sync triggers if they are missing, indexing
+    any rows that already exist. Safe to call repeatedly.
+    """
+    if not fts_available(using):
+        return False
+    with using.cursor() as cursor:
+        tables = using.introspection.table_names(cursor)
+        if SOURCE_TABLE not in tables:
+            return False
+        if FTS_TABLE in tables:
+            return True
+        for statement in _FTS_STATEMENTS:
+            cursor.execute(statement)
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    logger.info(f"Created full-text index {FTS_TABLE}.")
+    return True
+
+
+def to_match_expression(text):
+    """
+    Turns free text into an FTS5 MATCH expression: every word must appear,
+    and the last word matches as a prefix so partially typed queries work.
+    """
+    tokens = _TOKEN_RE.findall(text)
+    if not tokens:
+        return None
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def match_subquery(text):
+    """
+    Returns (sql, params) selecting the ids of SearchQuery rows matching text,
+    or None if the text has no searchable words.
+    """
+    expression = to_match_expression(text)
+    if expression is None:
+        return None
+    return f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [expression]
@@ -0,0 +1,84 @@
+import base64
+
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from analytics_app.buffer import EventBuffer, buffer_setting
+
+from .fts import ensure_fts_index, fts_available, match_subquery
+from .models import SearchQuery
+
+search_buffer = EventBuffer(
+    'search_app.SearchQuery',
+    max_events=buffer_setting('MAX_EVENTS', 10000),
+    batch_size=buffer_setting('BATCH_SIZE', 500),
+    flush_interval=buffer_setting('FLUSH_INTERVAL', 2.0),
+    drop_policy=buffer_setting('DROP_POLICY', 'newest'),
+)
+
+_fts_ready = False
+
+
+def record_search(query, page_ids, user=None, session_id=''):
+    """
+    Buffers a SearchQuery row. Results are stored as page IDs from the page
+    store rather than image paths or image data.
+    """
+    return search_buffer.add(
+        user_id=user.pk if user is not None and user.is_authenticated else None,
+        session_id=session_id or '',
+        query=query,
+        results=[page_id for page_id in page_ids if page_id],
+        timestamp=timezone.now(),
+    )
+
+
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(f"{row.timestamp.isoformat()}|{row.pk}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, pk = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        parsed = parse_datetime(timestamp)
+        if parsed is None:
+            raise ValueError
+        return parsed, int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def search_history(user, text='', cursor=None, limit=20, session_id=None):
+    """
+    Returns one page of a user's past queries, newest first.
+
+    Matching uses the FTS5 index on SQLite and falls back to a substring
+    filter elsewhere. Pagination is keyset-based on (timestamp, id), so each
+    page costs the same however deep into the history it is.
+
+    Returns:
+        tuple: (list of SearchQuery, next cursor or None)
+    """
+    global _fts_ready
+
+    rows = SearchQuery.objects.filter(user=user)
+    if session_id:
+        rows = rows.filter(session_id=session_id)
+    if text:
+        if fts_available() and (_fts_ready or ensure_fts_index()):
+            _fts_ready = True
+            subquery = match_subquery(text)
+            if subquery is None:
+                return [], None
+            rows = rows.filter(id__in=RawSQL(*subquery))
+        else:
+            rows = rows.filter(query__icontains=text)
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        rows = rows.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+
+    page = list(rows.order_by('-timestamp', '-id')[:limit + 1])
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
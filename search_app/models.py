@@ -1,15 +1,23 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class SearchQuery(models.Model):
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
+    session_id = models.CharField(max_length=64, blank=True, default='')
     query = models.TextField()
+    # Page IDs (content hashes from models.page_store) of the retrieved pages
     results = models.JSONField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set by the caller so buffered queries keep the time they were made
+    timestamp = models.DateTimeField(default=timezone.now)
     
     class Meta:
         ordering = ['-timestamp']
         verbose_name_plural = 'Search queries'
+        indexes = [
+            # Keyset pagination of a user's history: (user, timestamp, id) descending
+            models.Index(fields=['user', '-timestamp', '-id']),
+        ]
 
     def __str__(self):
         return f"{self.query[:50]}..."
@@ -1,6 +1,41 @@
+from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
+from models.page_store import page_relative_path
+
+from .history import search_history
+
+MAX_PAGE_SIZE = 100
+
 class SearchView(APIView):
     def get(self, request):
-        return Response({"message": "Search API is working!"})
+        try:
+            limit = min(int(request.query_params.get('limit', 20)), MAX_PAGE_SIZE)
+        except ValueError:
+            return Response({"error": "limit must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            rows, next_cursor = search_history(
+                request.user,
+                text=request.query_params.get('q', '').strip(),
+                cursor=request.query_params.get('cursor'),
+                limit=max(limit, 1),
+                session_id=request.query_params.get('session_id'),
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            "results": [
+                {
+                    "id": row.pk,
+                    "query": row.query,
+                    "session_id": row.session_id,
+                    "timestamp": row.timestamp.isoformat(),
+                    "page_ids": row.results,
+                    "images": [page_relative_path(page_id) for page_id in row.results],
+                }
+                for row in rows
+            ],
+            "next_cursor": next_cursor,
+        })
@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class UsersAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'users_app'
+
+    def ready(self):
+        from .models import UserProfile
+        from .profiles import invalidate_user_limits
+        post_save.connect(invalidate_user_limits, sender=UserProfile)
+        post_delete.connect(invalidate_user_limits, sender=UserProfile)
@@ -5,6 +5,9 @@ class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     api_key = models.CharField(max_length=255, blank=True, null=True)
     max_tokens = models.IntegerField(default=2000)
+    # Admission limits for generation requests (models/admission.py)
+    max_concurrent_requests = models.PositiveSmallIntegerField(default=1)
+    tokens_per_minute = models.IntegerField(default=20000)
     preferences = models.JSONField(default=dict)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from django.conf import settings
+
+from models.admission import (
+    ADMISSION_MAX_TOKENS, ADMISSION_TOKENS_PER_MINUTE, ADMISSION_USER_SLOTS,
+)
+
+from .models import UserProfile
+
+_limits = {}  # user_id -> (limits dict, expiry)
+_limits_lock = threading.Lock()
+
+DEFAULT_LIMITS = {
+    'max_tokens': ADMISSION_MAX_TOKENS,
+    'user_slots': ADMISSION_USER_SLOTS,
+    'tokens_per_minute': ADMISSION_TOKENS_PER_MINUTE,
+}
+
+
+def get_user_limits(user):
+    """
+    Returns the admission limits for a user as keyword arguments for
+    `AdmissionController.admit`. Profiles are cached in memory for
+    USER_PROFILE_CACHE_TTL seconds and dropped as soon as they are saved,
+    so the inference path does not query the database per request.
+    """
+    if user is None or not user.is_authenticated:
+        return dict(DEFAULT_LIMITS)
+    now = time.monotonic()
+    with _limits_lock:
+        cached = _limits.get(user.pk)
+        if cached is not None and cached[1] > now:
+            return dict(cached[0])
+
+    profile = UserProfile.objects.filter(user_id=user.pk).only(
+        'max_tokens', 'max_concurrent_requests', 'tokens_per_minute').first()
+    if profile is None:
+        limits = dict(DEFAULT_LIMITS)
+    else:
+        limits = {
+            'max_tokens': profile.max_tokens,
+            'user_slots': profile.max_concurrent_requests,
+            'tokens_per_minute': profile.tokens_per_minute,
+        }
+    with _limits_lock:
+        _limits[user.pk] = (limits, now + getattr(settings, 'USER_PROFILE_CACHE_TTL', 300))
+    return dict(limits)
+
+
+def invalidate_user_limits(sender, instance, **kwargs):
+    with _limits_lock:
+        _limits.pop(instance.user_id, None)